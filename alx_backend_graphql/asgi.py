@@ -2,6 +2,8 @@
 ASGI config for alx_backend_graphql_crm project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Websocket connections go to the GraphQL subscription server of
+crm.subscriptions, HTTP requests to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -13,4 +15,19 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alx_backend_graphql.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once the apps are loaded
+from crm.subscriptions import GraphQLWebSocketApp  # noqa: E402
+
+websocket_application = GraphQLWebSocketApp()
+
+
+async def application(scope, receive, send):
+    """
+    Serve GraphQL subscriptions on websockets at /graphql and
+    everything else with Django
+    """
+    if scope['type'] == 'websocket':
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
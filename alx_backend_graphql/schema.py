@@ -1,5 +1,8 @@
 import graphene
-from crm.schema import Query as CRMQuery, Mutation as CRMMutation
+from crm.schema import (
+    Query as CRMQuery, Mutation as CRMMutation,
+    Subscription as CRMSubscription)
+from crm.tracing import TracingMiddleware
 
 
 class Query(CRMQuery, graphene.ObjectType):
@@ -8,4 +11,12 @@ class Query(CRMQuery, graphene.ObjectType):
 class Mutation(CRMMutation, graphene.ObjectType):
     pass
 
-schema = graphene.Schema(query=Query, mutation=Mutation)
\ No newline at end of file
+class Subscription(CRMSubscription, graphene.ObjectType):
+    pass
+
+schema = graphene.Schema(
+    query=Query, mutation=Mutation, subscription=Subscription)
+
+# Resolver middleware of the view and the in-process executor,
+# registered through GRAPHENE['MIDDLEWARE']
+middleware = [TracingMiddleware()]
\ No newline at end of file
@@ -1,5 +1,6 @@
+import os
 from pathlib import Path
-from django_crontab import crontab
+from celery.schedules import crontab
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -37,9 +38,109 @@ INSTALLED_APPS = [
 ]
 
 GRAPHENE = {
-    "SCHEMA": "alx_backend_graphql.schema.schema"
+    "SCHEMA": "alx_backend_graphql.schema.schema",
+    "MIDDLEWARE": "alx_backend_graphql.schema.middleware",
 }
 
+# Operation tracing (see crm.tracing): share of operations with
+# per-field timings, whether their trace is returned in
+# extensions.tracing, the duration above which an operation is
+# logged and the executions of one SQL shape reported as duplicates
+GRAPHQL_TRACING_SAMPLE_RATE = 0.01
+GRAPHQL_TRACING_EXTENSIONS = DEBUG
+GRAPHQL_SLOW_OPERATION_MS = 500
+GRAPHQL_DUPLICATE_QUERY_THRESHOLD = 2
+
+# Query cost limits (see crm.cost): operations over the maximum cost
+# or depth are rejected before execution; unbounded lists count as
+# GRAPHQL_COST_LIST_SIZE items. Set GRAPHQL_COST_BUDGET_PER_MINUTE to
+# also throttle each client to that much cost per minute.
+GRAPHQL_MAX_QUERY_COST = 20000
+GRAPHQL_MAX_QUERY_DEPTH = 12
+GRAPHQL_COST_LIST_SIZE = 10
+GRAPHQL_COST_BUDGET_PER_MINUTE = None
+GRAPHQL_COST_BUDGET_CACHE = 'graphql'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'crm.tracing': {'handlers': ['console'], 'level': 'WARNING'},
+    },
+}
+
+# Operations accepted in one JSON array posted to /graphql
+GRAPHQL_BATCH_MAX_SIZE = 20
+
+# Parsed/validated GraphQL documents kept per process
+GRAPHQL_DOCUMENT_CACHE_SIZE = 256
+# Cache alias storing Automatic Persisted Query texts
+GRAPHQL_PERSISTED_QUERY_CACHE = 'graphql'
+
+# Set GRAPHQL_CACHE_URL to the Redis instance used by Celery in
+# production so that every worker shares cached responses and
+# invalidations; a process local cache is used otherwise
+GRAPHQL_CACHE_URL = os.environ.get('GRAPHQL_CACHE_URL')
+# Serve hinted read-only queries from the cache (see crm.response_cache).
+# Off unless the cache is shared: a process local cache never sees the
+# invalidations of writes made by other workers or by Celery
+GRAPHQL_RESPONSE_CACHE_ENABLED = bool(GRAPHQL_CACHE_URL)
+GRAPHQL_RESPONSE_CACHE = 'graphql'
+# Redis instance keeping the latest weekly report for every process
+CRM_REPORT_CACHE_URL = os.environ.get(
+    'CRM_REPORT_CACHE_URL', 'redis://localhost:6379/2')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'graphql': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': GRAPHQL_CACHE_URL,
+    } if GRAPHQL_CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'graphql',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'reports': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CRM_REPORT_CACHE_URL,
+    },
+}
+
+# How cron jobs and Celery tasks run their GraphQL documents: 'local'
+# executes them in process, 'remote' posts them to GRAPHQL_REMOTE_URL
+# over a pooled session (see crm.executor)
+GRAPHQL_EXECUTOR = 'local'
+GRAPHQL_REMOTE_URL = 'http://localhost:8000/graphql'
+GRAPHQL_REMOTE_RETRIES = 3
+GRAPHQL_REMOTE_TIMEOUT = 10
+
+# Broker of the GraphQL subscription events (see crm.pubsub): 'memory'
+# serves a single ASGI process, 'redis' shares the events of every
+# process through Redis pub/sub at GRAPHQL_PUBSUB_URL
+GRAPHQL_PUBSUB = 'memory'
+GRAPHQL_PUBSUB_URL = os.environ.get(
+    'GRAPHQL_PUBSUB_URL', 'redis://localhost:6379/1')
+GRAPHQL_PUBSUB_QUEUE_SIZE = 1000
+# Seconds a websocket client has to send connection_init
+GRAPHQL_WS_INIT_TIMEOUT = 10
+
+# Rows per INSERT / IN lookup in the bulk write paths
+CRM_BULK_BATCH_SIZE = 1000
+# Orders fetched per server-side cursor round trip by /export/orders
+CRM_EXPORT_CHUNK_SIZE = 2000
+
+# Weekly report (see crm.reports): customer ids aggregated per
+# subtask, the Redis cache alias holding the latest report and the
+# directory of the JSON report files
+CRM_REPORT_PARTITION_SIZE = 5000
+CRM_REPORT_CACHE = 'reports'
+CRM_REPORT_CACHE_TIMEOUT = 8 * 24 * 60 * 60
+CRM_REPORT_DIR = '/tmp'
+
 CRONJOBS = [
     ('*/5 * * * *', 'crm.cron.log_crm_heartbeat'),
     ('0 */12 * * *', 'crm.cron.update_low_stock'),
@@ -47,6 +148,9 @@ CRONJOBS = [
 
 # Redis settings
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
+# The chord of generate_partitioned_crm_report needs a result backend
+# to collect its header results; the other tasks do not
+CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
 # Task settings
 CELERY_ACCEPT_CONTENT = ['json']
@@ -56,6 +160,26 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'crm.tasks.generate_crm_report',
         'schedule': crontab(day_of_week='mon', hour=6, minute=0),
     },
+    'generate-partitioned-crm-report': {
+        'task': 'crm.tasks.generate_partitioned_crm_report',
+        'schedule': crontab(day_of_week='mon', hour=6, minute=30),
+    },
+    'reconcile-crm-stats': {
+        'task': 'crm.tasks.reconcile_crm_stats',
+        'schedule': crontab(minute=0),
+    },
+    'send-order-reminders': {
+        'task': 'crm.tasks.send_order_reminders',
+        'schedule': crontab(hour=8, minute=0),
+    },
+    'clean-inactive-customers': {
+        'task': 'crm.tasks.clean_inactive_customers',
+        'schedule': crontab(day_of_week='sun', hour=2, minute=0),
+    },
+    'refresh-sales-rollups': {
+        'task': 'crm.tasks.refresh_sales_rollups',
+        'schedule': crontab(minute='*/15'),
+    },
 }
 
 MIDDLEWARE = [
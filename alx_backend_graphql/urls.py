@@ -1,8 +1,12 @@
 from django.urls import path
-from graphene_django.views import GraphQLView
 from django.views.decorators.csrf import csrf_exempt
 from alx_backend_graphql.schema import schema
+from crm.views import AsyncCRMGraphQLView, CRMGraphQLView, OrderExportView
 
 urlpatterns = [
-    path("graphql", csrf_exempt(GraphQLView.as_view(graphiql=True, schema=schema))),
+    path("graphql", csrf_exempt(CRMGraphQLView.as_view(graphiql=True, schema=schema))),
+    # Async executor; serve the project over ASGI to use it
+    path("graphql/async", csrf_exempt(AsyncCRMGraphQLView.as_view(schema=schema))),
+    # Streaming CSV/NDJSON export of the orders (see crm.export)
+    path("export/orders", OrderExportView.as_view()),
 ]
@@ -0,0 +1,144 @@
+"""
+Async execution of the crm schema.
+
+The async view runs the schema with graphql-core's async executor so
+sibling root fields resolve concurrently. Fields listed in their
+type's ``async_fields`` resolve on the event loop with Django's async
+ORM methods (see the root connections and ``stats``); they check
+running_async() and return a coroutine there, so the same resolvers
+still serve the sync view.
+
+Every other resolver may touch the sync ORM, so AsyncBridgeMiddleware
+runs it through sync_to_async on the request's thread, where the
+DataLoaders keep batching as they do in the sync view. Default
+resolvers reading attributes already in memory stay on the loop.
+"""
+import asyncio
+from functools import partial
+from asgiref.sync import sync_to_async
+from django.db import models
+from django.db.models import QuerySet
+from graphene.relay.connection import connection_adapter, page_info_adapter
+from graphene.relay.node import GlobalID
+from graphene.types.resolver import get_default_resolver
+from graphene.utils.str_converters import to_snake_case
+from graphene_django.utils import maybe_queryset
+from graphql import get_named_type, is_leaf_type
+from graphql_relay import (
+    connection_from_array_slice, cursor_to_offset, get_offset_with_default,
+    offset_to_cursor)
+
+
+def running_async():
+    """
+    Return True when called on a running event loop
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _is_async_field(parent_type, field_name):
+    graphene_type = getattr(parent_type, 'graphene_type', None)
+    return to_snake_case(field_name) in getattr(
+        graphene_type, 'async_fields', ())
+
+
+def _is_memory_resolver(resolve):
+    if not isinstance(resolve, partial):
+        return False
+    return (
+        resolve.func is get_default_resolver()
+        or resolve.func == GlobalID.id_resolver
+    )
+
+
+class AsyncBridgeMiddleware:
+    """
+    Graphene middleware moving sync resolvers off the event loop
+    """
+    def __init__(self):
+        # (parent type, field) -> (async field, in-memory resolver)
+        self._kinds = {}
+
+    def kind(self, info):
+        key = (info.parent_type.name, info.field_name)
+        kind = self._kinds.get(key)
+        if kind is None:
+            field = info.parent_type.fields[info.field_name]
+            kind = self._kinds[key] = (
+                _is_async_field(info.parent_type, info.field_name),
+                _is_memory_resolver(field.resolve),
+            )
+        return kind
+
+    def resolve(self, next, root, info, **args):
+        is_async_field, in_memory = self.kind(info)
+        if is_async_field or not running_async():
+            return next(root, info, **args)
+        # Relations of model instances may still be loaded lazily
+        if in_memory and (
+                not isinstance(root, models.Model)
+                or is_leaf_type(get_named_type(info.return_type))):
+            return next(root, info, **args)
+        return sync_to_async(next)(root, info, **args)
+
+
+async def resolve_connection(connection, args, iterable, max_limit=None):
+    """
+    Async twin of DjangoConnectionField.resolve_connection counting
+    and fetching only the requested page with the async ORM
+    """
+    offset = args.pop('offset', None)
+    if offset:
+        if args.get('after'):
+            offset += cursor_to_offset(args['after']) + 1
+        args['after'] = offset_to_cursor(offset - 1)
+
+    iterable = maybe_queryset(iterable)
+    if isinstance(iterable, QuerySet):
+        array_length = await iterable.acount()
+    else:
+        array_length = len(iterable)
+
+    if (
+        max_limit is not None
+        and args.get('first') is None
+        and args.get('last') is None
+    ):
+        args['first'] = max_limit
+
+    # Same bounds as connection_from_array_slice
+    after = args.get('after')
+    before = args.get('before')
+    first = args.get('first')
+    last = args.get('last')
+    start = min(get_offset_with_default(after, -1) + 1, array_length)
+    end = min(array_length, get_offset_with_default(before, array_length))
+    if isinstance(first, int):
+        end = min(end, start + first)
+    if isinstance(last, int):
+        start = max(start, end - last)
+    start = min(start, end)
+
+    if isinstance(iterable, QuerySet):
+        nodes = [node async for node in iterable[start:end]]
+    else:
+        nodes = list(iterable[start:end])
+
+    result = connection_from_array_slice(
+        nodes,
+        args,
+        slice_start=start,
+        array_length=array_length,
+        array_slice_length=len(nodes),
+        connection_type=partial(connection_adapter, connection),
+        edge_type=connection.Edge,
+        page_info_type=page_info_adapter,
+    )
+    result.iterable = iterable
+    result.length = array_length
+    return result
+
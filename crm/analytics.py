@@ -0,0 +1,192 @@
+"""
+Time-bucketed sales analytics backed by the SalesRollup table.
+
+Order writes mark their ``order_date`` dirty (see crm.signals); the
+``refresh_sales_rollups`` Celery task then rebuilds the day, week and
+month buckets covering those days, so a timeseries read touches one
+pre-aggregated row per bucket instead of grouping the order tables.
+"""
+import calendar
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Trunc
+from . import response_cache
+from .models import Order, SalesRollup, SalesRollupDirtyDay
+
+
+GRANULARITIES = (SalesRollup.DAY, SalesRollup.WEEK, SalesRollup.MONTH)
+
+
+def bucket_start(day, granularity):
+    """
+    Return the first day of the bucket containing day
+    """
+    if granularity == SalesRollup.WEEK:
+        return day - timedelta(days=day.weekday())
+    if granularity == SalesRollup.MONTH:
+        return day.replace(day=1)
+    return day
+
+
+def bucket_end(start, granularity):
+    """
+    Return the last day of the bucket starting on start
+    """
+    if granularity == SalesRollup.WEEK:
+        return start + timedelta(days=6)
+    if granularity == SalesRollup.MONTH:
+        last_day = calendar.monthrange(start.year, start.month)[1]
+        return start.replace(day=last_day)
+    return start
+
+
+def mark_days_dirty(days):
+    """
+    Queue days whose rollups must be rebuilt
+    """
+    days = {day for day in days if day is not None}
+    if days:
+        SalesRollupDirtyDay.objects.bulk_create(
+            [SalesRollupDirtyDay(day=day) for day in days],
+            ignore_conflicts=True,
+        )
+
+
+def _aggregate_buckets(granularity, buckets):
+    """
+    Yield SalesRollup rows for the given buckets of one granularity,
+    computed with one GROUP BY for totals and one for products
+    """
+    ends = [bucket_end(b, granularity) for b in buckets]
+    date_range = (min(buckets), max(ends))
+
+    totals = (
+        Order.objects
+        .filter(order_date__range=date_range)
+        .annotate(bucket=Trunc('order_date', granularity))
+        .filter(bucket__in=buckets)
+        .values('bucket')
+        .annotate(
+            order_count=Count('pk'),
+            revenue=Sum('total_amount'),
+            customer_count=Count('customer_id', distinct=True),
+        )
+    )
+    for row in totals:
+        yield SalesRollup(granularity=granularity, product=None, **row)
+
+    per_product = (
+        Order.products.through.objects
+        .filter(order__order_date__range=date_range)
+        .annotate(bucket=Trunc('order__order_date', granularity))
+        .filter(bucket__in=buckets)
+        .values('bucket', 'product_id')
+        .annotate(
+            order_count=Count('order_id', distinct=True),
+            revenue=Sum('product__price'),
+            customer_count=Count('order__customer_id', distinct=True),
+        )
+    )
+    for row in per_product:
+        yield SalesRollup(granularity=granularity, **row)
+
+
+def rebuild_sales_rollups(days):
+    """
+    Rebuild every bucket, at every granularity, containing one of days
+    """
+    days = set(days)
+    if not days:
+        return 0
+
+    created = 0
+    for granularity in GRANULARITIES:
+        buckets = sorted({bucket_start(day, granularity) for day in days})
+        with transaction.atomic():
+            SalesRollup.objects.filter(
+                granularity=granularity, bucket__in=buckets).delete()
+            rows = SalesRollup.objects.bulk_create(
+                _aggregate_buckets(granularity, buckets), batch_size=1000)
+            created += len(rows)
+    response_cache.invalidate_models(SalesRollup)
+    return created
+
+
+def refresh_sales_rollups(max_days=None):
+    """
+    Drain the dirty-day queue and rebuild the affected buckets
+    """
+    queued = SalesRollupDirtyDay.objects.order_by('day')
+    if max_days is not None:
+        queued = queued[:max_days]
+    days = list(queued.values_list('day', flat=True))
+    if not days:
+        return 0
+
+    # Dequeue first so days dirtied during the rebuild are kept, in
+    # the same transaction so a failed rebuild leaves them queued
+    with transaction.atomic():
+        SalesRollupDirtyDay.objects.filter(day__in=days).delete()
+        rebuild_sales_rollups(days)
+    return len(days)
+
+
+def _rollup_timeseries(granularity, start, end, product_id):
+    rows = (
+        SalesRollup.objects
+        .filter(
+            granularity=granularity,
+            bucket__range=(bucket_start(start, granularity), end),
+            product_id=product_id,
+        )
+        .order_by('bucket')
+        .values('bucket', 'order_count', 'revenue', 'customer_count')
+    )
+    return list(rows)
+
+
+def _customer_timeseries(granularity, start, end, customer_id, product_id):
+    # A single customer's orders are few, so group them directly
+    start = bucket_start(start, granularity)
+    if product_id is None:
+        queryset = (
+            Order.objects
+            .filter(customer_id=customer_id, order_date__range=(start, end))
+            .annotate(bucket=Trunc('order_date', granularity))
+            .values('bucket')
+            .annotate(
+                order_count=Count('pk'),
+                revenue=Sum('total_amount'),
+                customer_count=Count('customer_id', distinct=True),
+            )
+        )
+    else:
+        queryset = (
+            Order.products.through.objects
+            .filter(
+                product_id=product_id,
+                order__customer_id=customer_id,
+                order__order_date__range=(start, end),
+            )
+            .annotate(bucket=Trunc('order__order_date', granularity))
+            .values('bucket')
+            .annotate(
+                order_count=Count('order_id', distinct=True),
+                revenue=Sum('product__price'),
+                customer_count=Count('order__customer_id', distinct=True),
+            )
+        )
+    return list(queryset.order_by('bucket'))
+
+
+def sales_timeseries(
+        granularity, start, end, customer_id=None, product_id=None):
+    """
+    Return one dict per bucket overlapping [start, end] with
+    order_count, revenue and customer_count
+    """
+    if customer_id is not None:
+        return _customer_timeseries(
+            granularity, start, end, customer_id, product_id)
+    return _rollup_timeseries(granularity, start, end, product_id)
@@ -0,0 +1,494 @@
+"""
+Set-based validation and insertion for bulk writes.
+
+Running a DRF serializer per row costs one uniqueness SELECT per
+row; here a whole batch is checked with the same rules and messages
+as CustomerSerializer, using precompiled patterns, in-batch duplicate
+detection and one ``email IN (...)`` query per chunk, then inserted
+with chunked ``bulk_create``.
+
+Signals do not fire for bulk_create/bulk_update, so every function
+here also does the bookkeeping crm.signals does for single saves:
+stored order totals, the stats snapshot, dirty rollup days, search
+documents and cached responses.
+"""
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import connections, transaction
+from . import pubsub, response_cache, search
+from .analytics import mark_days_dirty
+from .models import (
+    CRMStats, Customer, InsufficientStock, Order, Product,
+    supports_update_returning)
+from .search import chunked
+from .serializer import PHONE_ERROR, PHONE_RE, ProductSerializer
+from .signals import recompute_order_totals
+
+
+REQUIRED = 'This field is required.'
+BLANK = 'This field may not be blank.'
+TOO_LONG = 'Ensure this field has no more than {} characters.'
+INVALID_EMAIL = 'Enter a valid email address.'
+EMAIL_TAKEN = 'customer with this email already exists.'
+DUPLICATE_IN_BATCH = 'Duplicate of row {}.'
+NULL = 'This field may not be null.'
+EMPTY_LIST = 'This list may not be empty.'
+INCORRECT_PK = 'Incorrect type. Expected pk value, received {}.'
+MISSING_PK = 'Invalid pk "{}" - object does not exist.'
+OUT_OF_STOCK = 'Insufficient stock for product {}.'
+
+
+@dataclass
+class RowError:
+    index: int
+    field: str
+    messages: list
+
+
+@dataclass
+class BulkResult:
+    objects: list
+    created: int
+    errors: list
+
+
+def default_batch_size():
+    return getattr(settings, 'CRM_BULK_BATCH_SIZE', 1000)
+
+
+def _clean_text(row, name, max_length, required=True):
+    """
+    Return (value, messages) the way a DRF CharField would
+    """
+    value = row.get(name)
+    if value is None:
+        return None, [REQUIRED] if required else []
+    value = str(value).strip()
+    if not value:
+        return None, [BLANK] if required else []
+    if len(value) > max_length:
+        return value, [TOO_LONG.format(max_length)]
+    return value, []
+
+
+def clean_customer(row):
+    """
+    Return (cleaned data, [RowError without index]) for one row
+    """
+    data = {}
+    errors = {}
+    data['name'], errors['name'] = _clean_text(row, 'name', 100)
+    data['email'], errors['email'] = _clean_text(row, 'email', 254)
+    if data['email'] and not errors['email']:
+        try:
+            validate_email(data['email'])
+        except ValidationError:
+            errors['email'] = [INVALID_EMAIL]
+    data['phone'], errors['phone'] = _clean_text(
+        row, 'phone', 12, required=False)
+    if data['phone'] and not errors['phone']:
+        if not PHONE_RE.match(data['phone']):
+            errors['phone'] = [PHONE_ERROR]
+    return data, {name: msgs for name, msgs in errors.items() if msgs}
+
+
+def existing_emails(emails, batch_size=None):
+    emails = list(emails)
+    found = set()
+    for chunk in chunked(emails, batch_size or default_batch_size()):
+        found.update(
+            Customer.objects.filter(email__in=chunk)
+            .values_list('email', flat=True))
+    return found
+
+
+def validate_customer_rows(rows, update_existing=False, batch_size=None):
+    """
+    Validate customer rows as one batch.
+
+    Return ([(index, data)], [RowError], emails already stored); rows
+    repeating an earlier email of the batch are rejected, and so are
+    stored emails unless update_existing is set.
+    """
+    valid = []
+    errors = []
+    first_row = {}
+    for index, row in enumerate(rows):
+        data, row_errors = clean_customer(row)
+        if not row_errors and data['email'] in first_row:
+            row_errors = {'email': [
+                DUPLICATE_IN_BATCH.format(first_row[data['email']])]}
+        if row_errors:
+            errors.extend(
+                RowError(index, name, messages)
+                for name, messages in row_errors.items())
+            continue
+        first_row[data['email']] = index
+        valid.append((index, data))
+
+    stored = existing_emails(first_row, batch_size)
+    if stored and not update_existing:
+        errors.extend(
+            RowError(index, 'email', [EMAIL_TAKEN])
+            for index, data in valid if data['email'] in stored)
+        valid = [
+            (index, data) for index, data in valid
+            if data['email'] not in stored]
+    errors.sort(key=lambda error: error.index)
+    return valid, errors, stored
+
+
+def insert_new_customers(customers, batch_size):
+    """
+    Insert customers with INSERT ... ON CONFLICT (email) DO NOTHING
+    RETURNING email, and return the emails really inserted; rows a
+    concurrent transaction inserted first are skipped and left out
+    """
+    connection = connections[Customer.objects.db]
+    fields = [f for f in Customer._meta.concrete_fields if not f.primary_key]
+    quote = connection.ops.quote_name
+    table = quote(Customer._meta.db_table)
+    columns = ', '.join(quote(field.column) for field in fields)
+    email = quote(Customer._meta.get_field('email').column)
+    row = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    batch_size = min(
+        batch_size, connection.ops.bulk_batch_size(fields, customers))
+    inserted = set()
+    with connection.cursor() as cursor:
+        for chunk in chunked(customers, batch_size):
+            params = [
+                field.get_db_prep_save(
+                    field.pre_save(customer, True), connection)
+                for customer in chunk for field in fields
+            ]
+            cursor.execute(
+                f'INSERT INTO {table} ({columns}) '
+                f'VALUES {", ".join([row] * len(chunk))} '
+                f'ON CONFLICT ({email}) DO NOTHING RETURNING {email}',
+                params)
+            inserted.update(row[0] for row in cursor.fetchall())
+    return inserted
+
+
+def bulk_create_customers(rows, batch_size=None, update_existing=False):
+    """
+    Validate and insert customer rows, updating the name and phone of
+    stored emails when update_existing is set. Returns a BulkResult
+    whose objects follow the input order.
+    """
+    batch_size = batch_size or default_batch_size()
+    valid, errors, stored = validate_customer_rows(
+        rows, update_existing, batch_size)
+    if not valid:
+        return BulkResult([], 0, errors)
+
+    customers = [Customer(**data) for _, data in valid]
+    emails = [customer.email for customer in customers]
+    with transaction.atomic():
+        if update_existing:
+            Customer.objects.bulk_create(
+                customers,
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=['email'],
+                update_fields=['name', 'phone'],
+            )
+            created = sum(1 for email in emails if email not in stored)
+        elif supports_update_returning(connections[Customer.objects.db]):
+            # Rows inserted concurrently since the check are skipped
+            # instead of failing the whole batch, and not counted
+            created = len(insert_new_customers(customers, batch_size))
+        else:
+            # Re-check right before the insert to narrow the window
+            # for a concurrent insert being counted as ours
+            taken = existing_emails(emails, batch_size)
+            Customer.objects.bulk_create(
+                customers, batch_size=batch_size, ignore_conflicts=True)
+            created = sum(1 for email in emails if email not in taken)
+
+        # Primary keys are not returned when conflicts are handled
+        by_email = {}
+        for chunk in chunked(emails, batch_size):
+            by_email.update(
+                (customer.email, customer)
+                for customer in Customer.objects.filter(email__in=chunk))
+        customers = [by_email[email] for email in emails if email in by_email]
+
+        CRMStats.objects.increment(customers=created)
+        search.index_objects(
+            search.CUSTOMER, [customer.pk for customer in customers])
+        updated_ids = [c.pk for c in customers if c.email in stored]
+        if updated_ids:
+            # Order documents embed the customer's name
+            search.index_objects(
+                search.ORDER,
+                Order.objects.filter(customer_id__in=updated_ids)
+                .values_list('pk', flat=True))
+        response_cache.invalidate_models(Customer)
+    return BulkResult(customers, created, errors)
+
+
+def upsert_products(rows, batch_size=None):
+    """
+    Validate product rows with ProductSerializer and insert them,
+    updating the price and stock of stored products with the same
+    name. Returns a BulkResult whose objects follow the input order.
+    """
+    batch_size = batch_size or default_batch_size()
+    valid = []
+    errors = []
+    first_row = {}
+    for index, row in enumerate(rows):
+        serializer = ProductSerializer(data=row)
+        if not serializer.is_valid():
+            errors.extend(
+                RowError(index, name, [str(m) for m in messages])
+                for name, messages in serializer.errors.items())
+            continue
+        data = serializer.validated_data
+        if data['name'] in first_row:
+            errors.append(RowError(index, 'name', [
+                DUPLICATE_IN_BATCH.format(first_row[data['name']])]))
+            continue
+        first_row[data['name']] = index
+        valid.append(data)
+    if not valid:
+        return BulkResult([], 0, errors)
+
+    stored = {}
+    for chunk in chunked(first_row, batch_size):
+        # Lowest id wins when a name is stored more than once
+        for product in Product.objects.filter(
+                name__in=chunk).order_by('-pk'):
+            stored[product.name] = product
+
+    products = []
+    to_create = []
+    to_update = []
+    repriced = []
+    for data in valid:
+        product = stored.get(data['name'])
+        if product is None:
+            product = Product(**data)
+            to_create.append(product)
+        else:
+            if data['price'] != product.price:
+                repriced.append(product.pk)
+            for name, value in data.items():
+                setattr(product, name, value)
+            to_update.append(product)
+        products.append(product)
+
+    with transaction.atomic():
+        Product.objects.bulk_create(to_create, batch_size=batch_size)
+        Product.objects.bulk_update(
+            to_update, ['price', 'stock'], batch_size=batch_size)
+        search.index_objects(search.PRODUCT, [p.pk for p in to_create])
+        pubsub.stock_changed((p.pk, p.stock) for p in products)
+        if repriced:
+            recompute_order_totals(
+                Order.products.through.objects
+                .filter(product_id__in=repriced)
+                .values_list('order_id', flat=True).distinct())
+        response_cache.invalidate_models(Product)
+    return BulkResult(products, len(to_create), errors)
+
+
+def insert_orders(entries, batch_size=None):
+    """
+    Insert [(unsaved Order, product ids)] with one bulk_create for the
+    orders and one for their product links, then store their totals
+    """
+    batch_size = batch_size or default_batch_size()
+    if not entries:
+        return []
+    with transaction.atomic():
+        orders = Order.objects.bulk_create(
+            [order for order, _ in entries], batch_size=batch_size)
+        Through = Order.products.through
+        Through.objects.bulk_create(
+            [
+                Through(order_id=order.pk, product_id=product_id)
+                for order, (_, product_ids) in zip(orders, entries)
+                for product_id in dict.fromkeys(product_ids)
+            ],
+            batch_size=batch_size,
+        )
+
+        ids = [order.pk for order in orders]
+        created = Order.objects.filter(pk__in=ids)
+        created.update_total_amounts()
+        totals = dict(created.values_list('pk', 'total_amount'))
+        for order in orders:
+            order.total_amount = totals[order.pk]
+
+        CRMStats.objects.increment(
+            orders=len(orders), revenue=sum(totals.values()))
+        mark_days_dirty({order.order_date for order in orders})
+        search.index_objects(search.ORDER, ids)
+        pubsub.orders_created(ids)
+    return orders
+
+
+def _clean_pk(value):
+    """
+    Return (pk, messages) the way a PrimaryKeyRelatedField would
+    """
+    if isinstance(value, bool):
+        return None, [INCORRECT_PK.format(type(value).__name__)]
+    try:
+        return int(value), []
+    except (TypeError, ValueError):
+        return None, [INCORRECT_PK.format(type(value).__name__)]
+
+
+def _existing_pks(model, pks, batch_size):
+    found = set()
+    for chunk in chunked(pks, batch_size):
+        found.update(
+            model.objects.filter(pk__in=chunk).values_list('pk', flat=True))
+    return found
+
+
+def validate_order_rows(rows, batch_size=None):
+    """
+    Validate order rows with OrderSerializers' rules, resolving every
+    referenced customer and product with one IN query per model.
+
+    Return ([(index, customer id, [product ids], order date)], errors)
+    """
+    batch_size = batch_size or default_batch_size()
+    parsed = []
+    errors = []
+    for index, row in enumerate(rows):
+        row_errors = {}
+        customer_id, messages = _clean_pk(row.get('customer_id'))
+        if messages:
+            row_errors['customer'] = messages
+
+        product_ids = []
+        for value in row.get('product_ids') or []:
+            pk, messages = _clean_pk(value)
+            if messages:
+                row_errors['products'] = messages
+                break
+            product_ids.append(pk)
+        if not product_ids and 'products' not in row_errors:
+            row_errors['products'] = [EMPTY_LIST]
+
+        order_date = row.get('order_date')
+        if order_date is None:
+            row_errors['order_date'] = [NULL]
+
+        if row_errors:
+            errors.extend(
+                RowError(index, name, messages)
+                for name, messages in row_errors.items())
+            continue
+        parsed.append((
+            index, customer_id, list(dict.fromkeys(product_ids)), order_date))
+
+    customers = _existing_pks(
+        Customer, {customer_id for _, customer_id, _, _ in parsed},
+        batch_size)
+    products = _existing_pks(
+        Product, {pk for _, _, product_ids, _ in parsed for pk in product_ids},
+        batch_size)
+
+    valid = []
+    for index, customer_id, product_ids, order_date in parsed:
+        row_errors = []
+        if customer_id not in customers:
+            row_errors.append(
+                RowError(index, 'customer', [MISSING_PK.format(customer_id)]))
+        missing = [pk for pk in product_ids if pk not in products]
+        if missing:
+            row_errors.append(RowError(
+                index, 'products', [MISSING_PK.format(missing[0])]))
+        if row_errors:
+            errors.extend(row_errors)
+            continue
+        valid.append((index, customer_id, product_ids, order_date))
+    errors.sort(key=lambda error: error.index)
+    return valid, errors
+
+
+def bulk_create_orders(rows, batch_size=None):
+    """
+    Validate and insert order rows, taking one unit of stock of every
+    product of every order. When the stock of a product cannot cover
+    the whole batch, what is left goes to the rows in input order and
+    only the rows it cannot cover are rejected; the stock of the
+    accepted rows is reserved with one conditional UPDATE, so stock
+    never goes negative even under concurrent writers.
+    """
+    batch_size = batch_size or default_batch_size()
+    valid, errors = validate_order_rows(rows, batch_size)
+
+    with transaction.atomic():
+        while valid:
+            quantities = {}
+            for _, _, product_ids, _ in valid:
+                for pk in product_ids:
+                    quantities[pk] = quantities.get(pk, 0) + 1
+            try:
+                Product.objects.reserve_stock(quantities)
+                break
+            except InsufficientStock as e:
+                short = set(e.product_ids) or set(quantities)
+            # Locked so the retry reserves exactly what is handed out
+            available = dict(
+                Product.objects.select_for_update()
+                .filter(pk__in=short).values_list('pk', 'stock'))
+            accepted = []
+            for row in valid:
+                index, _, product_ids, _ = row
+                missing = [
+                    pk for pk in product_ids
+                    if pk in short and not available.get(pk)]
+                if missing:
+                    errors.append(RowError(index, 'products', [
+                        OUT_OF_STOCK.format(pk) for pk in missing]))
+                    continue
+                for pk in product_ids:
+                    if pk in short:
+                        available[pk] -= 1
+                accepted.append(row)
+            valid = accepted
+
+        orders = insert_orders(
+            [
+                (
+                    Order(customer_id=customer_id, order_date=order_date),
+                    product_ids,
+                )
+                for _, customer_id, product_ids, order_date in valid
+            ],
+            batch_size,
+        )
+    errors.sort(key=lambda error: error.index)
+    return BulkResult(orders, len(orders), errors)
+
+
+def delete_customers(customers):
+    """
+    Delete the customers of a queryset with their orders, through the
+    collector so that every delete receiver of crm.signals runs.
+    Returns (customers deleted, orders deleted).
+
+    The queryset is evaluated with SELECT ... FOR UPDATE inside the
+    transaction, so a filter on activity is re-checked against rows
+    no concurrent order can attach to before the delete.
+    """
+    with transaction.atomic():
+        ids = list(
+            customers.select_for_update().values_list('pk', flat=True))
+        if not ids:
+            return 0, 0
+        _, deleted = Customer.objects.filter(pk__in=ids).delete()
+    return (
+        deleted.get(Customer._meta.label, 0),
+        deleted.get(Order._meta.label, 0),
+    )
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+from . import response_cache
+
+
+@register()
+def check_response_cache(app_configs, **kwargs):
+    if not (response_cache.is_enabled()
+            and response_cache.is_process_local()):
+        return []
+    alias = getattr(settings, 'GRAPHQL_RESPONSE_CACHE', 'default')
+    return [Warning(
+        'The GraphQL response cache is enabled on a process local cache.',
+        hint=(
+            f"Writes made by other workers or by Celery never invalidate "
+            f"the responses cached in '{alias}'; point it at a shared "
+            f"cache (GRAPHQL_CACHE_URL) or disable "
+            f"GRAPHQL_RESPONSE_CACHE_ENABLED."),
+        id='crm.W001',
+    )]
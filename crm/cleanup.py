@@ -0,0 +1,79 @@
+"""
+Chunked removal of inactive customers.
+
+A customer is inactive when it has no order on or after the cutoff.
+That is tested with a correlated NOT EXISTS served by the
+(customer, order_date) index, one bounded id range at a time, and
+each range is deleted in its own short transaction through
+crm.bulk.delete_customers so crm_order is never locked for long.
+"""
+import time
+from dataclasses import asdict, dataclass
+from datetime import date, timedelta
+from django.db.models import Exists, OuterRef
+from .bulk import delete_customers
+from .models import Customer, Order
+
+
+@dataclass
+class CleanupResult:
+    cutoff: date
+    dry_run: bool
+    scanned_up_to: int = 0
+    customers: int = 0
+    orders: int = 0
+    chunks: int = 0
+    seconds: float = 0.0
+
+
+def inactive_customers(cutoff):
+    recent_orders = Order.objects.filter(
+        customer_id=OuterRef('pk'), order_date__gte=cutoff)
+    return Customer.objects.filter(~Exists(recent_orders))
+
+
+def clean_inactive_customers(
+    days=365, batch_size=500, sleep=0.0, dry_run=False, today=None,
+    on_chunk=None,
+):
+    """
+    Delete (or, with dry_run, count) the customers without an order
+    in the last days, batch_size customer ids at a time, pausing
+    sleep seconds between chunks. on_chunk is called with the
+    CleanupResult after every chunk. Returns the result as a dict.
+    """
+    cutoff = (today or date.today()) - timedelta(days=days)
+    inactive = inactive_customers(cutoff)
+    result = CleanupResult(cutoff=cutoff, dry_run=dry_run)
+    started = time.monotonic()
+
+    last_id = 0
+    while True:
+        ids = list(
+            inactive.filter(pk__gt=last_id)
+            .order_by('pk')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        chunk = inactive.filter(pk__gte=ids[0], pk__lte=ids[-1])
+        if dry_run:
+            result.customers += len(ids)
+            result.orders += Order.objects.filter(
+                customer_id__in=ids).count()
+        else:
+            customers, orders = delete_customers(chunk)
+            result.customers += customers
+            result.orders += orders
+
+        last_id = ids[-1]
+        result.scanned_up_to = last_id
+        result.chunks += 1
+        result.seconds = time.monotonic() - started
+        if on_chunk is not None:
+            on_chunk(result)
+        if sleep:
+            time.sleep(sleep)
+
+    result.seconds = time.monotonic() - started
+    return asdict(result)
@@ -0,0 +1,272 @@
+"""
+Static cost and depth analysis of GraphQL operations.
+
+Every list or connection field costs its weight (1 unless its type's
+``cost_weights`` says otherwise) times the number of parent objects it
+is resolved for, and multiplies the cost of its selections by the
+number of items it can return: its ``first``/``last`` argument, the
+relay page size limit for an unbounded connection, or
+GRAPHQL_COST_LIST_SIZE for an unbounded list. Other fields are free
+unless they declare a weight.
+
+QueryCostRule rejects documents over GRAPHQL_MAX_QUERY_COST or
+GRAPHQL_MAX_QUERY_DEPTH while validating, counting limits passed as
+variables as 1 since the validated document is cached for every set of
+variables. The view measures the operation again with its variables
+before executing it, rejects it or charges it to the client's budget
+per minute, and reports the cost in ``extensions.cost``.
+"""
+import time
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.cache import caches
+from graphene.utils.str_converters import to_snake_case
+from graphene_django.settings import graphene_settings
+from graphql import (
+    FieldNode, FragmentSpreadNode, GraphQLError, InlineFragmentNode,
+    IntValueNode, OperationDefinitionNode, VariableNode,
+    get_named_type, get_nullable_type, is_list_type, is_object_type,
+    is_interface_type)
+from graphql.validation import ValidationRule
+
+
+TOO_COMPLEX = 'QUERY_TOO_COMPLEX'
+THROTTLED = 'QUERY_COST_THROTTLED'
+BUDGET_PREFIX = 'crm:cost:'
+
+
+@dataclass
+class QueryCost:
+    cost: int = 0
+    depth: int = 0
+
+
+def max_cost():
+    return getattr(settings, 'GRAPHQL_MAX_QUERY_COST', None)
+
+
+def max_depth():
+    return getattr(settings, 'GRAPHQL_MAX_QUERY_DEPTH', None)
+
+
+def _field_weight(parent_type, field_name):
+    graphene_type = getattr(parent_type, 'graphene_type', None)
+    weights = getattr(graphene_type, 'cost_weights', None) or {}
+    return weights.get(to_snake_case(field_name))
+
+
+def _is_connection(graphql_type):
+    fields = getattr(graphql_type, 'fields', {})
+    return 'edges' in fields and 'pageInfo' in fields
+
+
+def _limit(node, variables):
+    """
+    Return the first/last argument of a field node, 1 for a
+    variable without a value, or None when there is none
+    """
+    for argument in node.arguments:
+        if argument.name.value not in ('first', 'last'):
+            continue
+        value = argument.value
+        if isinstance(value, IntValueNode):
+            return int(value.value)
+        if isinstance(value, VariableNode):
+            if variables is None:
+                return 1
+            limit = variables.get(value.name.value)
+            if isinstance(limit, int):
+                return limit
+    return None
+
+
+class _CostCalculator:
+    def __init__(self, schema, get_fragment, variables=None):
+        self.schema = schema
+        self.get_fragment = get_fragment
+        self.variables = variables
+        self.page_size = graphene_settings.RELAY_CONNECTION_MAX_LIMIT or 100
+        self.list_size = getattr(settings, 'GRAPHQL_COST_LIST_SIZE', 10)
+
+    def measure(self, operation):
+        root_type = self.schema.get_root_type(operation.operation)
+        if root_type is None:
+            return QueryCost()
+        return self.selection_set(
+            root_type, operation.selection_set, 1, None, 1, set())
+
+    def selection_set(
+        self, parent_type, selection_set, multiplier, edges_multiplier,
+        depth, visited,
+    ):
+        total = QueryCost(depth=depth - 1)
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                result = self.field(
+                    parent_type, selection, multiplier, edges_multiplier,
+                    depth, visited)
+            elif isinstance(selection, InlineFragmentNode):
+                fragment_type = parent_type
+                if selection.type_condition is not None:
+                    fragment_type = self.schema.get_type(
+                        selection.type_condition.name.value) or parent_type
+                result = self.selection_set(
+                    fragment_type, selection.selection_set, multiplier,
+                    edges_multiplier, depth, visited)
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                fragment = self.get_fragment(name)
+                if fragment is None or name in visited:
+                    continue
+                fragment_type = self.schema.get_type(
+                    fragment.type_condition.name.value) or parent_type
+                result = self.selection_set(
+                    fragment_type, fragment.selection_set, multiplier,
+                    edges_multiplier, depth, visited | {name})
+            else:
+                continue
+            total.cost += result.cost
+            total.depth = max(total.depth, result.depth)
+        return total
+
+    def field(
+        self, parent_type, node, multiplier, edges_multiplier, depth,
+        visited,
+    ):
+        name = node.name.value
+        if name.startswith('__') or not (
+                is_object_type(parent_type)
+                or is_interface_type(parent_type)):
+            return QueryCost(depth=depth)
+        field_def = parent_type.fields.get(name)
+        if field_def is None:
+            return QueryCost(depth=depth)
+
+        return_type = get_nullable_type(field_def.type)
+        named_type = get_named_type(return_type)
+        # The edges of a connection are paid for by the connection
+        is_edges = name == 'edges' and edges_multiplier is not None
+        is_list = is_list_type(return_type) and not is_edges
+        is_connection = _is_connection(named_type)
+        weight = _field_weight(parent_type, name)
+        if weight is None:
+            weight = 1 if is_list or is_connection else 0
+        cost = weight * multiplier
+
+        if node.selection_set is None:
+            return QueryCost(cost=cost, depth=depth)
+
+        limit = _limit(node, self.variables)
+        child_multiplier = multiplier
+        child_edges = None
+        if is_connection:
+            # The connection is resolved once; its edges repeat
+            child_edges = multiplier * (limit or self.page_size)
+        elif is_edges:
+            child_multiplier = edges_multiplier
+        elif is_list:
+            child_multiplier = multiplier * (limit or self.list_size)
+
+        result = self.selection_set(
+            named_type, node.selection_set, child_multiplier, child_edges,
+            depth + 1, visited)
+        result.cost += cost
+        return result
+
+
+def measure(schema, document, operation_ast, variables=None):
+    """
+    Return the QueryCost of an operation with its variables
+    """
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if not isinstance(definition, OperationDefinitionNode)
+    }
+    calculator = _CostCalculator(schema, fragments.get, variables or {})
+    return calculator.measure(operation_ast)
+
+
+def too_complex_error(query_cost, node=None):
+    """
+    Return the error of an operation over the cost or depth limits,
+    or None
+    """
+    limit = max_cost()
+    if limit is not None and query_cost.cost > limit:
+        message = (
+            f'Query cost {query_cost.cost} exceeds the maximum '
+            f'of {limit}.')
+    elif max_depth() is not None and query_cost.depth > max_depth():
+        message = (
+            f'Query depth {query_cost.depth} exceeds the maximum '
+            f'of {max_depth()}.')
+    else:
+        return None
+    return GraphQLError(message, node, extensions={
+        'code': TOO_COMPLEX,
+        'cost': query_cost.cost,
+        'maxCost': limit,
+        'depth': query_cost.depth,
+        'maxDepth': max_depth(),
+    })
+
+
+class QueryCostRule(ValidationRule):
+    """
+    Reject operations whose static cost or depth is over the limits
+    """
+    def enter_operation_definition(self, node, *args):
+        calculator = _CostCalculator(
+            self.context.schema, self.context.get_fragment)
+        error = too_complex_error(calculator.measure(node), node)
+        if error is not None:
+            self.report_error(error)
+        return self.SKIP
+
+
+def _client_key(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def charge(request, query_cost):
+    """
+    Add the cost to the client's spending of the current minute and
+    return a throttling error when it goes over
+    GRAPHQL_COST_BUDGET_PER_MINUTE, or None
+    """
+    budget = getattr(settings, 'GRAPHQL_COST_BUDGET_PER_MINUTE', None)
+    if budget is None or not query_cost.cost:
+        return None
+    cache = caches[getattr(settings, 'GRAPHQL_COST_BUDGET_CACHE', 'default')]
+    now = time.time()
+    key = f'{BUDGET_PREFIX}{_client_key(request)}:{int(now // 60)}'
+    cache.add(key, 0, timeout=60)
+    try:
+        spent = cache.incr(key, query_cost.cost)
+    except ValueError:
+        # Expired between add and incr
+        spent = query_cost.cost
+        cache.set(key, spent, timeout=60)
+    if spent <= budget:
+        return None
+    return GraphQLError(
+        'Query cost budget exceeded, retry later.',
+        extensions={
+            'code': THROTTLED,
+            'cost': query_cost.cost,
+            'budget': budget,
+            'retryAfter': 60 - int(now % 60),
+        })
+
+
+def as_extension(query_cost):
+    return {
+        'requestedQueryCost': query_cost.cost,
+        'maximumAvailable': max_cost(),
+        'depth': query_cost.depth,
+        'maximumDepth': max_depth(),
+    }
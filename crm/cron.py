@@ -1,10 +1,6 @@
 from datetime import datetime
-from gql import Client, gql
-from gql.transport.requests import RequestsHTTPTransport
-from cron_jobs.send_order_reminders import get_formatted_current_datetime
-
-
-GRAPHQL_URL = "http://localhost:8000/graphql"
+from crm.cron_jobs.send_order_reminders import get_formatted_current_datetime
+from crm.executor import execute_graphql
 
 
 def log_crm_heartbeat():
@@ -12,23 +8,17 @@ def log_crm_heartbeat():
     This function defines a cron for the django-crontab
     It monitors the crm app and logs its status
     """
-    # Establish connection to graphql endpoint
-    transport = RequestsHTTPTransport(url=GRAPHQL_URL)
-    client = Client(transport=transport)
-
     path_to_log_file = "/tmp/crm_heartbeat_log.txt"
 
     # Define and execute query
-    query = gql(
-        """
+    query = """
         {
             hello
         }
         """
-    )
 
     try:
-        result = client.execute(query)
+        result = execute_graphql(query)
     except Exception as e:
         with open(path_to_log_file, "a", encoding="utf-8") as f:
             current_time = get_formatted_current_datetime()
@@ -46,31 +36,23 @@ def log_crm_heartbeat():
 def update_low_stock():
     """
     This function executes an `UpdateLowStockProducts`
-    mutation and logs the new stock levels with a timestanp.
+    mutation and logs a summary of the restock with a timestamp.
     """
-    # Establish connection to graphql endpoint
-    transport = RequestsHTTPTransport(url=GRAPHQL_URL)
-    client = Client(transport=transport)
-
     path_to_log_file = "/tmp/low_stock_updates_log.txt"
 
     # Define and execute query
-    query = gql(
-        """
+    query = """
         mutation {
           updateLowStockProducts {
-            products {
-              name
-              stock
-            }
+            count
+            productIds
           }
         }
         """
-    )
 
     try:
         # Execute query
-        response = client.execute(query)
+        response = execute_graphql(query)
     except Exception as e:
         # Log errors and terminate function
         with open(path_to_log_file, "a", encoding="utf-8") as f:
@@ -80,18 +62,17 @@ def update_low_stock():
             print(message)
         return
 
-    # extract products from response
-    products = response.get('updateLowStockProducts').get('products')
+    # extract the restock summary from response
+    result = response.get('updateLowStockProducts')
+    count = result.get('count')
+    product_ids = result.get('productIds')
 
     with open(path_to_log_file, "a", encoding="utf-8") as f:
-        for p in products:
-            current_time = get_formatted_current_datetime()
-            p_name = p.get("name")
-            p_stock = p.get("stock")
-
-            # Log products and stock
-            f.write(
-                f"{current_time} - product_name={p_name} product_stock={p_stock}\n")
+        current_time = get_formatted_current_datetime()
+        sample = ",".join(product_ids[:20])
+        if len(product_ids) > 20:
+            sample += ",..."
+        f.write(
+            f"{current_time} - restocked {count} products ids={sample}\n")
 
     print('Low product stock updated!')
-
@@ -1,20 +1,13 @@
 #!/bin/bash
 #
-# This script cleans inactive customers
+# This script cleans inactive customers. Celery beat schedules the
+# cleanup (crm.tasks.clean_inactive_customers, Sunday 02:00); run this
+# by hand only for a one-off cleanup.
 
-command="
-from crm.models import Customer
-from datetime import datetime, timedelta
+cd "$(dirname "$0")/../.." || exit 1
 
-cutoff = datetime.now().date() - timedelta(days=365)
-qs = Customer.objects.exclude(orders__order_date__gte=cutoff)
-delete_count, _ = qs.delete()
-print(delete_count)
-"
-
-# Execute delete query and store number of deleted customers
-count=$(/home/scott/alx/alx_pdbe/graphql/bin/python3 manage.py shell -c "$command")
-
-# Log number of customers deleted with timestamp
-echo \"$(date +"%Y%m%d_%H%M%S"): $count Customers Deleted\" >>  /tmp/customer_cleanup_log.txt
+# Delete in short id-range transactions and keep the summary line
+summary=$(/home/scott/alx/alx_pdbe/graphql/bin/python3 manage.py clean_inactive_customers | tail -n 1)
 
+# Log the summary with timestamp
+echo "$(date +"%Y%m%d_%H%M%S"): $summary" >> /tmp/customer_cleanup_log.txt
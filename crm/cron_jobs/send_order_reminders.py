@@ -1,17 +1,63 @@
 """
 Send Order Reminders
 
-This script fetches all orders that were
-created in the past 7 days and, logs reminders
-for each of those orders.
+This script pages through the orders created in the
+past 7 days, ordered by customer, and logs one reminder
+per customer email. Pages are written to the log in one
+batch each, after which a checkpoint records the page
+cursor so that a rerun of the same window resumes where
+the previous run stopped instead of re-sending.
+
+Celery beat runs it daily at 08:00 through the
+crm.tasks.send_order_reminders task; run the script by
+hand only to catch up on a missed run.
 """
-from gql import Client, gql
-from gql.transport.requests import RequestsHTTPTransport
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from pathlib import Path
 import base64
+import json
+import os
+import sys
+
+if __package__ in (None, ""):
+    # Run as a script by cron: make the project importable
+    # and set Django up before importing the crm modules
+    import django
+
+    sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+    os.environ.setdefault(
+        "DJANGO_SETTINGS_MODULE", "alx_backend_graphql.settings")
+    django.setup()
+
+from crm.executor import execute_graphql  # noqa: E402
 
 
 PATH_TO_LOG_FILE = "/tmp/order_reminders_log.txt"
+PATH_TO_CHECKPOINT_FILE = "/tmp/order_reminders_checkpoint.json"
+WINDOW_DAYS = 7
+PAGE_SIZE = 200
+
+ORDERS_QUERY = """
+query ($date: Date!, $first: Int!, $after: String) {
+  allOrders(
+    orderDate_Gte: $date, orderBy: "customer", keyset: true,
+    first: $first, after: $after
+  ) {
+    edges {
+      node {
+        id
+        customer {
+          email
+        }
+      }
+    }
+    pageInfo {
+      hasNextPage
+      endCursor
+    }
+  }
+}
+"""
 
 
 def decode_relay_id(encoded_id):
@@ -22,49 +68,40 @@ def decode_relay_id(encoded_id):
     return decoded.split(":")[1]
 
 
-def fetch_orders():
+def fetch_order_pages(since, after=None, page_size=PAGE_SIZE):
     """
-    This function fetches orders which were created
-    in the past 7 days
+    This function yields (edges, end cursor) for each page
+    of the orders created since the given date, starting
+    after the given cursor
     """
-    grapql_url = "http://localhost:8000/graphql"
-    order_date_range = (
-        datetime.now() -
-        timedelta(
-            days=7)).strftime('%Y-%m-%d')
-
-    # Create connection to url
-    transport = RequestsHTTPTransport(url=grapql_url)
-    client = Client(transport=transport)
-
-    # Define query and pass order date range as variable
-    query = gql(
-        """
-        query ($date: Date!){
-        allOrders(orderDate_Gte: $date) {
-        edges {
-            node {
-            id
-            customer {
-                email
-            }
-            }
-        }
-        }
-    }
-        """
-    )
-    variable = {"date": order_date_range}
-
-    try:
-        # Execute query
-        response = client.execute(query, variable_values=variable)
-    except Exception as e:
-        with open(PATH_TO_LOG_FILE, 'a', encoding="utf-8") as f:
-            f.write(f"GraphQL query failed: {e}")
-        orders = {}
-    orders = response.get("allOrders", {}).get("edges", [])
-    return orders
+    while True:
+        response = execute_graphql(ORDERS_QUERY, variables={
+            "date": since.isoformat(),
+            "first": page_size,
+            "after": after,
+        })
+        connection = response["allOrders"]
+        page_info = connection["pageInfo"]
+        if connection["edges"]:
+            after = page_info["endCursor"]
+        yield connection["edges"], after
+        if not page_info["hasNextPage"]:
+            return
+
+
+def iter_reminders(edges, last_email=None):
+    """
+    This function yields (order id, email) for the first
+    order of each customer; orders arrive grouped by
+    customer so only the previous email is remembered
+    """
+    for edge in edges:
+        node = edge["node"]
+        email = node["customer"]["email"]
+        if email == last_email:
+            continue
+        last_email = email
+        yield decode_relay_id(node["id"]), email
 
 
 def get_formatted_current_datetime():
@@ -74,28 +111,77 @@ def get_formatted_current_datetime():
     return datetime.now().strftime("%d/%m/%y-%H:%M:%S")
 
 
-def log_pending_orders(orders):
+def load_checkpoint(path, since):
     """
-    This script logs the the email and id of each order
-    into the reminders log file
+    This function returns the checkpoint of the run for
+    the given window, or a fresh one
     """
+    try:
+        with open(path, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, ValueError):
+        checkpoint = {}
+    if checkpoint.get("since") != since.isoformat():
+        checkpoint = {"since": since.isoformat()}
+    return checkpoint
 
-    if orders:
-        with open(PATH_TO_LOG_FILE, 'a', encoding="utf-8") as f:
-            for edge in orders:
-                node = edge.get("node")
-                order_id = decode_relay_id(node.get("id"))
-                email = node.get("customer").get("email")
-                if order_id:
-                    current_time = get_formatted_current_datetime()
-                    f.write(f"{current_time} - id={order_id} email={email}\n")
 
-    print("Order reminders processed!")
+def save_checkpoint(path, checkpoint):
+    """
+    This function atomically replaces the checkpoint file
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def send_order_reminders(
+    today=None,
+    log_path=PATH_TO_LOG_FILE,
+    checkpoint_path=PATH_TO_CHECKPOINT_FILE,
+    page_size=PAGE_SIZE,
+):
+    """
+    This function logs the reminders of the current window,
+    resuming from its checkpoint, and returns the number of
+    reminders written by this run
+    """
+    since = (today or date.today()) - timedelta(days=WINDOW_DAYS)
+    checkpoint = load_checkpoint(checkpoint_path, since)
+    if checkpoint.get("done"):
+        return 0
+
+    sent = 0
+    last_email = checkpoint.get("last_email")
+    pages = fetch_order_pages(since, checkpoint.get("after"), page_size)
+    with open(log_path, "a", encoding="utf-8") as f:
+        try:
+            for edges, cursor in pages:
+                current_time = get_formatted_current_datetime()
+                lines = []
+                for order_id, email in iter_reminders(edges, last_email):
+                    lines.append(
+                        f"{current_time} - id={order_id} email={email}\n")
+                    last_email = email
+                # One write per page, flushed before the checkpoint
+                # moves past it
+                f.write("".join(lines))
+                f.flush()
+                sent += len(lines)
+                checkpoint.update(after=cursor, last_email=last_email)
+                save_checkpoint(checkpoint_path, checkpoint)
+        except Exception as e:
+            f.write(
+                f"{get_formatted_current_datetime()} - "
+                f"GraphQL query failed: {e}\n")
+            raise
+
+    checkpoint["done"] = True
+    save_checkpoint(checkpoint_path, checkpoint)
+    return sent
 
 
 if __name__ == "__main__":
-    # Fetch orders
-    orders = fetch_orders()
-
-    # Log fetched orders
-    log_pending_orders(orders=orders)
+    count = send_order_reminders()
+    print(f"Order reminders processed! ({count} sent)")
@@ -0,0 +1,123 @@
+"""
+Parsed-document cache and Automatic Persisted Queries (APQ) storage.
+
+Cron jobs and clients send the same few documents over and over, so
+the parsed and validated AST is kept in a per-process LRU keyed by the
+sha256 of the query text. APQ lets a client send only that sha256 once
+the server has seen the full text; the text is stored in Django's cache
+so every worker can resolve it.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from graphql import parse, validate
+from graphql.error import GraphQLError
+
+
+PERSISTED_QUERY_PREFIX = 'crm:apq:'
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+class DocumentCache:
+    """
+    Thread safe LRU of (document, validation errors) by query hash
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_validated(self, schema, query, rules=None, max_errors=None):
+        """
+        Return (document, validation errors) for query, parsing and
+        validating it only on a cache miss. Raises GraphQLError when
+        the query does not parse.
+        """
+        # Documents validated with other rules are cached apart
+        key = (id(schema), query_hash(query), tuple(rules or ()))
+        entry = self.get(key)
+        if entry is None:
+            document = parse(query)
+            errors = validate(schema, document, rules, max_errors)
+            entry = (document, errors)
+            self.set(key, entry)
+        return entry
+
+
+document_cache = DocumentCache(
+    getattr(settings, 'GRAPHQL_DOCUMENT_CACHE_SIZE', 256))
+
+
+class PersistedQueryNotFound(GraphQLError):
+    def __init__(self):
+        super().__init__(
+            'PersistedQueryNotFound',
+            extensions={'code': 'PERSISTED_QUERY_NOT_FOUND'},
+        )
+
+
+class PersistedQueryMismatch(GraphQLError):
+    def __init__(self):
+        super().__init__(
+            'provided sha does not match query',
+            extensions={'code': 'PERSISTED_QUERY_HASH_MISMATCH'},
+        )
+
+
+def get_persisted_query_cache():
+    alias = getattr(settings, 'GRAPHQL_PERSISTED_QUERY_CACHE', 'default')
+    return caches[alias]
+
+
+def resolve_persisted_query(query, persisted_query):
+    """
+    Return the query text for an APQ request, storing it when the
+    client sent both the text and its hash
+    """
+    sha256 = persisted_query.get('sha256Hash')
+    if persisted_query.get('version') != 1 or not sha256:
+        raise GraphQLError('Unsupported persisted query version')
+
+    cache = get_persisted_query_cache()
+    if query:
+        if query_hash(query) != sha256:
+            raise PersistedQueryMismatch()
+        cache.set(PERSISTED_QUERY_PREFIX + sha256, query, timeout=None)
+        return query
+
+    query = cache.get(PERSISTED_QUERY_PREFIX + sha256)
+    if query is None:
+        raise PersistedQueryNotFound()
+    return query
@@ -0,0 +1,128 @@
+"""
+Streaming export of orders as CSV or NDJSON.
+
+Orders are read through a server-side cursor in chunks of
+CRM_EXPORT_CHUNK_SIZE rows, with their customer joined in the same
+query. The product names of a chunk come from one query on the order
+products table and totals are the stored ``total_amount`` column, kept
+up to date in SQL by OrderQuerySet.update_total_amounts, so an export
+runs one query per chunk besides the orders cursor. Each chunk is
+serialized and, optionally, gzipped before the next one is read;
+memory stays flat however many orders match.
+"""
+import csv
+import io
+import zlib
+from collections import defaultdict
+from itertools import islice
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from .models import Order
+
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+CONTENT_TYPES = {
+    CSV: 'text/csv; charset=utf-8',
+    NDJSON: 'application/x-ndjson',
+}
+FIELDS = (
+    'id', 'order_date', 'customer_id', 'customer_name', 'customer_email',
+    'product_count', 'products', 'total_amount',
+)
+PRODUCT_SEPARATOR = '|'
+
+
+def default_chunk_size():
+    return getattr(settings, 'CRM_EXPORT_CHUNK_SIZE', 2000)
+
+
+def iter_order_chunks(orders, chunk_size=None):
+    """
+    Yield lists of export rows, one tuple of FIELDS per order of the
+    queryset, chunk_size orders at a time
+    """
+    chunk_size = chunk_size or default_chunk_size()
+    rows = orders.values_list(
+        'pk', 'order_date', 'customer_id', 'customer__name',
+        'customer__email', 'total_amount',
+    ).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        products = defaultdict(list)
+        for order_id, name in (
+                Order.products.through.objects
+                .filter(order_id__in=[row[0] for row in chunk])
+                .order_by('order_id', 'product_id')
+                .values_list('order_id', 'product__name')):
+            products[order_id].append(name)
+        yield [
+            (*row[:5], len(products[row[0]]), products[row[0]], row[5])
+            for row in chunk
+        ]
+
+
+def csv_lines(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for chunk in chunks:
+        for row in chunk:
+            writer.writerow(
+                (*row[:6], PRODUCT_SEPARATOR.join(row[6]), row[7]))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # No orders, only the header
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def ndjson_lines(chunks):
+    encoder = DjangoJSONEncoder()
+    for chunk in chunks:
+        yield ''.join(
+            encoder.encode(dict(zip(FIELDS, row))) + '\n' for row in chunk)
+
+
+SERIALIZERS = {CSV: csv_lines, NDJSON: ndjson_lines}
+
+
+def gzip_stream(chunks, level=6):
+    """
+    Gzip a stream of text chunks incrementally
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_orders(orders, format=CSV, compress=False, chunk_size=None):
+    """
+    Return an iterator over the serialized orders of a queryset,
+    gzipped when compress is set
+    """
+    stream = SERIALIZERS[format](iter_order_chunks(orders, chunk_size))
+    if compress:
+        return gzip_stream(stream)
+    return (chunk.encode() for chunk in stream)
+
+
+async def aiter_stream(stream):
+    """
+    Pull a sync stream from the event loop one block at a time,
+    so ASGI responses are not buffered whole
+    """
+    stream = iter(stream)
+    pull = sync_to_async(next, thread_sensitive=True)
+    while True:
+        block = await pull(stream, None)
+        if block is None:
+            return
+        yield block
@@ -0,0 +1,120 @@
+from asgiref.sync import sync_to_async
+from graphene_django.filter import DjangoFilterConnectionField
+from graphql import GraphQLError
+from . import aio
+from .loaders import get_loaders
+
+
+CONNECTION_ARGS = {'first', 'last', 'before', 'after', 'offset', 'keyset'}
+
+
+def has_filter_args(args):
+    """
+    Return True if any filtering/ordering argument was supplied
+    """
+    return any(
+        value is not None
+        for name, value in args.items()
+        if name not in CONNECTION_ARGS
+    )
+
+
+class BatchedFilterConnectionField(DjangoFilterConnectionField):
+    """
+    Filter connection field that accepts lists produced by the
+    DataLoaders and primes the loaders with every page it returns
+    """
+    @classmethod
+    def resolve_queryset(
+        cls, connection, iterable, info, args, filtering_args, filterset_class
+    ):
+        # Lists come from a loader and are only returned when
+        # no filter was requested, so there is nothing to refilter
+        if isinstance(iterable, list):
+            return iterable
+        return super().resolve_queryset(
+            connection, iterable, info, args, filtering_args, filterset_class)
+
+    @classmethod
+    def connection_resolver(
+        cls,
+        resolver,
+        connection,
+        default_manager,
+        queryset_resolver,
+        max_limit,
+        enforce_first_or_last,
+        root,
+        info,
+        **args,
+    ):
+        if aio.running_async():
+            return cls.aconnection_resolver(
+                resolver,
+                connection,
+                default_manager,
+                queryset_resolver,
+                max_limit,
+                enforce_first_or_last,
+                root,
+                info,
+                **args,
+            )
+        connection = super().connection_resolver(
+            resolver,
+            connection,
+            default_manager,
+            queryset_resolver,
+            max_limit,
+            enforce_first_or_last,
+            root,
+            info,
+            **args,
+        )
+        get_loaders(info).prime(edge.node for edge in connection.edges)
+        return connection
+
+    @classmethod
+    async def aconnection_resolver(
+        cls,
+        resolver,
+        connection,
+        default_manager,
+        queryset_resolver,
+        max_limit,
+        enforce_first_or_last,
+        root,
+        info,
+        **args,
+    ):
+        """
+        Resolve the connection on the event loop, counting and
+        reading the page with the async ORM
+        """
+        first = args.get('first')
+        last = args.get('last')
+        if enforce_first_or_last and not (first or last):
+            raise GraphQLError(
+                f"You must provide a `first` or `last` value to properly "
+                f"paginate the `{info.field_name}` connection.")
+        if max_limit and max(first or 0, last or 0) > max_limit:
+            raise GraphQLError(
+                f"Requesting more than {max_limit} records on the "
+                f"`{info.field_name}` connection is not allowed.")
+        if args.get('offset') is not None and args.get('before'):
+            raise GraphQLError(
+                f"You can't provide a `before` value at the same time as an "
+                f"`offset` value on the `{info.field_name}` connection.")
+
+        def get_iterable():
+            # Filter forms may query the database while validating
+            iterable = resolver(root, info, **args)
+            if iterable is None:
+                iterable = default_manager
+            return queryset_resolver(connection, iterable, info, args)
+
+        iterable = await sync_to_async(get_iterable)()
+        result = await aio.resolve_connection(
+            connection, args, iterable, max_limit)
+        get_loaders(info).prime(edge.node for edge in result.edges)
+        return result
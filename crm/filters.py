@@ -1,5 +1,4 @@
 import django_filters
-from django.db.models import Sum
 from crm.models import Customer, Product, Order
 
 
@@ -75,7 +74,12 @@ class OrderFilter(django_filters.FilterSet):
     customer_name = django_filters.CharFilter(
         field_name='customer__name', lookup_expr='icontains')
     order_by = django_filters.OrderingFilter(
-        fields=(('order_date', 'order_date')))
+        fields=(
+            ('order_date', 'order_date'),
+            ('total_amount', 'total_amount'),
+            ('customer', 'customer'),
+        )
+    )
 
     class Meta:
         model = Order
@@ -88,13 +92,11 @@ class OrderFilter(django_filters.FilterSet):
         This method returns orders with total amount greater
         than value
         """
-        return queryset.annotate(
-            total=Sum('products__price')).filter(total__gte=value)
+        return queryset.filter(total_amount__gte=value)
 
     def filter_total_amount_lte(self, queryset, name, value):
         """
         This method returns orders with total amount less
         than value
         """
-        return queryset.annotate(
-            total=Sum('products__price')).filter(total__lte=value)
+        return queryset.filter(total_amount__lte=value)
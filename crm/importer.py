@@ -0,0 +1,300 @@
+"""
+Streaming import of partner CSV/NDJSON files.
+
+Rows are read lazily and handled in fixed-size chunks, each validated
+and upserted through crm.bulk in its own transaction, so memory stays
+flat whatever the file size and an interrupted import can be resumed
+from the offset of the last committed chunk. Orders reference their
+customer by email and their products by name; the references are
+resolved through bounded in-memory id maps filled with one IN query
+per chunk.
+
+Columns:
+    customers: name, email, phone
+    products:  name, price, stock
+    orders:    customer_email, products, order_date
+               (products separated by ``|`` in CSV, a list in NDJSON)
+"""
+import csv
+import json
+import os
+from dataclasses import asdict, dataclass
+from datetime import date
+from itertools import islice
+from . import bulk
+from .models import Customer, Order, Product
+
+
+CUSTOMERS = 'customers'
+PRODUCTS = 'products'
+ORDERS = 'orders'
+OBJECT_TYPES = (CUSTOMERS, PRODUCTS, ORDERS)
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+FORMATS = (CSV, NDJSON)
+
+PRODUCT_SEPARATOR = '|'
+
+
+class RowParseError(Exception):
+    pass
+
+
+@dataclass
+class ImportResult:
+    processed: int = 0
+    created: int = 0
+    updated: int = 0
+    rejected: int = 0
+    next_offset: int = 0
+
+
+def detect_format(path):
+    if str(path).endswith(('.ndjson', '.jsonl')):
+        return NDJSON
+    return CSV
+
+
+def read_rows(stream, format):
+    """
+    Yield one dict per data row, or a RowParseError for lines
+    that are not valid NDJSON objects
+    """
+    if format == CSV:
+        for row in csv.DictReader(stream):
+            # Empty cells are missing values, not empty strings
+            yield {key: value for key, value in row.items() if value != ''}
+        return
+
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield RowParseError(f'Invalid JSON: {e}')
+            continue
+        if not isinstance(row, dict):
+            yield RowParseError('Expected a JSON object.')
+            continue
+        yield row
+
+
+class IdMap:
+    """
+    Natural key -> primary key map of one model, filled on demand
+    and emptied whenever it grows past maxsize
+    """
+    def __init__(self, model, key, maxsize=100_000):
+        self.model = model
+        self.key = key
+        self.maxsize = maxsize
+        self._ids = {}
+
+    def resolve(self, keys):
+        missing = {key for key in keys if key not in self._ids}
+        if len(self._ids) + len(missing) > self.maxsize:
+            self._ids.clear()
+        if missing:
+            # Lowest id wins when a key is stored more than once
+            rows = (
+                self.model.objects
+                .filter(**{f'{self.key}__in': missing})
+                .order_by('-pk')
+                .values_list(self.key, 'pk')
+            )
+            self._ids.update(rows)
+        return self
+
+    def get(self, key):
+        return self._ids.get(key)
+
+
+class OrderImporter:
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size
+        self.customers = IdMap(Customer, 'email')
+        self.products = IdMap(Product, 'name')
+
+    def parse(self, row):
+        """
+        Return ((email, product names, order date), {field: messages})
+        """
+        errors = {}
+        email = str(row.get('customer_email') or '').strip()
+        if not email:
+            errors['customer_email'] = [bulk.REQUIRED]
+
+        names = row.get('products') or []
+        if isinstance(names, str):
+            names = names.split(PRODUCT_SEPARATOR)
+        names = [str(name).strip() for name in names if str(name).strip()]
+        if not names:
+            errors['products'] = [bulk.REQUIRED]
+
+        order_date = row.get('order_date')
+        if not order_date:
+            errors['order_date'] = [bulk.REQUIRED]
+        else:
+            try:
+                order_date = date.fromisoformat(str(order_date))
+            except ValueError:
+                errors['order_date'] = [
+                    'Date has wrong format. Use one of these formats '
+                    'instead: YYYY-MM-DD.']
+        return (email, names, order_date), errors
+
+    def __call__(self, rows):
+        parsed = [self.parse(row) for row in rows]
+        self.customers.resolve(
+            email for (email, _, _), errors in parsed if not errors)
+        self.products.resolve(
+            name for (_, names, _), errors in parsed if not errors
+            for name in names)
+
+        entries = []
+        errors = []
+        for index, ((email, names, order_date), row_errors) in enumerate(
+                parsed):
+            if not row_errors:
+                customer_id = self.customers.get(email)
+                if customer_id is None:
+                    row_errors['customer_email'] = [
+                        f'No customer with email "{email}".']
+                unknown = [n for n in names if self.products.get(n) is None]
+                if unknown:
+                    row_errors['products'] = [
+                        f'Unknown product "{name}".' for name in unknown]
+            if row_errors:
+                errors.extend(
+                    bulk.RowError(index, name, messages)
+                    for name, messages in row_errors.items())
+                continue
+            entries.append((
+                Order(customer_id=customer_id, order_date=order_date),
+                [self.products.get(name) for name in names],
+            ))
+
+        orders = bulk.insert_orders(entries, self.batch_size)
+        return bulk.BulkResult(orders, len(orders), errors)
+
+
+def get_chunk_handler(object_type, batch_size=None):
+    """
+    Return a callable validating and upserting a list of rows
+    into a crm.bulk.BulkResult
+    """
+    if object_type == CUSTOMERS:
+        return lambda rows: bulk.bulk_create_customers(
+            rows, batch_size=batch_size, update_existing=True)
+    if object_type == PRODUCTS:
+        return lambda rows: bulk.upsert_products(rows, batch_size=batch_size)
+    if object_type == ORDERS:
+        return OrderImporter(batch_size)
+    raise ValueError(f'Unknown object type {object_type!r}')
+
+
+def import_stream(
+    stream, object_type, format=CSV, offset=0, chunk_size=1000,
+    report=None, on_chunk=None,
+):
+    """
+    Import rows from stream, skipping the first offset data rows.
+
+    Rejected rows are written to report (a text stream) as NDJSON
+    objects with their row number, errors and data. on_chunk is
+    called with the ImportResult after every committed chunk.
+    """
+    handle_chunk = get_chunk_handler(object_type, chunk_size)
+    rows = islice(enumerate(read_rows(stream, format)), offset, None)
+    result = ImportResult(next_offset=offset)
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        errors = {}
+        valid = []
+        for number, row in chunk:
+            if isinstance(row, RowParseError):
+                errors[number] = {'non_field_errors': [str(row)]}
+            else:
+                valid.append((number, row))
+
+        chunk_result = handle_chunk([row for _, row in valid])
+        for error in chunk_result.errors:
+            number = valid[error.index][0]
+            errors.setdefault(number, {})[error.field] = error.messages
+
+        result.processed += len(chunk)
+        result.created += chunk_result.created
+        result.updated += len(chunk_result.objects) - chunk_result.created
+        result.rejected += len(errors)
+        result.next_offset = chunk[-1][0] + 1
+
+        if report is not None:
+            data = dict(chunk)
+            for number in sorted(errors):
+                row = data[number]
+                report.write(json.dumps({
+                    'row': number,
+                    'errors': errors[number],
+                    'data': None if isinstance(row, RowParseError) else row,
+                }, default=str) + '\n')
+        if on_chunk is not None:
+            on_chunk(result)
+    return result
+
+
+def read_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, offset):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(str(offset))
+
+
+def import_file(
+    path, object_type, format=None, offset=None, chunk_size=1000,
+    report_path=None, checkpoint_path=None, on_chunk=None,
+):
+    """
+    Import a CSV or NDJSON file and return the ImportResult as a dict.
+
+    With a checkpoint_path, the offset of the last committed chunk is
+    written there after every chunk and used when offset is None; the
+    file is removed once the import completes.
+    """
+    format = format or detect_format(path)
+    if offset is None:
+        offset = read_checkpoint(checkpoint_path) if checkpoint_path else 0
+
+    def chunk_done(result):
+        if checkpoint_path:
+            write_checkpoint(checkpoint_path, result.next_offset)
+        if on_chunk is not None:
+            on_chunk(result)
+
+    report = None
+    if report_path:
+        # Appending keeps the rejections of earlier, resumed runs
+        report = open(report_path, 'a', encoding='utf-8')
+    try:
+        with open(path, newline='', encoding='utf-8') as stream:
+            result = import_stream(
+                stream, object_type, format, offset, chunk_size,
+                report, chunk_done)
+    finally:
+        if report is not None:
+            report.close()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return asdict(result)
@@ -0,0 +1,194 @@
+"""
+Per-request DataLoaders for the crm schema.
+
+The sync GraphQLView resolves a connection depth first, one node at a
+time, so a promise based DataLoader would never see more than one key
+per batch. Instead every node a connection hands out is *primed* into
+the loaders of the relations it exposes, and the first lookup on any of
+them fetches the whole level with a single ``IN (...)`` query.
+"""
+from collections import defaultdict
+from .models import Customer, Order, Product
+
+
+class BatchLoader:
+    """
+    Base loader that caches values by key and loads every
+    queued key in one batch on the first cache miss
+    """
+    default = None
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self._cache = {}
+        self._queue = {}
+
+    def prime(self, key):
+        """
+        Queue a key so it is fetched with the next batch
+        """
+        if key is not None and key not in self._cache:
+            self._queue[key] = None
+
+    def seed(self, key, value):
+        """
+        Store an already known value for a key
+        """
+        self._cache[key] = value
+        self._queue.pop(key, None)
+
+    def load(self, key):
+        """
+        Return the value for key, loading all queued keys if needed
+        """
+        if key not in self._cache:
+            self._queue[key] = None
+            self._dispatch()
+        return self._cache[key]
+
+    def clear(self):
+        self._cache.clear()
+        self._queue.clear()
+
+    def _dispatch(self):
+        keys = list(self._queue)
+        self._queue.clear()
+        results = self.batch_load(keys)
+        for key in keys:
+            value = results.get(key)
+            if value is None:
+                value = self.get_default()
+            self._cache[key] = value
+
+    def get_default(self):
+        return self.default
+
+    def batch_load(self, keys):
+        """
+        Return a dict mapping each key to its value
+        """
+        raise NotImplementedError
+
+
+class ListLoader(BatchLoader):
+    """
+    Loader whose values are lists of related objects
+    """
+    def get_default(self):
+        return []
+
+
+class CustomerLoader(BatchLoader):
+    """
+    Load customers by id
+    """
+    def batch_load(self, keys):
+        customers = Customer.objects.in_bulk(keys)
+        self.loaders.prime(customers.values())
+        return customers
+
+
+class OrdersByCustomerLoader(ListLoader):
+    """
+    Load the orders of each customer id
+    """
+    def batch_load(self, keys):
+        orders = Order.objects.filter(customer_id__in=keys).order_by('pk')
+        results = defaultdict(list)
+        for order in orders:
+            results[order.customer_id].append(order)
+        self.loaders.prime(orders)
+        return results
+
+
+class ProductsByOrderLoader(ListLoader):
+    """
+    Load the products of each order id through the M2M table
+    """
+    def batch_load(self, keys):
+        links = (
+            Order.products.through.objects
+            .filter(order_id__in=keys)
+            .select_related('product')
+            .order_by('pk')
+        )
+        results = defaultdict(list)
+        for link in links:
+            results[link.order_id].append(link.product)
+        self.loaders.prime(
+            product for products in results.values() for product in products)
+        return results
+
+
+class OrdersByProductLoader(ListLoader):
+    """
+    Load the orders containing each product id through the M2M table
+    """
+    def batch_load(self, keys):
+        links = (
+            Order.products.through.objects
+            .filter(product_id__in=keys)
+            .select_related('order')
+            .order_by('pk')
+        )
+        results = defaultdict(list)
+        for link in links:
+            results[link.product_id].append(link.order)
+        self.loaders.prime(
+            order for orders in results.values() for order in orders)
+        return results
+
+
+class Loaders:
+    """
+    The set of loaders shared by one GraphQL execution
+    """
+    def __init__(self):
+        self.customer = CustomerLoader(self)
+        self.orders_by_customer = OrdersByCustomerLoader(self)
+        self.products_by_order = ProductsByOrderLoader(self)
+        self.orders_by_product = OrdersByProductLoader(self)
+
+    def prime(self, objects):
+        """
+        Queue the relations of freshly loaded objects so that their
+        siblings are fetched together
+        """
+        for obj in objects:
+            if isinstance(obj, Order):
+                if not (
+                    Order.customer.is_cached(obj)
+                    or 'customer_id' in obj.get_deferred_fields()
+                ):
+                    self.customer.prime(obj.customer_id)
+                self.products_by_order.prime(obj.pk)
+            elif isinstance(obj, Customer):
+                self.customer.seed(obj.pk, obj)
+                self.orders_by_customer.prime(obj.pk)
+            elif isinstance(obj, Product):
+                self.orders_by_product.prime(obj.pk)
+
+    def clear(self):
+        for loader in (
+            self.customer,
+            self.orders_by_customer,
+            self.products_by_order,
+            self.orders_by_product,
+        ):
+            loader.clear()
+
+
+def get_loaders(info):
+    """
+    Return the loaders attached to the execution context,
+    creating them when the context has none yet
+    """
+    context = info.context
+    loaders = getattr(context, 'loaders', None)
+    if loaders is None:
+        loaders = Loaders()
+        try:
+            context.loaders = loaders
+        except AttributeError:
+            pass
+    return loaders
@@ -0,0 +1,155 @@
+import asyncio
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.test.utils import override_settings
+
+
+DEFAULT_QUERY = """
+    query {
+      stats { totalCustomers totalOrders totalRevenue }
+      allProducts(first: 20) {
+        totalCount
+        edges { node { name price stock } }
+      }
+    }
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the throughput of the WSGI GraphQL view with the "
+        "async view served over ASGI"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=200,
+            help="Requests sent to each endpoint",
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=20,
+            help="Requests in flight at once",
+        )
+        parser.add_argument(
+            '--query',
+            default=DEFAULT_QUERY,
+            help="GraphQL document to send",
+        )
+        parser.add_argument(
+            '--wsgi-url',
+            help="Benchmark a running WSGI server instead of the "
+                 "in-process application, e.g. http://localhost:8000/graphql",
+        )
+        parser.add_argument(
+            '--asgi-url',
+            help="Benchmark a running ASGI server instead of the in-process "
+                 "application, e.g. http://localhost:8001/graphql/async",
+        )
+        parser.add_argument(
+            '--cache',
+            action='store_true',
+            help="Keep the response cache on for in-process runs",
+        )
+
+    def handle(self, *args, **options):
+        payload = {'query': options['query']}
+        total = options['requests']
+        concurrency = options['concurrency']
+
+        with override_settings(
+                GRAPHQL_RESPONSE_CACHE_ENABLED=options['cache']):
+            results = [
+                ('wsgi', self.run_wsgi(
+                    options['wsgi_url'], payload, total, concurrency)),
+                ('asgi', asyncio.run(self.run_asgi(
+                    options['asgi_url'], payload, total, concurrency))),
+            ]
+
+        self.stdout.write(
+            f"{'path':<6}{'requests':>10}{'errors':>8}{'req/s':>10}"
+            f"{'p50 ms':>10}{'p95 ms':>10}")
+        for name, (elapsed, latencies, errors) in results:
+            p50, p95 = self.percentiles(latencies)
+            self.stdout.write(
+                f"{name:<6}{len(latencies):>10}{errors:>8}"
+                f"{len(latencies) / elapsed:>10.1f}{p50:>10.1f}{p95:>10.1f}")
+
+    @staticmethod
+    def percentiles(latencies):
+        if len(latencies) < 2:
+            value = latencies[0] * 1000 if latencies else 0.0
+            return value, value
+        cuts = statistics.quantiles(latencies, n=20)
+        return statistics.median(latencies) * 1000, cuts[18] * 1000
+
+    @staticmethod
+    def is_error(response):
+        return response.status_code != 200 or 'errors' in response.json()
+
+    def run_wsgi(self, url, payload, total, concurrency):
+        """
+        Send the requests from a thread pool, one client per thread
+        """
+        local = threading.local()
+        app = None
+        if url is None:
+            app = get_wsgi_application()
+            url = 'http://localhost/graphql'
+
+        def client():
+            if not hasattr(local, 'client'):
+                transport = httpx.WSGITransport(app=app) if app else None
+                local.client = httpx.Client(transport=transport)
+            return local.client
+
+        def send(_):
+            start = time.perf_counter()
+            response = client().post(url, json=payload)
+            return time.perf_counter() - start, self.is_error(response)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            outcomes = list(pool.map(send, range(total)))
+        elapsed = time.perf_counter() - start
+        return (
+            elapsed,
+            [latency for latency, _ in outcomes],
+            sum(error for _, error in outcomes),
+        )
+
+    async def run_asgi(self, url, payload, total, concurrency):
+        """
+        Send the requests from one event loop
+        """
+        transport = None
+        if url is None:
+            transport = httpx.ASGITransport(app=get_asgi_application())
+            url = 'http://localhost/graphql/async'
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async with httpx.AsyncClient(transport=transport) as client:
+            async def send():
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.post(url, json=payload)
+                    return time.perf_counter() - start, self.is_error(
+                        response)
+
+            start = time.perf_counter()
+            outcomes = await asyncio.gather(*(send() for _ in range(total)))
+            elapsed = time.perf_counter() - start
+        return (
+            elapsed,
+            [latency for latency, _ in outcomes],
+            sum(error for _, error in outcomes),
+        )
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from crm.cleanup import clean_inactive_customers
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete customers without an order in the last --days days, "
+        "in short id-range transactions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Number of customers deleted per transaction",
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.1,
+            help="Seconds to pause between chunks",
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only count the customers and orders that would go",
+        )
+
+    def handle(self, *args, **options):
+        verb = "would delete" if options['dry_run'] else "deleted"
+
+        def progress(result):
+            rate = result.customers / result.seconds if result.seconds else 0
+            self.stdout.write(
+                f"chunk={result.chunks} up_to_id={result.scanned_up_to} "
+                f"customers={result.customers} orders={result.orders} "
+                f"rate={rate:.0f}/s")
+
+        result = clean_inactive_customers(
+            days=options['days'],
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            dry_run=options['dry_run'],
+            on_chunk=progress,
+        )
+        # Last line is logged by clean_inactive_customers.sh
+        self.stdout.write(
+            f"{verb} {result['customers']} customers "
+            f"({result['orders']} orders) inactive since "
+            f"{result['cutoff']} in {result['seconds']:.1f}s")
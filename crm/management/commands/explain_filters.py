@@ -0,0 +1,159 @@
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from crm.filters import CustomerFilter, OrderFilter, ProductFilter
+from crm.models import Customer, Order, Product
+
+
+# Indexes added for the filtersets, dropped by --compare
+TUNED_INDEXES = [
+    'crm_customer_created_idx',
+    'crm_customer_name_idx',
+    'crm_customer_phone_prefix_idx',
+    'crm_order_date_idx',
+    'crm_order_customer_date_idx',
+    'crm_product_name_idx',
+    'crm_product_price_idx',
+    'crm_product_stock_idx',
+    'crm_product_low_stock_idx',
+]
+POSTGRES_INDEXES = [
+    'crm_customer_name_trgm_idx',
+    'crm_customer_email_trgm_idx',
+    'crm_product_name_trgm_idx',
+]
+
+
+def filter_queries():
+    """
+    Representative filterset queries, built the same way the
+    GraphQL connections build them
+    """
+    today = date.today()
+    customer = Customer.objects.order_by('pk').first()
+    yield 'customers name icontains', CustomerFilter(
+        {'name__icontains': 'smith'}, Customer.objects.all()).qs
+    yield 'customers phone prefix', CustomerFilter(
+        {'phone_pattern': '+1555'}, Customer.objects.all()).qs
+    yield 'customers created range', CustomerFilter(
+        {'created_at__gte': today - timedelta(days=30),
+         'order_by': 'created_at'},
+        Customer.objects.all()).qs[:50]
+    yield 'products low stock', ProductFilter(
+        {'low_stock': True}, Product.objects.all()).qs
+    yield 'products price range', ProductFilter(
+        {'price__gte': 10, 'price__lte': 20, 'order_by': 'price'},
+        Product.objects.all()).qs[:50]
+    yield 'orders date range', OrderFilter(
+        {'order_date__gte': today - timedelta(days=7),
+         'order_by': '-order_date'},
+        Order.objects.all()).qs[:50]
+    yield 'orders of customer by date', OrderFilter(
+        {'order_date__gte': today - timedelta(days=365)},
+        Order.objects.filter(customer=customer)).qs
+    yield 'orders total range', OrderFilter(
+        {'total_amount__gte': 100, 'total_amount__lte': 200},
+        Order.objects.all()).qs[:50]
+
+
+class Command(BaseCommand):
+    help = (
+        "Print EXPLAIN plans and timings for the filterset queries, "
+        "optionally with and without the tuned indexes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--compare',
+            action='store_true',
+            help="Also explain every query with the tuned indexes dropped "
+                 "(inside a rolled back transaction)",
+        )
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=0,
+            help="Insert this many synthetic customers/products/orders "
+                 "in a rolled back transaction before explaining",
+        )
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['rows']:
+                self.seed(options['rows'])
+            if options['compare']:
+                with transaction.atomic():
+                    self.drop_indexes()
+                    self.report('WITHOUT tuned indexes', options['repeat'])
+                    transaction.set_rollback(True)
+            self.report('WITH tuned indexes', options['repeat'])
+            transaction.set_rollback(True)
+
+    def drop_indexes(self):
+        names = list(TUNED_INDEXES)
+        if connection.vendor == 'postgresql':
+            names += POSTGRES_INDEXES
+        with connection.cursor() as cursor:
+            for name in names:
+                cursor.execute(
+                    f'DROP INDEX IF EXISTS {connection.ops.quote_name(name)}')
+        self.analyze()
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def seed(self, rows):
+        rng = random.Random(0)
+        start = date.today() - timedelta(days=3 * 365)
+        customers = Customer.objects.bulk_create(
+            [
+                Customer(
+                    name=f'Customer {i}',
+                    email=f'bench{i}@example.com',
+                    phone=f'+1555{i:07d}',
+                )
+                for i in range(rows)
+            ],
+            batch_size=1000,
+        )
+        products = Product.objects.bulk_create(
+            [
+                Product(
+                    name=f'Product {i}',
+                    price=Decimal(rng.randint(100, 10000)) / 100,
+                    stock=rng.randint(0, 200),
+                )
+                for i in range(max(rows // 10, 1))
+            ],
+            batch_size=1000,
+        )
+        Order.objects.bulk_create(
+            [
+                Order(
+                    customer=rng.choice(customers),
+                    order_date=start + timedelta(days=rng.randint(0, 1095)),
+                    total_amount=rng.choice(products).price,
+                )
+                for _ in range(rows)
+            ],
+            batch_size=1000,
+        )
+        self.analyze()
+
+    def report(self, title, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"== {title} =="))
+        for label, queryset in filter_queries():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                list(queryset.all())
+                timings.append(time.perf_counter() - started)
+            self.stdout.write(self.style.MIGRATE_LABEL(
+                f"-- {label}: best of {repeat} "
+                f"{min(timings) * 1000:.2f} ms"))
+            self.stdout.write(queryset.explain())
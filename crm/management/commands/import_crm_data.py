@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from crm import importer
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream customers, products or orders from a CSV or NDJSON "
+        "file into the crm tables"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument(
+            '--type',
+            dest='object_type',
+            required=True,
+            choices=importer.OBJECT_TYPES,
+        )
+        parser.add_argument(
+            '--format',
+            choices=importer.FORMATS,
+            help="Input format (default: from the file extension)",
+        )
+        parser.add_argument(
+            '--offset',
+            type=int,
+            help="Number of data rows to skip, to resume an import "
+                 "(default: the checkpoint left by an interrupted run)",
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help="Number of rows validated and written per transaction",
+        )
+        parser.add_argument(
+            '--report',
+            help="File receiving rejected rows as NDJSON "
+                 "(default: <path>.rejected.ndjson)",
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+
+        def progress(result):
+            self.stdout.write(
+                f"{result.next_offset} rows committed "
+                f"({result.rejected} rejected)")
+
+        result = importer.import_file(
+            path,
+            options['object_type'],
+            format=options['format'],
+            offset=options['offset'],
+            chunk_size=options['chunk_size'],
+            report_path=options['report'] or f'{path}.rejected.ndjson',
+            checkpoint_path=f'{path}.offset',
+            on_chunk=progress,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {result['processed']} rows: "
+            f"{result['created']} created, {result['updated']} updated, "
+            f"{result['rejected']} rejected"))
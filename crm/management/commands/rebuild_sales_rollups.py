@@ -0,0 +1,42 @@
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from crm.analytics import rebuild_sales_rollups
+from crm.models import Order
+
+
+class Command(BaseCommand):
+    help = "Rebuild the sales rollup buckets over a range of order dates"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from', dest='start', type=date.fromisoformat,
+            help="First order date to rebuild (default: earliest order)")
+        parser.add_argument(
+            '--to', dest='end', type=date.fromisoformat,
+            help="Last order date to rebuild (default: latest order)")
+        parser.add_argument(
+            '--chunk-days', type=int, default=31,
+            help="Number of days rebuilt per transaction")
+
+    def handle(self, *args, **options):
+        bounds = Order.objects.aggregate(
+            start=Min('order_date'), end=Max('order_date'))
+        start = options['start'] or bounds['start']
+        end = options['end'] or bounds['end']
+        if start is None or end is None:
+            self.stdout.write("No orders to roll up")
+            return
+
+        created = 0
+        chunk = timedelta(days=options['chunk_days'])
+        while start <= end:
+            chunk_end = min(start + chunk, end + timedelta(days=1))
+            days = [
+                start + timedelta(days=i)
+                for i in range((chunk_end - start).days)
+            ]
+            created += rebuild_sales_rollups(days)
+            start = chunk_end
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {created} sales rollup rows"))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from crm import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search documents from the source tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--type',
+            dest='types',
+            action='append',
+            choices=list(search.MODELS),
+            help="Only rebuild this object type (repeatable)",
+        )
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for object_type in options['types'] or list(search.MODELS):
+            model = search.MODELS[object_type]
+            indexed = 0
+            last_id = 0
+            while True:
+                ids = list(
+                    model.objects
+                    .filter(pk__gt=last_id)
+                    .order_by('pk')
+                    .values_list('pk', flat=True)[:batch_size]
+                )
+                if not ids:
+                    break
+                search.index_objects(object_type, ids)
+                indexed += len(ids)
+                last_id = ids[-1]
+            self.stdout.write(self.style.SUCCESS(
+                f"Indexed {indexed} {object_type} documents"))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from crm import response_cache
+
+
+class Command(BaseCommand):
+    help = "Print the GraphQL response cache hit and miss counters"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help="Reset the counters after printing them",
+        )
+
+    def handle(self, *args, **options):
+        if response_cache.is_process_local():
+            self.stderr.write(
+                "The response cache is local to each process; these "
+                "counters only cover this command's process.")
+        stats = response_cache.get_stats()
+        self.stdout.write(
+            f"hits={stats['hits']} misses={stats['misses']} "
+            f"hit_ratio={stats['hit_ratio']:.2%}")
+        if options['reset']:
+            response_cache.reset_stats()
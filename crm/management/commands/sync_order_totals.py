@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from crm.models import Order
+
+
+class Command(BaseCommand):
+    help = "Backfill or verify the stored Order.total_amount column"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help="Only report orders whose stored total is wrong",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help="Number of order ids updated per transaction",
+        )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            self.verify()
+        else:
+            self.backfill(options['batch_size'])
+
+    def backfill(self, batch_size):
+        """
+        Recompute totals in id ranges so each UPDATE stays short
+        """
+        updated = 0
+        last_id = 0
+        while True:
+            ids = list(
+                Order.objects
+                .filter(pk__gt=last_id)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            with transaction.atomic():
+                updated += (
+                    Order.objects
+                    .filter(pk__gte=ids[0], pk__lte=ids[-1])
+                    .update_total_amounts()
+                )
+            last_id = ids[-1]
+        self.stdout.write(self.style.SUCCESS(
+            f"Recomputed total_amount for {updated} orders"))
+
+    def verify(self):
+        mismatched = (
+            Order.objects
+            .with_computed_total()
+            .exclude(total_amount=F('computed_total'))
+        )
+        count = 0
+        for order in mismatched.values('pk', 'total_amount', 'computed_total'):
+            count += 1
+            self.stdout.write(
+                f"order={order['pk']} stored={order['total_amount']} "
+                f"expected={order['computed_total']}")
+        if count:
+            self.stdout.write(self.style.ERROR(
+                f"{count} orders have a stale total_amount"))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                "All order totals are up to date"))
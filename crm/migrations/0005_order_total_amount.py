@@ -0,0 +1,38 @@
+# Generated by Django 4.2.25 on 2026-10-18 03:35
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_total_amount(apps, schema_editor):
+    Order = apps.get_model('crm', 'Order')
+    totals = (
+        Order.products.through.objects
+        .filter(order_id=OuterRef('pk'))
+        .values('order_id')
+        .annotate(total=Sum('product__price'))
+        .values('total')
+    )
+    Order.objects.update(total_amount=Coalesce(
+        Subquery(totals),
+        Value(0),
+        output_field=models.DecimalField(max_digits=12, decimal_places=2),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0004_alter_order_order_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='total_amount',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(
+            backfill_total_amount, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.25 on 2026-10-18 03:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0005_order_total_amount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CRMStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_customers', models.IntegerField(default=0)),
+                ('total_orders', models.IntegerField(default=0)),
+                ('total_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 4.2.25 on 2026-10-18 03:38
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Trunc
+import django.db.models.deletion
+
+
+def backfill_sales_rollups(apps, schema_editor):
+    """
+    Roll up the existing orders into day, week and month buckets,
+    as crm.analytics.rebuild_sales_rollups does for dirty days
+    """
+    Order = apps.get_model('crm', 'Order')
+    SalesRollup = apps.get_model('crm', 'SalesRollup')
+    for granularity in ('day', 'week', 'month'):
+        totals = (
+            Order.objects
+            .annotate(bucket=Trunc('order_date', granularity))
+            .values('bucket')
+            .annotate(
+                order_count=Count('pk'),
+                revenue=Sum('total_amount'),
+                customer_count=Count('customer_id', distinct=True),
+            )
+        )
+        per_product = (
+            Order.products.through.objects
+            .annotate(bucket=Trunc('order__order_date', granularity))
+            .values('bucket', 'product_id')
+            .annotate(
+                order_count=Count('order_id', distinct=True),
+                revenue=Sum('product__price'),
+                customer_count=Count('order__customer_id', distinct=True),
+            )
+        )
+        SalesRollup.objects.bulk_create(
+            [SalesRollup(granularity=granularity, **row) for row in totals]
+            + [SalesRollup(granularity=granularity, **row)
+               for row in per_product],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0006_crmstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesRollupDirtyDay',
+            fields=[
+                ('day', models.DateField(primary_key=True, serialize=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('day', 'Day'), ('week', 'Week'), ('month', 'Month')], max_length=5)),
+                ('bucket', models.DateField()),
+                ('order_count', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('customer_count', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='crm.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['granularity', 'product', 'bucket'], name='crm_salesrollup_lookup_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='salesrollup',
+            constraint=models.UniqueConstraint(fields=('granularity', 'bucket', 'product'), name='crm_salesrollup_product_bucket_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='salesrollup',
+            constraint=models.UniqueConstraint(condition=models.Q(('product__isnull', True)), fields=('granularity', 'bucket'), name='crm_salesrollup_total_bucket_uniq'),
+        ),
+        migrations.RunPython(
+            backfill_sales_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,86 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS crm_search USING fts5("
+            "body, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE IF NOT EXISTS crm_search ('
+            'key bigint PRIMARY KEY, '
+            'object_type smallint NOT NULL, '
+            'document tsvector NOT NULL)'
+        )
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS crm_search_document_idx '
+            'ON crm_search USING gin (document)'
+        )
+
+
+def backfill_search_index(apps, schema_editor):
+    """
+    Index the existing customers, products and orders with the
+    documents crm.search.build_documents writes, keyed by
+    id * 4 + type code (1 customer, 2 product, 3 order)
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor not in ('sqlite', 'postgresql'):
+        return
+    quote = schema_editor.connection.ops.quote_name
+    Customer = apps.get_model('crm', 'Customer')
+    Product = apps.get_model('crm', 'Product')
+    Order = apps.get_model('crm', 'Order')
+    customers = quote(Customer._meta.db_table)
+    products = quote(Product._meta.db_table)
+    orders = quote(Order._meta.db_table)
+    links = quote(Order.products.through._meta.db_table)
+
+    if vendor == 'sqlite':
+        names = "group_concat(p.name, ' ')"
+    else:
+        names = "string_agg(p.name, ' ')"
+    sources = [
+        (1, "c.name || ' ' || c.email", f'{customers} c', 'c.id'),
+        (2, 'p.name', f'{products} p', 'p.id'),
+        (
+            3,
+            f"c.name || ' ' || c.email || COALESCE(' ' || ("
+            f'SELECT {names} FROM {links} l '
+            f'JOIN {products} p ON p.id = l.product_id '
+            f"WHERE l.order_id = o.id), '')",
+            f'{orders} o JOIN {customers} c ON c.id = o.customer_id',
+            'o.id',
+        ),
+    ]
+    for code, body, tables, pk in sources:
+        if vendor == 'sqlite':
+            schema_editor.execute(
+                f'INSERT INTO crm_search (rowid, body) '
+                f'SELECT {pk} * 4 + {code}, {body} FROM {tables}')
+        else:
+            schema_editor.execute(
+                f'INSERT INTO crm_search (key, object_type, document) '
+                f"SELECT {pk} * 4 + {code}, {code}, "
+                f"to_tsvector('simple', {body}) FROM {tables}")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE IF EXISTS crm_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0009_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(
+            backfill_search_index, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,10 @@
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import (
+    Case, DecimalField, F, OuterRef, Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce
 from django.core.validators import MinValueValidator
+from django.utils import timezone
+from . import pubsub, response_cache
 
 
 class Customer(models.Model):
@@ -8,10 +13,131 @@ class Customer(models.Model):
     phone = models.CharField(max_length=12, null=True)
     created_at = models.DateField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['created_at', 'id'], name='crm_customer_created_idx'),
+            models.Index(fields=['name', 'id'], name='crm_customer_name_idx'),
+            # varchar_pattern_ops lets PostgreSQL serve `LIKE 'x%'`
+            # (phone_pattern) from the index in any collation
+            models.Index(
+                fields=['phone'],
+                opclasses=['varchar_pattern_ops'],
+                name='crm_customer_phone_prefix_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
 
+def supports_update_returning(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    return False
+
+
+class InsufficientStock(Exception):
+    """
+    Raised when a stock reservation cannot be fully satisfied
+    """
+    def __init__(self, product_ids):
+        self.product_ids = sorted(product_ids)
+        super().__init__(
+            f"Insufficient stock for products {self.product_ids}")
+
+
+class ProductQuerySet(models.QuerySet):
+    def reserve_stock(self, quantities):
+        """
+        Decrement the stock of {product id: quantity} with a single
+        conditional UPDATE. Either every product has enough stock and
+        is decremented, or nothing changes and InsufficientStock names
+        the products that were short.
+        """
+        quantities = {
+            pk: quantity for pk, quantity in quantities.items() if quantity
+        }
+        if not quantities:
+            return
+        needed = Case(
+            *[When(pk=pk, then=Value(n)) for pk, n in quantities.items()],
+            output_field=models.PositiveIntegerField(),
+        )
+        try:
+            with transaction.atomic():
+                updated = (
+                    self.filter(pk__in=quantities, stock__gte=needed)
+                    .update(stock=F('stock') - needed)
+                )
+                if updated != len(quantities):
+                    raise InsufficientStock(())
+                pubsub.stock_changed(
+                    self.model.objects.filter(pk__in=list(quantities))
+                    .values_list('pk', 'stock'))
+        except InsufficientStock:
+            stock = dict(
+                self.filter(pk__in=quantities).values_list('pk', 'stock'))
+            raise InsufficientStock(
+                pk for pk, quantity in quantities.items()
+                if (stock.get(pk) or 0) < quantity)
+        response_cache.invalidate_models(self.model)
+
+    def restock(self, increment):
+        """
+        Add increment to the stock of every product in the queryset
+        with a single UPDATE, so concurrent restocks and reservations
+        never overwrite each other
+        """
+        updated = self.update(stock=F('stock') + increment)
+        response_cache.invalidate_models(self.model)
+        return updated
+
+    def restock_below(self, threshold, increment, limit=None):
+        """
+        Add increment to the stock of the products below threshold,
+        lowest stock first and at most limit of them, with a single
+        UPDATE. Returns the ids of the restocked products, read back
+        with RETURNING where the database supports it.
+        """
+        connection = connections[self.db]
+        candidates = self.filter(stock__lt=threshold)
+        if limit is not None:
+            candidates = candidates.order_by('stock', 'pk')[:limit]
+
+        if not supports_update_returning(connection):
+            with transaction.atomic():
+                ids = list(candidates.values_list('pk', flat=True))
+                self.model.objects.filter(
+                    pk__in=ids, stock__lt=threshold).restock(increment)
+                pubsub.stock_changed(
+                    self.model.objects.filter(pk__in=ids)
+                    .values_list('pk', 'stock'))
+            return ids
+
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        pk = quote(self.model._meta.pk.column)
+        stock = quote(self.model._meta.get_field('stock').column)
+        inner_sql, inner_params = (
+            candidates.values('pk').query.sql_with_params())
+        # The outer condition re-checks rows changed since the
+        # subquery picked them
+        sql = (
+            f'UPDATE {table} SET {stock} = {stock} + %s '
+            f'WHERE {pk} IN ({inner_sql}) AND {stock} < %s '
+            f'RETURNING {pk}, {stock}'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [increment, *inner_params, threshold])
+            rows = cursor.fetchall()
+        pubsub.stock_changed(rows)
+        ids = [row[0] for row in rows]
+        response_cache.invalidate_models(self.model)
+        return ids
+
+
 class Product(models.Model):
     name = models.CharField(max_length=100)
     price = models.DecimalField(
@@ -21,10 +147,56 @@ class Product(models.Model):
             MinValueValidator(0)])
     stock = models.PositiveIntegerField(default=0, null=True)
 
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['name', 'id'], name='crm_product_name_idx'),
+            models.Index(fields=['price', 'id'], name='crm_product_price_idx'),
+            models.Index(fields=['stock', 'id'], name='crm_product_stock_idx'),
+            # Small partial index serving lowStock and the restock job
+            models.Index(
+                fields=['stock'],
+                condition=models.Q(stock__lt=10),
+                name='crm_product_low_stock_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
 
+class OrderQuerySet(models.QuerySet):
+    def _total_expression(self):
+        totals = (
+            self.model.products.through.objects
+            .filter(order_id=OuterRef('pk'))
+            .values('order_id')
+            .annotate(total=Sum('product__price'))
+            .values('total')
+        )
+        return Coalesce(
+            Subquery(totals),
+            Value(0),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        )
+
+    def with_computed_total(self):
+        """
+        Annotate each order with the sum of its product prices
+        computed from the M2M table
+        """
+        return self.annotate(computed_total=self._total_expression())
+
+    def update_total_amounts(self):
+        """
+        Recompute the stored total of every order in the queryset
+        with a single UPDATE
+        """
+        updated = self.update(total_amount=self._total_expression())
+        response_cache.invalidate_models(self.model)
+        return updated
+
+
 class Order(models.Model):
     customer = models.ForeignKey(
         Customer,
@@ -32,10 +204,150 @@ class Order(models.Model):
         on_delete=models.CASCADE)
     products = models.ManyToManyField(Product, related_name='orders')
     order_date = models.DateField()
+    # Sum of product prices, kept in sync by crm.signals
+    total_amount = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0, db_index=True)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['order_date', 'id'], name='crm_order_date_idx'),
+            models.Index(
+                fields=['customer', 'order_date'],
+                name='crm_order_customer_date_idx'),
+        ]
+
+
+class CRMStatsManager(models.Manager):
+    SNAPSHOT_ID = 1
+
+    def get_snapshot(self):
+        """
+        Return the stats row, building it on first use
+        """
+        snapshot = self.filter(pk=self.SNAPSHOT_ID).first()
+        if snapshot is None:
+            snapshot = self.reconcile()
+        return snapshot
+
+    async def aget_snapshot(self):
+        snapshot = await self.filter(pk=self.SNAPSHOT_ID).afirst()
+        if snapshot is None:
+            snapshot = await self.areconcile()
+        return snapshot
+
+    def increment(self, customers=0, orders=0, revenue=0):
+        """
+        Atomically apply deltas to the stats row
+        """
+        if not (customers or orders or revenue):
+            return
+        updated = self.filter(pk=self.SNAPSHOT_ID).update(
+            total_customers=models.F('total_customers') + customers,
+            total_orders=models.F('total_orders') + orders,
+            total_revenue=models.F('total_revenue') + revenue,
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            self.reconcile()
+
+    def reconcile(self):
+        """
+        Recompute every counter from the source tables
+        """
+        total_revenue = (
+            Order.products.through.objects
+            .aggregate(total=Sum('product__price'))
+        )['total'] or 0
+        snapshot, _ = self.update_or_create(
+            pk=self.SNAPSHOT_ID,
+            defaults={
+                'total_customers': Customer.objects.count(),
+                'total_orders': Order.objects.count(),
+                'total_revenue': total_revenue,
+            },
+        )
+        response_cache.invalidate_models(self.model)
+        return snapshot
+
+    async def areconcile(self):
+        total_revenue = (
+            await Order.products.through.objects
+            .aaggregate(total=Sum('product__price'))
+        )['total'] or 0
+        snapshot, _ = await self.aupdate_or_create(
+            pk=self.SNAPSHOT_ID,
+            defaults={
+                'total_customers': await Customer.objects.acount(),
+                'total_orders': await Order.objects.acount(),
+                'total_revenue': total_revenue,
+            },
+        )
+        response_cache.invalidate_models(self.model)
+        return snapshot
+
+
+class CRMStats(models.Model):
+    """
+    Single row snapshot of the global CRM counters,
+    maintained incrementally by crm.signals
+    """
+    total_customers = models.IntegerField(default=0)
+    total_orders = models.IntegerField(default=0)
+    total_revenue = models.DecimalField(
+        max_digits=16, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = CRMStatsManager()
+
+
+class SalesRollup(models.Model):
+    """
+    Pre-aggregated order counts, revenue and distinct customers
+    per time bucket, overall (product is null) and per product.
+    Maintained by crm.analytics.
+    """
+    DAY = 'day'
+    WEEK = 'week'
+    MONTH = 'month'
+    GRANULARITY_CHOICES = [
+        (DAY, 'Day'),
+        (WEEK, 'Week'),
+        (MONTH, 'Month'),
+    ]
+
+    granularity = models.CharField(max_length=5, choices=GRANULARITY_CHOICES)
+    bucket = models.DateField()
+    product = models.ForeignKey(
+        Product,
+        null=True,
+        related_name='+',
+        on_delete=models.CASCADE)
+    order_count = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    customer_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'bucket', 'product'],
+                name='crm_salesrollup_product_bucket_uniq'),
+            models.UniqueConstraint(
+                fields=['granularity', 'bucket'],
+                condition=models.Q(product__isnull=True),
+                name='crm_salesrollup_total_bucket_uniq'),
+        ]
+        indexes = [
+            models.Index(
+                fields=['granularity', 'product', 'bucket'],
+                name='crm_salesrollup_lookup_idx'),
+        ]
+
 
-    @property
-    def total_amount(self):
-        total_amount = 0
-        for p in self.products.all():
-            total_amount += p.price
-        return total_amount
+class SalesRollupDirtyDay(models.Model):
+    """
+    Days whose orders changed since the rollups were last refreshed
+    """
+    day = models.DateField(primary_key=True)
@@ -0,0 +1,144 @@
+"""
+Selection-set driven queryset optimizer.
+
+Walks the GraphQL selection of a node or connection field and applies
+``only()``, ``select_related()`` and ``prefetch_related()`` so that a
+query asking for two columns does not hydrate whole rows, and a
+to-one relation is joined instead of fetched per row.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from graphene.utils.str_converters import to_snake_case
+from graphql.language import (
+    FieldNode,
+    FragmentSpreadNode,
+    InlineFragmentNode,
+)
+from .fields import CONNECTION_ARGS
+
+
+IGNORED_FIELDS = {'__typename'}
+
+
+def get_selections(selection_set, fragments):
+    """
+    Yield the field nodes of a selection set, expanding fragments
+    """
+    if selection_set is None:
+        return
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            yield selection
+        elif isinstance(selection, InlineFragmentNode):
+            yield from get_selections(selection.selection_set, fragments)
+        elif isinstance(selection, FragmentSpreadNode):
+            fragment = fragments.get(selection.name.value)
+            if fragment is not None:
+                yield from get_selections(fragment.selection_set, fragments)
+
+
+def get_node_selections(field_node, fragments):
+    """
+    Return the selections applied to the model instances a field
+    returns, looking through ``edges { node }`` for connections
+    """
+    selections = list(get_selections(field_node.selection_set, fragments))
+    names = {s.name.value for s in selections}
+    if 'edges' not in names:
+        return selections
+
+    node_selections = []
+    for edges in selections:
+        if edges.name.value != 'edges':
+            continue
+        for node in get_selections(edges.selection_set, fragments):
+            if node.name.value == 'node':
+                node_selections.extend(
+                    get_selections(node.selection_set, fragments))
+    return node_selections
+
+
+def has_filter_arguments(field_node):
+    return any(
+        arg.name.value not in CONNECTION_ARGS for arg in field_node.arguments)
+
+
+class QueryPlan:
+    """
+    The columns, joins and prefetches needed by a selection
+    """
+    def __init__(self):
+        self.only = set()
+        self.select_related = set()
+        self.prefetch_related = []
+        # False when a selected field is not backed by a column,
+        # in which case whole rows are loaded
+        self.restrict_columns = True
+
+    def apply(self, queryset):
+        if self.select_related:
+            queryset = queryset.select_related(*sorted(self.select_related))
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        if self.restrict_columns and self.only:
+            queryset = queryset.only(*sorted(self.only))
+        return queryset
+
+
+def plan_selections(model, selections, fragments, plan=None, prefix=''):
+    """
+    Collect the query plan for selections made on a model type
+    """
+    if plan is None:
+        plan = QueryPlan()
+    plan.only.add(prefix + model._meta.pk.attname)
+
+    for selection in selections:
+        name = selection.name.value
+        if name in IGNORED_FIELDS:
+            continue
+        try:
+            field = model._meta.get_field(to_snake_case(name))
+        except FieldDoesNotExist:
+            plan.restrict_columns = False
+            continue
+
+        path = prefix + field.name
+        if not field.is_relation:
+            plan.only.add(path)
+        elif field.many_to_one or (field.one_to_one and field.concrete):
+            plan.select_related.add(path)
+            plan.only.add(path)
+            plan_selections(
+                field.related_model,
+                get_node_selections(selection, fragments),
+                fragments,
+                plan,
+                prefix=path + '__',
+            )
+        elif not has_filter_arguments(selection):
+            # Filtered connections are resolved with their own queryset
+            related_plan = plan_selections(
+                field.related_model,
+                get_node_selections(selection, fragments),
+                fragments,
+            )
+            if field.one_to_many:
+                related_plan.only.add(field.field.attname)
+            plan.prefetch_related.append(Prefetch(
+                path,
+                queryset=related_plan.apply(
+                    field.related_model._default_manager.all()),
+            ))
+    return plan
+
+
+def optimize_queryset(queryset, info):
+    """
+    Restrict a queryset to what the current field selects
+    """
+    selections = []
+    for field_node in info.field_nodes:
+        selections.extend(get_node_selections(field_node, info.fragments))
+    plan = plan_selections(queryset.model, selections, info.fragments)
+    return plan.apply(queryset)
@@ -0,0 +1,319 @@
+"""
+Keyset (cursor-on-column) pagination for the crm connections.
+
+Offset cursors make deep pages scan and discard every earlier row and
+force a ``COUNT(*)`` per page. In keyset mode the cursor carries the
+ordering column values plus the primary key of the last row returned,
+so the next page is a ``WHERE (col, id) > (...)`` range read on an index
+and the total is only counted when ``totalCount`` is selected.
+"""
+import base64
+import json
+import graphene
+from asgiref.sync import sync_to_async
+from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import BooleanField, F, Func, Q, Value
+from graphql import GraphQLError
+from .aio import running_async
+from .fields import BatchedFilterConnectionField
+from .loaders import get_loaders
+
+
+KEYSET_PREFIX = 'keyset:'
+
+
+class CountableConnection(graphene.relay.Connection):
+    """
+    Connection exposing a lazily computed totalCount
+    """
+    class Meta:
+        abstract = True
+
+    total_count = graphene.Int()
+
+    # Counted as one more query by crm.cost
+    cost_weights = {'total_count': 1}
+    # Counted with the async ORM by the async view (see crm.aio)
+    async_fields = {'total_count'}
+
+    def resolve_total_count(self, info):
+        length = getattr(self, 'length', None)
+        if length is not None:
+            return length
+        if running_async():
+            return self.iterable.acount()
+        return self.iterable.count()
+
+
+def encode_keyset_cursor(values):
+    payload = json.dumps(values, cls=DjangoJSONEncoder)
+    return base64.b64encode(
+        (KEYSET_PREFIX + payload).encode('utf-8')).decode('ascii')
+
+
+def decode_keyset_cursor(cursor, keys):
+    """
+    Decode a cursor into python values for each ordering key
+    """
+    try:
+        decoded = base64.b64decode(cursor).decode('utf-8')
+        if not decoded.startswith(KEYSET_PREFIX):
+            raise ValueError
+        values = json.loads(decoded[len(KEYSET_PREFIX):])
+    except (ValueError, UnicodeDecodeError):
+        raise GraphQLError(f"Invalid keyset cursor: {cursor}")
+    if len(values) != len(keys):
+        raise GraphQLError("Keyset cursor does not match the ordering.")
+    return [
+        None if value is None else field.to_python(value)
+        for (field, _), value in zip(keys, values)
+    ]
+
+
+def get_keyset_keys(queryset):
+    """
+    Return (model field, descending) pairs for the queryset
+    ordering, ending with the primary key as a tie breaker
+    """
+    model = queryset.model
+    keys = []
+    for name in queryset.query.order_by:
+        if not isinstance(name, str):
+            raise GraphQLError("Keyset pagination needs plain field ordering.")
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == 'pk':
+            name = model._meta.pk.name
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise GraphQLError(
+                f"Keyset pagination cannot order by `{name}`.")
+        if not field.concrete or field.many_to_many:
+            raise GraphQLError(
+                f"Keyset pagination cannot order by `{name}`.")
+        keys.append((field, descending))
+        if field.primary_key:
+            return keys
+    keys.append((model._meta.pk, False))
+    return keys
+
+
+def _after_value(field, value, greater):
+    """
+    Condition for rows strictly after value on one column,
+    sorting NULL before every other value
+    """
+    name = field.attname
+    if greater:
+        if value is None:
+            return Q(**{f'{name}__isnull': False})
+        return Q(**{f'{name}__gt': value})
+    if value is None:
+        return Q(pk__in=[])
+    condition = Q(**{f'{name}__lt': value})
+    if field.null:
+        condition |= Q(**{f'{name}__isnull': True})
+    return condition
+
+
+def _equal_value(field, value):
+    if value is None:
+        return Q(**{f'{field.attname}__isnull': True})
+    return Q(**{field.attname: value})
+
+
+class RowAfter(Func):
+    """
+    Row value comparison ``(k1, k2, ...) > (v1, v2, ...)``, which
+    the database answers with one range seek on a (k1, k2, ...) index
+    """
+    output_field = BooleanField()
+
+    def __init__(self, keys, values, greater):
+        super().__init__(
+            *[F(field.attname) for field, _ in keys],
+            *[Value(value, output_field=field)
+              for (field, _), value in zip(keys, values)],
+        )
+        self.greater = greater
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sqls, params = [], []
+        for expression in self.source_expressions:
+            sql, expression_params = compiler.compile(expression)
+            sqls.append(sql)
+            params.extend(expression_params)
+        half = len(sqls) // 2
+        operator = '>' if self.greater else '<'
+        return (
+            f"({', '.join(sqls[:half])}) {operator} "
+            f"({', '.join(sqls[half:])})",
+            params,
+        )
+
+
+def keyset_condition(keys, values, backwards):
+    """
+    Build (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ... honoring
+    the direction of every key, or a single row value comparison
+    when the keys are NOT NULL and run in the same direction
+    """
+    directions = {descending for _, descending in keys}
+    if len(directions) == 1 and not any(field.null for field, _ in keys):
+        return RowAfter(keys, values, greater=directions.pop() == backwards)
+
+    condition = Q(pk__in=[])
+    equal = Q()
+    for (field, descending), value in zip(keys, values):
+        greater = descending == backwards
+        condition |= equal & _after_value(field, value, greater)
+        equal &= _equal_value(field, value)
+    return condition
+
+
+def keyset_ordering(keys, backwards):
+    """
+    Order by the keys, NULL first for nullable columns; NOT NULL
+    columns get no NULLS clause so a plain index can serve the order
+    """
+    ordering = []
+    for field, descending in keys:
+        column = F(field.attname)
+        if descending != backwards:
+            ordering.append(
+                column.desc(nulls_last=True) if field.null else column.desc())
+        else:
+            ordering.append(
+                column.asc(nulls_first=True) if field.null else column.asc())
+    return ordering
+
+
+def paginate_keyset(connection, queryset, args, max_limit=None):
+    """
+    Return a connection instance for one keyset page of queryset
+    """
+    if args.get('offset') is not None:
+        raise GraphQLError("`offset` cannot be combined with `keyset`.")
+    first = args.get('first')
+    last = args.get('last')
+    after = args.get('after')
+    before = args.get('before')
+    backwards = last is not None and first is None
+    limit = last if backwards else first
+    if limit is None:
+        limit = max_limit
+    if limit is not None and limit < 0:
+        raise GraphQLError("`first` and `last` must be non-negative.")
+
+    keys = get_keyset_keys(queryset)
+    page = queryset.order_by(*keyset_ordering(keys, backwards))
+    names = [f'keyset_{i}' for i in range(len(keys))]
+    page = page.annotate(**{
+        name: F(field.attname) for name, (field, _) in zip(names, keys)})
+
+    cursor = before if backwards else after
+    if cursor:
+        values = decode_keyset_cursor(cursor, keys)
+        page = page.filter(keyset_condition(keys, values, backwards))
+
+    nodes = list(page[:limit + 1] if limit is not None else page)
+    has_more = limit is not None and len(nodes) > limit
+    nodes = nodes[:limit] if limit is not None else nodes
+    if backwards:
+        nodes.reverse()
+
+    edges = [
+        connection.Edge(
+            node=node,
+            cursor=encode_keyset_cursor(
+                [getattr(node, name) for name in names]),
+        )
+        for node in nodes
+    ]
+    page_info = graphene.relay.PageInfo(
+        start_cursor=edges[0].cursor if edges else None,
+        end_cursor=edges[-1].cursor if edges else None,
+        has_previous_page=has_more if backwards else bool(after),
+        has_next_page=bool(before) if backwards else has_more,
+    )
+    result = connection(edges=edges, page_info=page_info)
+    result.iterable = queryset
+    result.length = None
+    return result
+
+
+class KeysetFilterConnectionField(BatchedFilterConnectionField):
+    """
+    Filter connection field with an opt-in ``keyset`` argument that
+    switches from offset cursors to keyset cursors
+    """
+    def __init__(self, type_, *args, **kwargs):
+        kwargs.setdefault('keyset', graphene.Boolean(
+            description="Paginate with keyset cursors on the ordering "
+                        "columns instead of offsets"))
+        super().__init__(type_, *args, **kwargs)
+
+    @classmethod
+    def connection_resolver(
+        cls,
+        resolver,
+        connection,
+        default_manager,
+        queryset_resolver,
+        max_limit,
+        enforce_first_or_last,
+        root,
+        info,
+        **args,
+    ):
+        if not args.get('keyset'):
+            return super().connection_resolver(
+                resolver,
+                connection,
+                default_manager,
+                queryset_resolver,
+                max_limit,
+                enforce_first_or_last,
+                root,
+                info,
+                **args,
+            )
+
+        if running_async():
+            # Keyset pages are read with the sync ORM off the loop
+            return sync_to_async(cls.connection_resolver)(
+                resolver,
+                connection,
+                default_manager,
+                queryset_resolver,
+                max_limit,
+                enforce_first_or_last,
+                root,
+                info,
+                **args,
+            )
+
+        first = args.get('first')
+        last = args.get('last')
+        if enforce_first_or_last and not (first or last):
+            raise GraphQLError(
+                f"You must provide a `first` or `last` value to properly "
+                f"paginate the `{info.field_name}` connection.")
+        if max_limit and max(first or 0, last or 0) > max_limit:
+            raise GraphQLError(
+                f"Requesting more than {max_limit} records on the "
+                f"`{info.field_name}` connection is not allowed.")
+
+        iterable = resolver(root, info, **args)
+        if iterable is None:
+            iterable = default_manager
+        queryset = queryset_resolver(connection, iterable, info, args)
+        if isinstance(queryset, list):
+            raise GraphQLError(
+                f"`{info.field_name}` does not support keyset pagination.")
+
+        result = paginate_keyset(connection, queryset, args, max_limit)
+        get_loaders(info).prime(edge.node for edge in result.edges)
+        return result
@@ -0,0 +1,166 @@
+"""
+Publish/subscribe of crm events feeding the GraphQL subscriptions.
+
+Writes publish their events once the transaction commits, so a
+subscriber never hears about rows it cannot read yet. Messages are
+small JSON documents of ids; subscriptions load the rows themselves.
+
+The default broker keeps subscribers in process, which serves a
+single ASGI server running both the mutations and the websockets.
+Set GRAPHQL_PUBSUB to 'redis' to route events through Redis pub/sub
+at GRAPHQL_PUBSUB_URL when mutations run in other processes (WSGI
+workers, Celery, cron jobs).
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
+
+
+logger = logging.getLogger(__name__)
+
+MEMORY = 'memory'
+REDIS = 'redis'
+
+ORDER_CREATED = 'crm.order_created'
+STOCK_CHANGED = 'crm.stock_changed'
+
+
+class InMemoryPubSub:
+    """
+    Broker delivering messages to the subscribers of this process.
+
+    publish may be called from any thread; every subscriber has a
+    bounded queue on its own event loop and misses the messages
+    published while its queue is full.
+    """
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscribers.get(channel, ()))
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, message)
+            except RuntimeError:
+                # The subscriber's loop is closed
+                self._remove(channel, (loop, queue))
+
+    @staticmethod
+    def _deliver(queue, message):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning('Dropped a pub/sub message for a slow subscriber')
+
+    def _remove(self, channel, subscriber):
+        with self._lock:
+            self._subscribers[channel].discard(subscriber)
+            if not self._subscribers[channel]:
+                del self._subscribers[channel]
+
+    async def subscribe(self, channel):
+        """
+        Yield the messages published on channel until closed
+        """
+        subscriber = (
+            asyncio.get_running_loop(), asyncio.Queue(self.queue_size))
+        with self._lock:
+            self._subscribers[channel].add(subscriber)
+        try:
+            while True:
+                yield await subscriber[1].get()
+        finally:
+            self._remove(channel, subscriber)
+
+
+class RedisPubSub:
+    """
+    Broker relaying messages through Redis pub/sub so that every
+    process subscribed to a channel receives them
+    """
+    prefix = 'crm:pubsub:'
+
+    def __init__(self, url):
+        import redis
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+
+    def publish(self, channel, message):
+        self.client.publish(self.prefix + channel, json.dumps(message))
+
+    async def subscribe(self, channel):
+        from redis import asyncio as aioredis
+        client = aioredis.Redis.from_url(self.url)
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self.prefix + channel)
+        try:
+            async for item in pubsub.listen():
+                if item['type'] == 'message':
+                    yield json.loads(item['data'])
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+
+_brokers = {}
+_lock = threading.Lock()
+
+
+def get_pubsub():
+    """
+    Return the broker selected by GRAPHQL_PUBSUB, shared per process
+    """
+    mode = getattr(settings, 'GRAPHQL_PUBSUB', MEMORY)
+    with _lock:
+        if mode not in _brokers:
+            if mode == REDIS:
+                _brokers[mode] = RedisPubSub(settings.GRAPHQL_PUBSUB_URL)
+            elif mode == MEMORY:
+                _brokers[mode] = InMemoryPubSub(
+                    getattr(settings, 'GRAPHQL_PUBSUB_QUEUE_SIZE', 1000))
+            else:
+                raise ValueError(f'Unknown GRAPHQL_PUBSUB {mode!r}')
+        return _brokers[mode]
+
+
+def publish_on_commit(channel, message):
+    """
+    Publish message once the current transaction commits
+    """
+    def publish():
+        try:
+            get_pubsub().publish(channel, message)
+        except Exception:
+            # The write is committed already; losing the event is
+            # better than failing the request
+            logger.exception('Could not publish to %s', channel)
+
+    transaction.on_commit(publish)
+
+
+def orders_created(order_ids):
+    order_ids = list(order_ids)
+    if order_ids:
+        publish_on_commit(ORDER_CREATED, {'ids': order_ids})
+
+
+def stock_changed(stock):
+    """
+    Publish (product id, stock) pairs once the current transaction
+    commits; callers read them in the transaction that wrote them, so
+    a later write can never be reported early
+    """
+    stock = [list(row) for row in stock]
+    if stock:
+        publish_on_commit(STOCK_CHANGED, {'products': stock})
@@ -0,0 +1,204 @@
+"""
+Weekly CRM report built from partitioned partial aggregates.
+
+The customer id space is split into ranges; each range is aggregated
+by its own Celery task (see crm.tasks.generate_crm_report) into
+per-customer revenue, product sales and signup-month cohorts. The
+ranges never share a customer, so the partials merge exactly: sums
+add up and the overall top customers are among the per-range tops.
+The merged report is cached and written as a JSON file.
+"""
+import heapq
+import json
+import os
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+from .models import Customer, Order, Product
+
+
+REPORT_CACHE_KEY = 'crm:report:latest'
+TOP = 20
+CENTS = Decimal('0.01')
+
+
+def get_report_cache():
+    return caches[getattr(settings, 'CRM_REPORT_CACHE', 'default')]
+
+
+def partition_customers(size):
+    """
+    Return [(first id, last id)] ranges of at most size ids
+    covering every customer
+    """
+    bounds = Customer.objects.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+    return [
+        (first, min(first + size - 1, bounds['high']))
+        for first in range(bounds['low'], bounds['high'] + 1, size)
+    ]
+
+
+def _month(value):
+    return value.strftime('%Y-%m')
+
+
+def aggregate_partition(first_id, last_id, top=TOP):
+    """
+    Return the JSON serializable partial aggregates of the
+    customers with ids in [first_id, last_id]
+    """
+    customers = Customer.objects.filter(pk__gte=first_id, pk__lte=last_id)
+    orders = Order.objects.filter(
+        customer_id__gte=first_id, customer_id__lte=last_id)
+    totals = orders.aggregate(orders=Count('pk'), revenue=Sum('total_amount'))
+
+    top_customers = (
+        orders
+        .values('customer_id', 'customer__name', 'customer__email')
+        .annotate(orders=Count('pk'), revenue=Sum('total_amount'))
+        .order_by('-revenue', 'customer_id')[:top]
+    )
+    products = (
+        Order.products.through.objects
+        .filter(
+            order__customer_id__gte=first_id,
+            order__customer_id__lte=last_id)
+        .values('product_id')
+        .annotate(units=Count('pk'), revenue=Sum('product__price'))
+    )
+
+    cohorts = defaultdict(lambda: {
+        'customers': 0, 'active_customers': 0, 'revenue': '0'})
+    signups = (
+        customers
+        .annotate(month=TruncMonth('created_at'))
+        .values('month')
+        .annotate(customers=Count('pk'))
+    )
+    for row in signups:
+        cohorts[_month(row['month'])]['customers'] = row['customers']
+    activity = (
+        orders
+        .annotate(month=TruncMonth('customer__created_at'))
+        .values('month')
+        .annotate(
+            active=Count('customer_id', distinct=True),
+            revenue=Sum('total_amount'))
+    )
+    for row in activity:
+        cohort = cohorts[_month(row['month'])]
+        cohort['active_customers'] = row['active']
+        cohort['revenue'] = str(row['revenue'])
+
+    return {
+        'customers': customers.count(),
+        'orders': totals['orders'],
+        'revenue': str(totals['revenue'] or 0),
+        'top_customers': [
+            {
+                'id': row['customer_id'],
+                'name': row['customer__name'],
+                'email': row['customer__email'],
+                'orders': row['orders'],
+                'revenue': str(row['revenue']),
+            }
+            for row in top_customers
+        ],
+        'products': {
+            str(row['product_id']): [row['units'], str(row['revenue'])]
+            for row in products
+        },
+        'cohorts': dict(cohorts),
+    }
+
+
+def merge_partials(partials, top=TOP):
+    """
+    Merge partition aggregates into the final report
+    """
+    report = {
+        'generated_at': timezone.now().isoformat(),
+        'partitions': len(partials),
+        'customers': 0,
+        'orders': 0,
+        'revenue': Decimal(0),
+    }
+    units = defaultdict(int)
+    product_revenue = defaultdict(Decimal)
+    cohorts = defaultdict(lambda: {
+        'customers': 0, 'active_customers': 0, 'revenue': Decimal(0)})
+    for partial in partials:
+        report['customers'] += partial['customers']
+        report['orders'] += partial['orders']
+        report['revenue'] += Decimal(partial['revenue'])
+        for product_id, (count, revenue) in partial['products'].items():
+            units[product_id] += count
+            product_revenue[product_id] += Decimal(revenue)
+        for month, values in partial['cohorts'].items():
+            cohort = cohorts[month]
+            cohort['customers'] += values['customers']
+            cohort['active_customers'] += values['active_customers']
+            cohort['revenue'] += Decimal(values['revenue'])
+
+    report['revenue'] = report['revenue'].quantize(CENTS)
+    report['top_customers'] = [
+        {**row, 'revenue': Decimal(row['revenue']).quantize(CENTS)}
+        for row in heapq.nlargest(
+            top,
+            (row for partial in partials for row in partial['top_customers']),
+            key=lambda row: (Decimal(row['revenue']), -row['id']),
+        )
+    ]
+    top_products = heapq.nlargest(
+        top, product_revenue, key=lambda pk: (product_revenue[pk], -int(pk)))
+    names = Product.objects.in_bulk([int(pk) for pk in top_products])
+    report['top_products'] = [
+        {
+            'id': int(pk),
+            'name': names[int(pk)].name if int(pk) in names else None,
+            'units': units[pk],
+            'revenue': product_revenue[pk].quantize(CENTS),
+        }
+        for pk in top_products
+    ]
+    report['cohorts'] = [
+        {
+            'month': month,
+            **cohorts[month],
+            'revenue': cohorts[month]['revenue'].quantize(CENTS),
+        }
+        for month in sorted(cohorts)
+    ]
+    # Round trip through JSON so the cached and written reports
+    # hold the same plain values
+    return json.loads(json.dumps(report, cls=DjangoJSONEncoder))
+
+
+def publish_report(report):
+    """
+    Cache the report and write it to CRM_REPORT_DIR,
+    returning the file path
+    """
+    get_report_cache().set(
+        REPORT_CACHE_KEY, report,
+        timeout=getattr(settings, 'CRM_REPORT_CACHE_TIMEOUT', None))
+    directory = getattr(settings, 'CRM_REPORT_DIR', '/tmp')
+    path = os.path.join(
+        directory, f'crm_report_{date.today().isoformat()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def get_latest_report():
+    return get_report_cache().get(REPORT_CACHE_KEY)
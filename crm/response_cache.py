@@ -0,0 +1,270 @@
+"""
+Response cache for read-only GraphQL operations.
+
+A query is cacheable when every root field it selects declares a
+``CacheHint`` in its type's ``cache_hints``. The cached response is
+keyed by the normalized document, the operation name, the variables,
+the user and the current version of every tag the operation reads.
+
+Tags are model labels (``crm.order``...) collected from the Django
+object types the document selects plus the explicit tags of its hints.
+Writes never delete entries: they bump the version of their tags (see
+crm.signals and the bulk write paths) so every key built from the old
+version becomes unreachable and simply expires.
+"""
+import json
+import time
+from dataclasses import dataclass, field
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from graphene.utils.str_converters import to_snake_case
+from graphql import (
+    FieldNode, OperationType, get_named_type, print_ast, visit)
+from graphql.utilities import TypeInfo
+from graphql.utilities.type_info import TypeInfoVisitor
+from graphql.language import Visitor
+from .documents import query_hash
+
+
+KEY_PREFIX = 'crm:response:'
+TAG_PREFIX = 'crm:tag:'
+HITS_KEY = 'crm:response-cache:hits'
+MISSES_KEY = 'crm:response-cache:misses'
+
+
+@dataclass(frozen=True)
+class CacheHint:
+    """
+    Maximum age in seconds of a field, and the tags it reads
+    beyond the models of the types it returns
+    """
+    ttl: int
+    tags: tuple = ()
+
+
+@dataclass
+class CachePlan:
+    ttl: int
+    tags: set = field(default_factory=set)
+
+
+def is_enabled():
+    return getattr(settings, 'GRAPHQL_RESPONSE_CACHE_ENABLED', False)
+
+
+def get_cache():
+    alias = getattr(settings, 'GRAPHQL_RESPONSE_CACHE', 'default')
+    return caches[alias]
+
+
+def is_process_local():
+    """
+    Whether the cache lives in this process only, where the writes of
+    other processes can neither invalidate nor be counted
+    """
+    return isinstance(get_cache(), (LocMemCache, DummyCache))
+
+
+def model_tag(model):
+    return model._meta.label_lower
+
+
+def _graphene_type(graphql_type):
+    return getattr(get_named_type(graphql_type), 'graphene_type', None)
+
+
+def _field_hint(parent_type, field_name):
+    graphene_type = _graphene_type(parent_type)
+    hints = getattr(graphene_type, 'cache_hints', None) or {}
+    return hints.get(to_snake_case(field_name))
+
+
+class _TagCollector(Visitor):
+    def __init__(self, type_info, plan):
+        super().__init__()
+        self.type_info = type_info
+        self.plan = plan
+
+    def enter_field(self, node, *args):
+        parent_type = self.type_info.get_parent_type()
+        if parent_type is not None:
+            hint = _field_hint(parent_type, node.name.value)
+            if hint is not None:
+                self.plan.ttl = min(self.plan.ttl, hint.ttl)
+                self.plan.tags.update(hint.tags)
+        self.add_type(self.type_info.get_type())
+
+    def enter_inline_fragment(self, node, *args):
+        self.add_type(self.type_info.get_type())
+
+    def enter_fragment_definition(self, node, *args):
+        self.add_type(self.type_info.get_type())
+
+    def add_type(self, graphql_type):
+        if graphql_type is None:
+            return
+        meta = getattr(_graphene_type(graphql_type), '_meta', None)
+        # A connection reads its node's model even when only
+        # totalCount is selected
+        node = getattr(meta, 'node', None)
+        if node is not None:
+            meta = getattr(node, '_meta', None)
+        model = getattr(meta, 'model', None)
+        if model is not None:
+            self.plan.tags.add(model_tag(model))
+
+
+def get_plan(schema, document, operation_ast):
+    """
+    Return the CachePlan of a validated operation,
+    or None when it must not be cached
+    """
+    if (
+        operation_ast is None
+        or operation_ast.operation != OperationType.QUERY
+    ):
+        return None
+
+    plan = None
+    for selection in operation_ast.selection_set.selections:
+        if not isinstance(selection, FieldNode):
+            return None
+        if selection.name.value == '__typename':
+            continue
+        hint = _field_hint(schema.query_type, selection.name.value)
+        if hint is None:
+            return None
+        if plan is None:
+            plan = CachePlan(ttl=hint.ttl)
+        plan.ttl = min(plan.ttl, hint.ttl)
+    if plan is None or plan.ttl <= 0:
+        return None
+
+    # Fragments of other operations in the document are visited too,
+    # which can only add tags
+    type_info = TypeInfo(schema)
+    collector = _TagCollector(type_info, plan)
+    visit(document, TypeInfoVisitor(type_info, collector))
+    return plan if plan.ttl > 0 else None
+
+
+def get_tag_versions(cache, tags):
+    """
+    Return {tag: version}, creating missing versions. A missing
+    version starts at the current time so that a tag evicted from
+    the cache never comes back at a version already used
+    """
+    keys = [TAG_PREFIX + tag for tag in sorted(tags)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def _user_key(request):
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return None
+    return user.pk
+
+
+def make_key(plan, document, operation_name, variables, request):
+    """
+    Return the cache key of an operation at the current tag versions
+    """
+    payload = json.dumps(
+        [
+            print_ast(document),
+            operation_name,
+            variables or {},
+            _user_key(request),
+            sorted(get_tag_versions(get_cache(), plan.tags).items()),
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return KEY_PREFIX + query_hash(payload)
+
+
+def get_response(key):
+    """
+    Return the cached data for key, or None, counting hits and misses
+    """
+    cache = get_cache()
+    data = cache.get(key)
+    _count(cache, MISSES_KEY if data is None else HITS_KEY)
+    return data
+
+
+def lookup(plan, document, operation_name, variables, request):
+    """
+    Return (key, cached data or None) for an operation
+    """
+    key = make_key(plan, document, operation_name, variables, request)
+    return key, get_response(key)
+
+
+def set_response(key, data, ttl):
+    get_cache().set(key, data, timeout=ttl)
+
+
+def _count(cache, key):
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add and incr
+        cache.set(key, 1, timeout=None)
+
+
+def get_stats():
+    cache = get_cache()
+    counts = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits = counts.get(HITS_KEY, 0)
+    misses = counts.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else 0.0,
+    }
+
+
+def reset_stats():
+    get_cache().delete_many([HITS_KEY, MISSES_KEY])
+
+
+def bump_tags(tags):
+    cache = get_cache()
+    for tag in tags:
+        key = TAG_PREFIX + tag
+        cache.add(key, time.time_ns(), timeout=None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), timeout=None)
+
+
+def invalidate(*tags):
+    """
+    Make every cached response reading one of tags unreachable.
+
+    The bump is repeated when the current transaction commits, since
+    a response cached between the write and the commit still holds
+    the old rows.
+    """
+    tags = set(tags)
+    if not tags:
+        return
+    bump_tags(tags)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: bump_tags(tags))
+
+
+def invalidate_models(*models):
+    invalidate(*(model_tag(model) for model in models))
@@ -1,17 +1,86 @@
 import graphene
 from django.db import transaction
-from django.db.models import Sum
 from graphql import GraphQLError
 from graphene_django.types import DjangoObjectType
-from graphene_django.filter import DjangoFilterConnectionField
+from graphene_django.utils import bypass_get_queryset
 from graphene import relay
-from .models import Customer, Order
+from .models import CRMStats, Customer, InsufficientStock, Order
 from crm.models import Product
 from .serializer import OrderSerializers, ProductSerializer, CustomerSerializer
 from .filters import ProductFilter, CustomerFilter, OrderFilter
+from .fields import BatchedFilterConnectionField, has_filter_args
+from .loaders import get_loaders
+from .optimizer import optimize_queryset
+from .pagination import CountableConnection, KeysetFilterConnectionField
+from .analytics import sales_timeseries
+from .aio import running_async
+from .bulk import bulk_create_customers, bulk_create_orders
+from . import pubsub, search as search_index
+from .response_cache import CacheHint
 import json
 
 
+# =====================================
+# Batched Resolvers
+# =====================================
+def get_prefetched(obj, name):
+    """
+    Return the prefetched objects of a relation, or None
+    when the optimizer did not prefetch it
+    """
+    cache = getattr(obj, '_prefetched_objects_cache', {})
+    if name in cache:
+        return list(cache[name])
+    return None
+
+
+@bypass_get_queryset
+def resolve_order_customer(order, info):
+    """
+    Resolve an order's customer through the customer loader
+    """
+    if Order.customer.is_cached(order):
+        return order.customer
+    return get_loaders(info).customer.load(order.customer_id)
+
+
+def resolve_order_products(order, info, **kwargs):
+    """
+    Resolve an order's products through the M2M loader, falling
+    back to a queryset when the client filters the connection
+    """
+    if has_filter_args(kwargs):
+        return order.products.all()
+    prefetched = get_prefetched(order, 'products')
+    if prefetched is not None:
+        return prefetched
+    return get_loaders(info).products_by_order.load(order.pk)
+
+
+def resolve_customer_orders(customer, info, **kwargs):
+    """
+    Resolve a customer's orders through the orders loader
+    """
+    if has_filter_args(kwargs):
+        return customer.orders.all()
+    prefetched = get_prefetched(customer, 'orders')
+    if prefetched is not None:
+        return prefetched
+    return get_loaders(info).orders_by_customer.load(customer.pk)
+
+
+def resolve_product_orders(product, info, **kwargs):
+    """
+    Resolve the orders containing a product through the M2M loader
+    """
+    if has_filter_args(kwargs):
+        return product.orders.all()
+    prefetched = get_prefetched(product, 'orders')
+    if prefetched is not None:
+        return prefetched
+    return get_loaders(info).orders_by_product.load(product.pk)
+
+
 # =====================================
 # Types
 # =====================================
@@ -27,6 +96,7 @@ class ProductType(DjangoObjectType):
 
 class OrderType(DjangoObjectType):
     total_amount = graphene.Decimal()
+    products = BatchedFilterConnectionField(lambda: ProductNode)
 
     class Meta:
         model = Order
@@ -40,6 +110,9 @@ class OrderType(DjangoObjectType):
         filterset_class = OrderFilter
         interfaces = (graphene.relay.Node,)
 
+    resolve_customer = resolve_order_customer
+    resolve_products = resolve_order_products
+
 
 class StatsType(graphene.ObjectType):
     total_customers = graphene.Int()
@@ -47,6 +120,33 @@ class StatsType(graphene.ObjectType):
     total_revenue = graphene.Decimal()
 
 
+class RowErrorType(graphene.ObjectType):
+    index = graphene.Int()
+    field = graphene.String()
+    messages = graphene.List(graphene.String)
+
+
+def row_errors(errors):
+    return [
+        RowErrorType(
+            index=error.index, field=error.field, messages=error.messages)
+        for error in errors
+    ]
+
+
+class SalesGranularity(graphene.Enum):
+    DAY = 'day'
+    WEEK = 'week'
+    MONTH = 'month'
+
+
+class SalesBucketType(graphene.ObjectType):
+    bucket = graphene.Date()
+    order_count = graphene.Int()
+    revenue = graphene.Decimal()
+    customer_count = graphene.Int()
+
+
 # =============================================
 # Inputs to Mutation
 # =============================================
@@ -97,30 +197,23 @@ class BulkCreateCustomers(graphene.Mutation):
     """
     class Arguments:
         input = graphene.List(CustomerInput)
+        batch_size = graphene.Int()
+        update_existing = graphene.Boolean(default_value=False)
 
     customers = graphene.List(CustomerType)
-    errors = graphene.String()
-
-    def mutate(self, info, input):
-        valid_customers = []
-        errors = []
-
-        for i, data in enumerate(input):
-            serializer = CustomerSerializer(data=data)
-            if not serializer.is_valid():
-                errors.append(serializer.errors)
-                continue
-
-            valid_customers.append(Customer(**serializer.validated_data))
-
-        created_customers = []
-        if valid_customers:
-            with transaction.atomic():
-                created_customers = Customer.objects.bulk_create(
-                    valid_customers)
-
+    created = graphene.Int()
+    errors = graphene.List(graphene.NonNull(RowErrorType))
+
+    def mutate(self, info, input, batch_size=None, update_existing=False):
+        if batch_size is not None and batch_size < 1:
+            raise GraphQLError("`batchSize` must be positive.")
+        result = bulk_create_customers(
+            input, batch_size=batch_size, update_existing=update_existing)
         return BulkCreateCustomers(
-            customers=created_customers, errors=json.dumps(errors))
+            customers=result.objects,
+            created=result.created,
+            errors=row_errors(result.errors),
+        )
 
 
 class CreateProduct(graphene.Mutation):
@@ -162,49 +255,161 @@ class CreateOrder(graphene.Mutation):
         if not serializer.is_valid():
             raise GraphQLError(json.dumps(serializer.errors))
 
-        order = serializer.save()
+        products = serializer.validated_data['products']
+        try:
+            with transaction.atomic():
+                Product.objects.reserve_stock({p.pk: 1 for p in products})
+                order = serializer.save()
+        except InsufficientStock as e:
+            names = [p.name for p in products if p.pk in e.product_ids]
+            raise GraphQLError(
+                f"Insufficient stock for: {', '.join(names)}.",
+                extensions={
+                    'code': 'INSUFFICIENT_STOCK',
+                    'productIds': e.product_ids,
+                },
+            )
         return CreateOrder(order=order)
 
 
+class BulkCreateOrders(graphene.Mutation):
+    """
+    Bulk Create Order Mutation
+    """
+    class Arguments:
+        input = graphene.List(graphene.NonNull(OrderInput), required=True)
+        batch_size = graphene.Int()
+
+    orders = graphene.List(OrderType)
+    errors = graphene.List(graphene.NonNull(RowErrorType))
+
+    def mutate(self, info, input, batch_size=None):
+        if batch_size is not None and batch_size < 1:
+            raise GraphQLError("`batchSize` must be positive.")
+        result = bulk_create_orders(input, batch_size=batch_size)
+        return BulkCreateOrders(
+            orders=result.objects,
+            errors=row_errors(result.errors),
+        )
+
+
 class UpdateLowStockProducts(graphene.Mutation):
     """
     Update Low Stock Products Mutaton
     """
-    products = graphene.List(ProductType)
+    class Arguments:
+        threshold = graphene.Int(default_value=10)
+        increment = graphene.Int(default_value=10)
+        limit = graphene.Int()
+
+    count = graphene.Int()
+    product_ids = graphene.List(graphene.NonNull(graphene.ID))
+    products = graphene.List(
+        ProductType, deprecation_reason="Use `changedProducts`.")
+    changed_products = BatchedFilterConnectionField(lambda: ProductNode)
     message = graphene.String()
 
-    def mutate(self, info):
-        products = Product.objects.filter(stock__lt=10)
-        for p in products:
-            p.stock = p.stock + 10
-        Product.objects.bulk_update(products, ['stock'])
-
+    def mutate(self, info, threshold=10, increment=10, limit=None):
+        if increment < 1:
+            raise GraphQLError("`increment` must be positive.")
+        if limit is not None and limit < 1:
+            raise GraphQLError("`limit` must be positive.")
+        ids = Product.objects.restock_below(threshold, increment, limit)
         return UpdateLowStockProducts(
-            products=products, message='Low stocks updated successfully!')
+            count=len(ids),
+            product_ids=ids,
+            message='Low stocks updated successfully!')
+
+    def resolve_products(self, info):
+        return Product.objects.filter(pk__in=self.product_ids).order_by('pk')
+
+    def resolve_changed_products(self, info, **kwargs):
+        return Product.objects.filter(pk__in=self.product_ids)
 
 
 # ==============================================
 # Query Nodes
 # ===============================================
 class CustomerNode(DjangoObjectType):
+    orders = BatchedFilterConnectionField(lambda: OrderNode)
+
     class Meta:
         model = Customer
         filterset_class = CustomerFilter
         interfaces = (graphene.relay.Node,)
+        connection_class = CountableConnection
+
+    resolve_orders = resolve_customer_orders
+
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        return optimize_queryset(queryset, info)
 
 
 class ProductNode(DjangoObjectType):
+    orders = BatchedFilterConnectionField(lambda: OrderNode)
+
     class Meta:
         model = Product
         filterset_class = ProductFilter
         interfaces = (graphene.relay.Node,)
+        connection_class = CountableConnection
+
+    # Stock moves with every order, keep it fresher than the rest
+    cache_hints = {
+        'stock': CacheHint(ttl=10),
+    }
+
+    resolve_orders = resolve_product_orders
+
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        return optimize_queryset(queryset, info)
 
 
 class OrderNode(DjangoObjectType):
+    products = BatchedFilterConnectionField(ProductNode)
+
     class Meta:
         model = Order
         filterset_class = OrderFilter
         interfaces = (graphene.relay.Node,)
+        connection_class = CountableConnection
+
+    resolve_customer = resolve_order_customer
+    resolve_products = resolve_order_products
+
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        return optimize_queryset(queryset, info)
+
+
+class SearchType(graphene.Enum):
+    CUSTOMER = search_index.CUSTOMER
+    PRODUCT = search_index.PRODUCT
+    ORDER = search_index.ORDER
+
+
+class SearchResult(graphene.Union):
+    class Meta:
+        types = (CustomerNode, ProductNode, OrderNode)
+
+
+class SearchHitType(graphene.ObjectType):
+    rank = graphene.Float()
+    node = graphene.Field(SearchResult)
+
+
+def stats_type(snapshot):
+    return StatsType(
+        total_customers=snapshot.total_customers,
+        total_orders=snapshot.total_orders,
+        total_revenue=snapshot.total_revenue,
+    )
+
+
+async def resolve_stats_async():
+    return stats_type(await CRMStats.objects.aget_snapshot())
 
 
 # =============================================
@@ -212,30 +417,76 @@ class OrderNode(DjangoObjectType):
 # ==============================================
 class Query(graphene.ObjectType):
     customer = relay.Node.Field(CustomerNode)
-    all_customers = DjangoFilterConnectionField(CustomerNode)
+    all_customers = KeysetFilterConnectionField(CustomerNode)
 
     product = relay.Node.Field(ProductNode)
-    all_products = DjangoFilterConnectionField(ProductNode)
+    all_products = KeysetFilterConnectionField(ProductNode)
 
     order = relay.Node.Field(OrderNode)
-    all_orders = DjangoFilterConnectionField(OrderNode)
+    all_orders = KeysetFilterConnectionField(OrderNode)
 
     stats = graphene.Field(StatsType)
 
+    sales_timeseries = graphene.List(
+        graphene.NonNull(SalesBucketType),
+        granularity=SalesGranularity(required=True),
+        from_=graphene.Date(required=True, name='from'),
+        to=graphene.Date(required=True),
+        customer_id=graphene.ID(),
+        product_id=graphene.ID(),
+    )
+
+    search = graphene.List(
+        graphene.NonNull(SearchHitType),
+        query=graphene.String(required=True),
+        types=graphene.List(graphene.NonNull(SearchType)),
+        first=graphene.Int(default_value=10),
+    )
+
+    # Root fields without a hint are never served from the cache
+    cache_hints = {
+        'customer': CacheHint(ttl=60),
+        'all_customers': CacheHint(ttl=60),
+        'product': CacheHint(ttl=60),
+        'all_products': CacheHint(ttl=60),
+        'order': CacheHint(ttl=60),
+        'all_orders': CacheHint(ttl=60),
+        'stats': CacheHint(ttl=30, tags=(
+            'crm.crmstats', 'crm.customer', 'crm.order', 'crm.product')),
+        'sales_timeseries': CacheHint(ttl=300, tags=(
+            'crm.salesrollup', 'crm.order')),
+        'search': CacheHint(ttl=60, tags=(
+            'crm.customer', 'crm.product', 'crm.order')),
+    }
+
+    # Resolved on the event loop by the async view (see crm.aio)
+    async_fields = {'stats', 'all_customers', 'all_products', 'all_orders'}
+
     def resolve_stats(self, info):
-        total_customers = Customer.objects.count()
-        total_orders = Order.objects.count()
-        total_revenue = (
-            Order.objects
-            .values('products__price')
-            .aggregate(total=Sum('products__price'))
-        )['total'] or 0
-
-        return StatsType(
-            total_customers=total_customers,
-            total_orders=total_orders,
-            total_revenue=total_revenue,
+        if running_async():
+            return resolve_stats_async()
+        return stats_type(CRMStats.objects.get_snapshot())
+
+    def resolve_sales_timeseries(
+            self, info, granularity, from_, to,
+            customer_id=None, product_id=None):
+        if from_ > to:
+            raise GraphQLError("`from` must not be after `to`.")
+        rows = sales_timeseries(
+            granularity.value,
+            from_,
+            to,
+            customer_id=customer_id,
+            product_id=product_id,
         )
+        return [SalesBucketType(**row) for row in rows]
+
+    def resolve_search(self, info, query, types=None, first=10):
+        if not 0 < first <= 100:
+            raise GraphQLError("`first` must be between 1 and 100.")
+        types = [t.value for t in types] if types else None
+        hits = search_index.search(query, types=types, limit=first)
+        return [SearchHitType(rank=rank, node=obj) for obj, rank in hits]
 
 
 class Mutation(graphene.ObjectType):
@@ -243,4 +494,44 @@ class Mutation(graphene.ObjectType):
     bulk_create_customers = BulkCreateCustomers.Field()
     create_product = CreateProduct.Field()
     create_order = CreateOrder.Field()
+    bulk_create_orders = BulkCreateOrders.Field()
     update_low_stock_products = UpdateLowStockProducts.Field()
+
+
+# ==============================================
+# Subscriptions
+# ===============================================
+class Subscription(graphene.ObjectType):
+    """
+    Events published by the crm writes (see crm.pubsub), served over
+    websockets by crm.subscriptions. The subscribe_ generators run on
+    the event loop and yield ids; each event is then resolved like a
+    query on a worker thread.
+    """
+    order_created = graphene.Field(OrderNode)
+    product_stock_changed = graphene.Field(
+        ProductNode,
+        threshold=graphene.Int(
+            description="Only report products whose stock fell below"),
+    )
+
+    async def subscribe_order_created(root, info):
+        async for message in pubsub.get_pubsub().subscribe(
+                pubsub.ORDER_CREATED):
+            for pk in message['ids']:
+                yield pk
+
+    async def subscribe_product_stock_changed(root, info, threshold=None):
+        async for message in pubsub.get_pubsub().subscribe(
+                pubsub.STOCK_CHANGED):
+            for pk, stock in message['products']:
+                if threshold is None or stock < threshold:
+                    yield pk
+
+    def resolve_order_created(root, info):
+        return OrderNode.get_queryset(
+            Order.objects.filter(pk=root), info).first()
+
+    def resolve_product_stock_changed(root, info, threshold=None):
+        return ProductNode.get_queryset(
+            Product.objects.filter(pk=root), info).first()
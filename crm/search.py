@@ -0,0 +1,223 @@
+"""
+Full-text search over customers, products and orders.
+
+Every searchable object owns one document in a backend specific index:
+an FTS5 virtual table on SQLite and a tsvector column with a GIN index
+on PostgreSQL (both created by migration 0010). Documents are rewritten
+from crm.signals and by the bulk write paths, and ranked lookups go to
+the index instead of ``LIKE '%x%'`` scans over the source tables.
+"""
+import re
+from collections import defaultdict
+from django.db import connection
+from graphql import GraphQLError
+from .models import Customer, Order, Product
+
+
+CUSTOMER = 'customer'
+PRODUCT = 'product'
+ORDER = 'order'
+
+# Documents are keyed by object_id * 4 + type code so that an update
+# or delete is a primary key lookup on both backends
+TYPE_CODES = {CUSTOMER: 1, PRODUCT: 2, ORDER: 3}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+MODELS = {CUSTOMER: Customer, PRODUCT: Product, ORDER: Order}
+
+TABLE = 'crm_search'
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def document_key(object_type, object_id):
+    return int(object_id) * 4 + TYPE_CODES[object_type]
+
+
+def split_key(key):
+    return TYPE_NAMES[key % 4], key // 4
+
+
+def build_documents(object_type, ids):
+    """
+    Return {object id: document text} for the given objects
+    """
+    ids = list(ids)
+    if object_type == CUSTOMER:
+        rows = Customer.objects.filter(pk__in=ids).values_list(
+            'pk', 'name', 'email')
+        return {pk: f'{name} {email}' for pk, name, email in rows}
+    if object_type == PRODUCT:
+        rows = Product.objects.filter(pk__in=ids).values_list('pk', 'name')
+        return {pk: name for pk, name in rows}
+
+    documents = {
+        pk: f'{name} {email}'
+        for pk, name, email in Order.objects.filter(pk__in=ids).values_list(
+            'pk', 'customer__name', 'customer__email')
+    }
+    product_names = defaultdict(list)
+    links = Order.products.through.objects.filter(
+        order_id__in=documents).values_list('order_id', 'product__name')
+    for order_id, name in links:
+        product_names[order_id].append(name)
+    return {
+        pk: ' '.join([text, *product_names[pk]])
+        for pk, text in documents.items()
+    }
+
+
+def chunked(items, size=500):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SQLiteSearchBackend:
+    def upsert(self, object_type, documents):
+        self.delete(object_type, documents)
+        with connection.cursor() as cursor:
+            for chunk in chunked(documents.items()):
+                values = ', '.join(['(%s, %s)'] * len(chunk))
+                params = []
+                for pk, body in chunk:
+                    params.extend([document_key(object_type, pk), body])
+                cursor.execute(
+                    f'INSERT INTO {TABLE} (rowid, body) VALUES {values}',
+                    params)
+
+    def delete(self, object_type, ids):
+        with connection.cursor() as cursor:
+            for chunk in chunked(ids):
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(
+                    f'DELETE FROM {TABLE} WHERE rowid IN ({placeholders})',
+                    [document_key(object_type, pk) for pk in chunk])
+
+    def search(self, tokens, types, limit):
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        sql = (
+            f'SELECT rowid, bm25({TABLE}) AS score FROM {TABLE} '
+            f'WHERE {TABLE} MATCH %s'
+        )
+        params = [match]
+        if types:
+            codes = ', '.join(str(TYPE_CODES[t]) for t in types)
+            sql += f' AND rowid %% 4 IN ({codes})'
+        sql += ' ORDER BY score LIMIT %s'
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            # bm25 is lower for better matches
+            return [(key, -score) for key, score in cursor.fetchall()]
+
+
+class PostgresSearchBackend:
+    def upsert(self, object_type, documents):
+        with connection.cursor() as cursor:
+            for chunk in chunked(documents.items()):
+                values = ', '.join(
+                    ["(%s, %s, to_tsvector('simple', %s))"] * len(chunk))
+                params = []
+                for pk, body in chunk:
+                    params.extend([
+                        document_key(object_type, pk),
+                        TYPE_CODES[object_type],
+                        body,
+                    ])
+                cursor.execute(
+                    f'INSERT INTO {TABLE} (key, object_type, document) '
+                    f'VALUES {values} '
+                    f'ON CONFLICT (key) DO UPDATE '
+                    f'SET document = EXCLUDED.document',
+                    params)
+
+    def delete(self, object_type, ids):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {TABLE} WHERE key = ANY(%s)',
+                [[document_key(object_type, pk) for pk in ids]],
+            )
+
+    def search(self, tokens, types, limit):
+        tsquery = ' & '.join(f'{token}:*' for token in tokens)
+        sql = (
+            f"SELECT key, ts_rank_cd(document, to_tsquery('simple', %s)) "
+            f'AS score FROM {TABLE} '
+            f"WHERE document @@ to_tsquery('simple', %s)"
+        )
+        params = [tsquery, tsquery]
+        if types:
+            sql += ' AND object_type = ANY(%s)'
+            params.append([TYPE_CODES[t] for t in types])
+        sql += ' ORDER BY score DESC LIMIT %s'
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_backend():
+    backend = BACKENDS.get(connection.vendor)
+    if backend is None:
+        return None
+    return backend()
+
+
+def index_objects(object_type, ids):
+    """
+    Write (or rewrite) the search documents of the given objects
+    """
+    backend = get_backend()
+    ids = [pk for pk in ids if pk is not None]
+    if backend is None or not ids:
+        return
+    documents = build_documents(object_type, ids)
+    if documents:
+        backend.upsert(object_type, documents)
+    missing = set(ids) - set(documents)
+    if missing:
+        backend.delete(object_type, missing)
+
+
+def unindex_objects(object_type, ids):
+    backend = get_backend()
+    ids = [pk for pk in ids if pk is not None]
+    if backend is not None and ids:
+        backend.delete(object_type, ids)
+
+
+def search(query, types=None, limit=10):
+    """
+    Return [(object, rank)] best matches first; every word of
+    the query must match as a word prefix
+    """
+    backend = get_backend()
+    if backend is None:
+        raise GraphQLError(
+            f"Search is not available on the {connection.vendor} "
+            f"database; it requires {' or '.join(sorted(BACKENDS))}.")
+    tokens = TOKEN_RE.findall(query.lower())
+    if not tokens:
+        return []
+
+    hits = [
+        (*split_key(key), score)
+        for key, score in backend.search(tokens, types, limit)
+    ]
+    ids_by_type = defaultdict(list)
+    for object_type, object_id, _ in hits:
+        ids_by_type[object_type].append(object_id)
+    objects = {
+        object_type: MODELS[object_type].objects.in_bulk(ids)
+        for object_type, ids in ids_by_type.items()
+    }
+    return [
+        (objects[object_type][object_id], score)
+        for object_type, object_id, score in hits
+        if object_id in objects[object_type]
+    ]
@@ -3,6 +3,10 @@ from .models import Customer, Product, Order
 import re
 
 
+PHONE_RE = re.compile(r"^(\+\d{1,15}|(\d{3}-\d{3}-\d{4}))$")
+PHONE_ERROR = "Invalid phone number format. Use +1234567890 or 123-456-7890."
+
+
 class CustomerSerializer(serializers.ModelSerializer):
     class Meta:
         model = Customer
@@ -13,11 +17,8 @@ class CustomerSerializer(serializers.ModelSerializer):
         """
         Validate phone format (e.g., +1234567890 or 123-456-7890)
         """
-        pattern = re.compile(r"^(\+\d{1,15}|(\d{3}-\d{3}-\d{4}))$")
-        if not pattern.match(str(value)):
-            raise serializers.ValidationError(
-                "Invalid phone number format. Use +1234567890 or 123-456-7890."
-            )
+        if not PHONE_RE.match(str(value)):
+            raise serializers.ValidationError(PHONE_ERROR)
         return value
 
 
@@ -37,4 +38,4 @@ class OrderSerializers(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ['customer', 'products', 'total_amount', 'order_date']
-        read_only_fields = ['id']
+        read_only_fields = ['id', 'total_amount']
@@ -1,5 +1,5 @@
 from pathlib import Path
-from django_crontab import crontab
+from celery.schedules import crontab
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
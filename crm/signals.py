@@ -0,0 +1,209 @@
+"""
+Signal handlers keeping denormalized crm data in sync
+"""
+from django.db.models import Sum
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete, pre_save)
+from django.dispatch import receiver
+from . import pubsub, response_cache, search
+from .analytics import mark_days_dirty
+from .models import CRMStats, Customer, Order, Product
+
+
+def recompute_order_totals(order_ids):
+    """
+    Recompute the stored totals of the given orders and
+    apply the revenue difference to the stats snapshot
+    """
+    orders = Order.objects.filter(pk__in=list(order_ids))
+    before = orders.aggregate(total=Sum('total_amount'))['total'] or 0
+    orders.update_total_amounts()
+    after = orders.aggregate(total=Sum('total_amount'))['total'] or 0
+    CRMStats.objects.increment(revenue=after - before)
+    if after != before:
+        mark_days_dirty(orders.values_list('order_date', flat=True).distinct())
+
+
+@receiver(m2m_changed, sender=Order.products.through)
+def sync_orders_on_products_change(
+        sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Recompute order totals and search documents when products are
+    added to or removed from orders, from either side of the relation
+    """
+    if action == 'pre_clear' and reverse:
+        # pk_set is not provided on clear, remember the orders now
+        instance._cleared_order_ids = list(
+            instance.orders.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        order_ids = [instance.pk]
+    elif action == 'post_clear':
+        order_ids = instance.__dict__.pop('_cleared_order_ids', [])
+    else:
+        order_ids = list(pk_set or [])
+    recompute_order_totals(order_ids)
+    search.index_objects(search.ORDER, order_ids)
+    if not reverse:
+        instance.refresh_from_db(fields=['total_amount'])
+
+
+@receiver(pre_save, sender=Product)
+def remember_previous_price_and_name(
+        sender, instance, update_fields=None, **kwargs):
+    if instance._state.adding:
+        return
+    if update_fields is not None and not {'price', 'name'} & update_fields:
+        return
+    previous = (
+        Product.objects
+        .filter(pk=instance.pk)
+        .values_list('price', 'name')
+        .first()
+    )
+    if previous is not None:
+        instance._previous_price, instance._previous_name = previous
+
+
+@receiver(post_save, sender=Product)
+def update_order_totals_on_price_change(sender, instance, created, **kwargs):
+    """
+    Recompute the totals of orders containing a product
+    when the product is saved with a new price
+    """
+    previous = instance.__dict__.pop('_previous_price', None)
+    if created:
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and 'price' not in update_fields:
+        return
+    if previous is not None and previous == instance.price:
+        return
+    recompute_order_totals(
+        instance.orders.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Product)
+def remember_orders_of_deleted_product(sender, instance, **kwargs):
+    instance._deleted_order_ids = list(
+        instance.orders.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def update_orders_on_product_delete(sender, instance, **kwargs):
+    """
+    Recompute the totals and search documents of orders
+    that contained a deleted product
+    """
+    order_ids = instance.__dict__.pop('_deleted_order_ids', [])
+    recompute_order_totals(order_ids)
+    search.index_objects(search.ORDER, order_ids)
+    search.unindex_objects(search.PRODUCT, [instance.pk])
+
+
+@receiver(post_save, sender=Customer)
+def count_created_customer(sender, instance, created, **kwargs):
+    if created:
+        CRMStats.objects.increment(customers=1)
+
+
+@receiver(post_delete, sender=Customer)
+def count_deleted_customer(sender, instance, **kwargs):
+    CRMStats.objects.increment(customers=-1)
+
+
+@receiver(pre_save, sender=Order)
+def remember_previous_order_date(sender, instance, **kwargs):
+    if instance._state.adding:
+        return
+    instance._previous_order_date = (
+        Order.objects
+        .filter(pk=instance.pk)
+        .values_list('order_date', flat=True)
+        .first()
+    )
+
+
+@receiver(post_save, sender=Order)
+def count_created_order(sender, instance, created, **kwargs):
+    if created:
+        CRMStats.objects.increment(
+            orders=1, revenue=instance.total_amount or 0)
+    previous = instance.__dict__.pop('_previous_order_date', None)
+    mark_days_dirty([instance.order_date, previous])
+
+
+@receiver(post_delete, sender=Order)
+def count_deleted_order(sender, instance, **kwargs):
+    CRMStats.objects.increment(
+        orders=-1, revenue=-(instance.total_amount or 0))
+    mark_days_dirty([instance.order_date])
+
+
+@receiver(post_save, sender=Customer)
+def index_customer(sender, instance, created, **kwargs):
+    """
+    Rewrite the search documents of a saved customer and,
+    on update, of its orders which embed its name and email
+    """
+    search.index_objects(search.CUSTOMER, [instance.pk])
+    if not created:
+        search.index_objects(
+            search.ORDER, instance.orders.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Customer)
+def unindex_customer(sender, instance, **kwargs):
+    search.unindex_objects(search.CUSTOMER, [instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, created, **kwargs):
+    """
+    Rewrite the search documents of a saved product and,
+    when its name changed, of the orders containing it
+    """
+    search.index_objects(search.PRODUCT, [instance.pk])
+    previous = instance.__dict__.pop('_previous_name', None)
+    update_fields = kwargs.get('update_fields')
+    if created or (update_fields is not None and 'name' not in update_fields):
+        return
+    if previous is not None and previous == instance.name:
+        return
+    search.index_objects(
+        search.ORDER, instance.orders.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Order)
+def index_order(sender, instance, **kwargs):
+    search.index_objects(search.ORDER, [instance.pk])
+
+
+@receiver(post_save, sender=Order)
+def publish_created_order(sender, instance, created, **kwargs):
+    if created:
+        pubsub.orders_created([instance.pk])
+
+
+@receiver(post_delete, sender=Order)
+def unindex_order(sender, instance, **kwargs):
+    search.unindex_objects(search.ORDER, [instance.pk])
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def invalidate_cached_responses(sender, **kwargs):
+    response_cache.invalidate_models(sender)
+
+
+@receiver(m2m_changed, sender=Order.products.through)
+def invalidate_cached_order_products(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        response_cache.invalidate_models(Order, Product)
@@ -0,0 +1,323 @@
+"""
+GraphQL over websockets for the ASGI application.
+
+Speaks the graphql-transport-ws protocol of the graphql-ws client and,
+for older clients, the graphql-ws protocol of
+subscriptions-transport-ws, picked from the subprotocols the client
+offers. Subscription events are produced on the event loop by the
+subscribe_ generators of the schema (fed by crm.pubsub); every event,
+like every query or mutation sent over the socket, is then executed on
+a worker thread with its own DataLoaders, trace and database
+connection, since resolvers use the sync ORM.
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import close_old_connections, transaction
+from graphene_django.settings import graphene_settings
+from graphql import (
+    ExecutionResult, GraphQLError, OperationType, create_source_event_stream,
+    execute, get_operation_ast)
+from graphql.validation import specified_rules
+from . import cost, tracing
+from .documents import document_cache
+from .loaders import Loaders
+
+
+GRAPHQL_TRANSPORT_WS = 'graphql-transport-ws'
+GRAPHQL_WS = 'graphql-ws'
+PROTOCOLS = (GRAPHQL_TRANSPORT_WS, GRAPHQL_WS)
+
+# graphql-transport-ws close codes
+INVALID_MESSAGE = 4400
+UNAUTHORIZED = 4401
+INIT_TIMEOUT = 4408
+SUBSCRIBER_EXISTS = 4409
+TOO_MANY_INIT = 4429
+
+
+def _as_graphql_error(error):
+    if isinstance(error, GraphQLError):
+        return error
+    return GraphQLError(str(error), original_error=error)
+
+
+class GraphQLWebSocket:
+    """
+    One websocket connection and the operations running on it
+    """
+    validation_rules = (*specified_rules, cost.QueryCostRule)
+
+    def __init__(self, schema, scope, receive, send):
+        self.schema = schema
+        self.scope = scope
+        self.receive = receive
+        self._send = send
+        self.protocol = None
+        self.acknowledged = False
+        self.closed = False
+        self.connection_params = {}
+        self.operations = {}
+
+    @property
+    def legacy(self):
+        return self.protocol == GRAPHQL_WS
+
+    async def run(self):
+        message = await self.receive()
+        if message['type'] != 'websocket.connect':
+            return
+        offered = self.scope.get('subprotocols') or ()
+        self.protocol = next((p for p in offered if p in PROTOCOLS), None)
+        if self.protocol is None:
+            # Rejects the handshake
+            await self._send({'type': 'websocket.close'})
+            return
+        await self._send(
+            {'type': 'websocket.accept', 'subprotocol': self.protocol})
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + getattr(
+            settings, 'GRAPHQL_WS_INIT_TIMEOUT', 10)
+        try:
+            while not self.closed:
+                timeout = None
+                if not self.acknowledged:
+                    timeout = max(deadline - loop.time(), 0)
+                try:
+                    message = await asyncio.wait_for(self.receive(), timeout)
+                except asyncio.TimeoutError:
+                    await self.close(
+                        INIT_TIMEOUT, 'Connection initialisation timeout')
+                    break
+                if message['type'] == 'websocket.disconnect':
+                    self.closed = True
+                elif message['type'] == 'websocket.receive':
+                    await self.handle(
+                        message.get('text') or message.get('bytes'))
+        finally:
+            tasks = list(self.operations.values())
+            self.operations.clear()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def send(self, message):
+        if not self.closed:
+            await self._send(
+                {'type': 'websocket.send', 'text': json.dumps(message)})
+
+    async def close(self, code=1000, reason=''):
+        if not self.closed:
+            self.closed = True
+            await self._send(
+                {'type': 'websocket.close', 'code': code, 'reason': reason})
+
+    async def handle(self, text):
+        try:
+            message = json.loads(text)
+            message_type = message['type']
+        except (TypeError, ValueError, KeyError):
+            await self.close(INVALID_MESSAGE, 'Invalid message')
+            return
+
+        if message_type == 'connection_init':
+            await self.init(message.get('payload'))
+        elif message_type in ('subscribe', 'start'):
+            await self.subscribe(message.get('id'), message.get('payload'))
+        elif message_type in ('complete', 'stop'):
+            await self.complete(message.get('id'))
+        elif message_type == 'ping' and not self.legacy:
+            await self.send({'type': 'pong'})
+        elif message_type == 'pong' and not self.legacy:
+            pass
+        elif message_type == 'connection_terminate' and self.legacy:
+            await self.close()
+        else:
+            await self.close(
+                INVALID_MESSAGE, f'Unknown message type {message_type}')
+
+    async def init(self, payload):
+        if self.acknowledged:
+            await self.close(TOO_MANY_INIT, 'Too many initialisation requests')
+            return
+        self.connection_params = payload if isinstance(payload, dict) else {}
+        self.acknowledged = True
+        await self.send({'type': 'connection_ack'})
+
+    async def subscribe(self, id, payload):
+        if not self.acknowledged:
+            await self.close(UNAUTHORIZED, 'Unauthorized')
+            return
+        if not isinstance(id, str) or not isinstance(payload, dict):
+            await self.close(INVALID_MESSAGE, 'Invalid message')
+            return
+        if id in self.operations:
+            await self.close(
+                SUBSCRIBER_EXISTS, f'Subscriber for {id} already exists')
+            return
+        self.operations[id] = asyncio.create_task(
+            self.run_operation(id, payload))
+
+    async def complete(self, id):
+        task = self.operations.pop(id, None)
+        if task is None:
+            return
+        task.cancel()
+        if self.legacy:
+            await self.send({'type': 'complete', 'id': id})
+
+    async def run_operation(self, id, payload):
+        try:
+            await self.execute_operation(id, payload)
+        finally:
+            if self.operations.get(id) is asyncio.current_task():
+                del self.operations[id]
+
+    def prepare(self, payload):
+        """
+        Return (document, operation, errors) for an operation payload,
+        validated and costed like the ones sent to the view
+        """
+        schema = self.schema.graphql_schema
+        try:
+            document, errors = document_cache.get_validated(
+                schema,
+                payload.get('query') or '',
+                self.validation_rules,
+                graphene_settings.MAX_VALIDATION_ERRORS,
+            )
+        except Exception as e:
+            return None, None, [_as_graphql_error(e)]
+        if errors:
+            return document, None, errors
+
+        operation = get_operation_ast(document, payload.get('operationName'))
+        if operation is None:
+            return document, None, [GraphQLError(
+                'Must provide a known operation name if the query '
+                'contains several operations.')]
+        error = cost.too_complex_error(
+            cost.measure(
+                schema, document, operation, payload.get('variables')),
+            operation)
+        return document, operation, [error] if error else []
+
+    async def execute_operation(self, id, payload):
+        document, operation, errors = self.prepare(payload)
+        if errors:
+            await self.send_error(id, errors)
+            return
+        variables = payload.get('variables')
+        operation_name = payload.get('operationName')
+
+        if operation.operation != OperationType.SUBSCRIPTION:
+            result = await self.execute(
+                document, operation, None, variables, operation_name)
+            await self.send_next(id, result)
+            await self.send({'type': 'complete', 'id': id})
+            return
+
+        stream = await create_source_event_stream(
+            self.schema.graphql_schema,
+            document,
+            context_value=self.get_context(),
+            variable_values=variables,
+            operation_name=operation_name,
+        )
+        if isinstance(stream, ExecutionResult):
+            await self.send_error(id, stream.errors)
+            return
+        try:
+            async for event in stream:
+                result = await self.execute(
+                    document, operation, event, variables, operation_name)
+                await self.send_next(id, result)
+        finally:
+            await stream.aclose()
+        await self.send({'type': 'complete', 'id': id})
+
+    async def send_next(self, id, result):
+        await self.send({
+            'type': 'data' if self.legacy else 'next',
+            'id': id,
+            'payload': result.formatted,
+        })
+
+    async def send_error(self, id, errors):
+        errors = [error.formatted for error in errors]
+        if self.legacy:
+            await self.send(
+                {'type': 'data', 'id': id, 'payload': {'errors': errors}})
+            await self.send({'type': 'complete', 'id': id})
+        else:
+            await self.send({'type': 'error', 'id': id, 'payload': errors})
+
+    def get_context(self):
+        return SimpleNamespace(
+            loaders=Loaders(),
+            user=self.scope.get('user') or AnonymousUser(),
+            connection_params=self.connection_params,
+        )
+
+    async def execute(self, document, operation, root_value, variables,
+                      operation_name):
+        return await sync_to_async(self.execute_sync, thread_sensitive=False)(
+            document, operation, root_value, variables, operation_name)
+
+    def execute_sync(self, document, operation, root_value, variables,
+                     operation_name):
+        """
+        Execute an operation, or one subscription event, under a
+        trace; mutations are atomic like in the view
+        """
+        close_old_connections()
+        try:
+            context = self.get_context()
+            options = {
+                'root_value': root_value,
+                'context_value': context,
+                'variable_values': variables,
+                'operation_name': operation_name,
+                'middleware': graphene_settings.MIDDLEWARE,
+            }
+            schema = self.schema.graphql_schema
+            with tracing.trace_operation(
+                    context, operation, operation_name) as trace:
+                if operation.operation == OperationType.MUTATION:
+                    with transaction.atomic():
+                        result = execute(schema, document, **options)
+                        if result.errors:
+                            transaction.set_rollback(True)
+                else:
+                    result = execute(schema, document, **options)
+            return tracing.attach_extension(result, trace)
+        except Exception as e:
+            return ExecutionResult(errors=[_as_graphql_error(e)])
+        finally:
+            close_old_connections()
+
+
+class GraphQLWebSocketApp:
+    """
+    ASGI application serving GraphQL websockets at paths
+    """
+    def __init__(self, schema=None, paths=('/graphql', '/graphql/')):
+        self._schema = schema
+        self.paths = paths
+
+    @property
+    def schema(self):
+        return self._schema or graphene_settings.SCHEMA
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            raise ValueError(f"Unsupported scope type {scope['type']!r}")
+        if scope['path'] not in self.paths:
+            await receive()
+            await send({'type': 'websocket.close'})
+            return
+        await GraphQLWebSocket(self.schema, scope, receive, send).run()
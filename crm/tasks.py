@@ -1,28 +1,22 @@
-from celery import shared_task
-from gql import Client, gql
-from gql.transport.requests import RequestsHTTPTransport
+from celery import chord, shared_task
 from datetime import datetime
-import requests
-
-
-GRAPHQL_URL = "http://localhost:8000/graphql"
+from django.conf import settings
+from crm import analytics, cleanup, importer, reports
+from crm.cron_jobs import send_order_reminders as order_reminders
+from crm.executor import execute_graphql
+from crm.models import CRMStats
 
 
 @shared_task()
 def generate_crm_report():
     """
-    This function generates a crm report from a graphql
-    endpint and logs it.
+    This function generates a crm report from the graphql
+    schema and logs it.
     """
-    # Establish connection to graphql endpoint
-    transport = RequestsHTTPTransport(url=GRAPHQL_URL)
-    client = Client(transport=transport)
-
     path_to_log_file = "/tmp/crm_report_log.txt"
 
     # Define and execute query
-    query = gql(
-        """
+    query = """
         query {
           stats {
             totalCustomers
@@ -31,11 +25,10 @@ def generate_crm_report():
           }
         }
         """
-    )
 
     try:
         # Execute query
-        response = client.execute(query)
+        response = execute_graphql(query)
     except Exception as e:
         # Log errors and terminate function
         with open(path_to_log_file, "a", encoding="utf-8") as f:
@@ -58,5 +51,116 @@ def generate_crm_report():
 
     print('Report generated successfully')
 
+
+@shared_task()
+def generate_partitioned_crm_report(partition_size=None):
+    """
+    This function starts the partitioned weekly report and
+    returns the id of the task merging it.
+    """
+    return build_crm_report(partition_size).id
+
+
+def build_crm_report(partition_size=None):
+    """
+    This function fans the report out as one subtask per
+    customer id range, merged by merge_crm_report once every
+    range is aggregated.
+    """
+    size = partition_size or getattr(
+        settings, "CRM_REPORT_PARTITION_SIZE", 5000)
+    header = [
+        aggregate_report_partition.s(first_id, last_id)
+        for first_id, last_id in reports.partition_customers(size)
+    ]
+    if not header:
+        return merge_crm_report.delay([])
+    return chord(header)(merge_crm_report.s())
+
+
+@shared_task()
+def aggregate_report_partition(first_id, last_id):
+    """
+    This function aggregates the revenue, product sales and
+    cohorts of the customers with ids in [first_id, last_id].
+    """
+    return reports.aggregate_partition(first_id, last_id)
+
+
+@shared_task()
+def merge_crm_report(partials):
+    """
+    This function merges the partition aggregates, caches the
+    report and writes it as a JSON file.
+    """
+    report = reports.merge_partials(partials)
+    report["path"] = reports.publish_report(report)
+    return report
+
+
+@shared_task()
+def reconcile_crm_stats():
+    """
+    This function recomputes the stats snapshot from the
+    source tables to correct any drift from bulk writes.
+    """
+    snapshot = CRMStats.objects.reconcile()
+    return {
+        "total_customers": snapshot.total_customers,
+        "total_orders": snapshot.total_orders,
+        "total_revenue": str(snapshot.total_revenue),
+    }
+
+
+@shared_task()
+def refresh_sales_rollups():
+    """
+    This function rebuilds the sales rollup buckets of
+    every day whose orders changed since the last run.
+    """
+    return analytics.refresh_sales_rollups()
+
+
+@shared_task()
+def import_crm_file(path, object_type, format=None, offset=None,
+                    chunk_size=1000):
+    """
+    This function streams a partner CSV/NDJSON file into the crm
+    tables, resuming from the last committed chunk of an earlier
+    run when no offset is given.
+    """
+    return importer.import_file(
+        path,
+        object_type,
+        format=format,
+        offset=offset,
+        chunk_size=chunk_size,
+        report_path=f"{path}.rejected.ndjson",
+        checkpoint_path=f"{path}.offset",
+    )
+
+
+@shared_task()
+def send_order_reminders():
+    """
+    This function logs a reminder per customer with an order
+    in the past 7 days, resuming a partial run from its
+    checkpoint instead of re-sending.
+    """
+    return order_reminders.send_order_reminders()
+
+
+@shared_task()
+def clean_inactive_customers(days=365, dry_run=False):
+    """
+    This function deletes the customers without an order in
+    the last `days` days in short id-range transactions and
+    returns the counts, or only counts them on a dry run.
+    """
+    result = cleanup.clean_inactive_customers(days=days, dry_run=dry_run)
+    result["cutoff"] = result["cutoff"].isoformat()
+    return result
+
+
 if __name__ == "__main__":
     generate_crm_report()
\ No newline at end of file
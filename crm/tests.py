@@ -1,3 +1,1879 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from unittest import mock
+from datetime import date
+from decimal import Decimal
+from importlib import import_module
+from types import SimpleNamespace
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+import threading
+from contextlib import ExitStack, asynccontextmanager
+from django.db import connection, connections
+from django.db.utils import OperationalError
+from django.db.models import Sum
+from django.db.models.signals import post_delete
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from graphene_django.utils.testing import GraphQLTestCase
+from graphql import parse
+from graphql_relay import to_global_id
+from .analytics import refresh_sales_rollups
+from .bulk import bulk_create_orders
+from .cleanup import clean_inactive_customers
+from .cron_jobs import send_order_reminders as reminders
+from .documents import (
+    document_cache, get_persisted_query_cache, query_hash)
+from .executor import (
+    GraphQLExecutionError, RemoteExecutor, execute_graphql,
+    execute_graphql_batch)
+from .pagination import get_keyset_keys, keyset_ordering
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from alx_backend_graphql.asgi import application as asgi_application
+from . import (
+    aio, analytics, bulk, cron, export, importer, pubsub, reports,
+    response_cache, schema, signals, tasks, tracing)
+from . import search as search_index
+from .celery import app as celery_app
+from .models import (
+    CRMStats, Customer, InsufficientStock, Product, Order,
+    SalesRollup, SalesRollupDirtyDay)
 
-# Create your tests here.
+
+class CRMTestCase(GraphQLTestCase):
+    GRAPHQL_URL = '/graphql'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Product {i}', price=Decimal('10.00') + i, stock=i)
+            for i in range(5)
+        ])
+        cls.customers = Customer.objects.bulk_create([
+            Customer(name=f'Customer {i}', email=f'customer{i}@example.com')
+            for i in range(4)
+        ])
+        for i, customer in enumerate(cls.customers):
+            for j in range(3):
+                order = Order.objects.create(
+                    customer=customer, order_date=date(2025, 1, 1 + i + j))
+                order.products.set(cls.products[j:j + 2])
+
+    def setUp(self):
+        super().setUp()
+        # Rolled back rows do not bump tag versions
+        response_cache.get_cache().clear()
+
+    def execute(self, query, variables=None):
+        response = self.query(query, variables=variables)
+        self.assertResponseNoErrors(response)
+        return json.loads(response.content)['data']
+
+
+class DataLoaderTests(CRMTestCase):
+    def test_nested_orders_query_count(self):
+        query = """
+        {
+          allOrders {
+            edges {
+              node {
+                customer { email }
+                products { edges { node { name price } } }
+              }
+            }
+          }
+        }
+        """
+        # count, orders joined to customers, products IN
+        with self.assertNumQueries(3):
+            data = self.execute(query)
+        edges = data['allOrders']['edges']
+        self.assertEqual(len(edges), 12)
+        for edge in edges:
+            self.assertEqual(len(edge['node']['products']['edges']), 2)
+
+    def test_nested_customers_query_count(self):
+        query = """
+        {
+          allCustomers {
+            edges {
+              node {
+                email
+                orders {
+                  edges {
+                    node {
+                      customer { email }
+                      products { edges { node { name } } }
+                    }
+                  }
+                }
+              }
+            }
+          }
+        }
+        """
+        # count, customers, orders IN, products IN
+        with self.assertNumQueries(4):
+            data = self.execute(query)
+        for edge in data['allCustomers']['edges']:
+            customer = edge['node']
+            orders = customer['orders']['edges']
+            self.assertEqual(len(orders), 3)
+            for order in orders:
+                self.assertEqual(
+                    order['node']['customer']['email'], customer['email'])
+
+    def test_filtered_nested_connection(self):
+        query = """
+        {
+          allOrders(first: 1) {
+            edges {
+              node {
+                products(name_Icontains: "Product 1") {
+                  edges { node { name } }
+                }
+              }
+            }
+          }
+        }
+        """
+        data = self.execute(query)
+        products = data['allOrders']['edges'][0]['node']['products']['edges']
+        self.assertEqual([p['node']['name'] for p in products], ['Product 1'])
+
+
+class OptimizerTests(CRMTestCase):
+    def test_only_selected_columns_are_loaded(self):
+        query = """
+        {
+          allOrders(first: 2) {
+            edges { node { customer { email } } }
+          }
+        }
+        """
+        with CaptureQueriesContext(connection) as ctx:
+            self.execute(query)
+        sql = ctx.captured_queries[-1]['sql']
+        self.assertIn('"crm_customer"."email"', sql)
+        self.assertNotIn('"crm_customer"."name"', sql)
+        self.assertNotIn('"crm_order"."order_date"', sql)
+
+    def test_fragments_are_followed(self):
+        query = """
+        query {
+          allProducts(first: 1) { edges { node { ...ProductFields } } }
+        }
+        fragment ProductFields on ProductNode { name }
+        """
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.execute(query)
+        self.assertEqual(
+            data['allProducts']['edges'][0]['node']['name'], 'Product 0')
+        sql = ctx.captured_queries[-1]['sql']
+        self.assertNotIn('"crm_product"."price"', sql)
+
+    def test_node_field_is_optimized(self):
+        order = Order.objects.first()
+        query = """
+        query ($id: ID!) {
+          order(id: $id) { orderDate customer { name } }
+        }
+        """
+        with self.assertNumQueries(1):
+            data = self.execute(
+                query, {'id': to_global_id('OrderNode', order.pk)})
+        self.assertEqual(data['order']['customer']['name'], 'Customer 0')
+
+
+class OrderTotalTests(CRMTestCase):
+    def test_total_follows_products(self):
+        order = Order.objects.create(
+            customer=self.customers[0], order_date=date(2025, 2, 1))
+        order.products.add(self.products[0], self.products[1])
+        self.assertEqual(order.total_amount, Decimal('21.00'))
+
+        order.products.remove(self.products[0])
+        self.assertEqual(order.total_amount, Decimal('11.00'))
+
+        self.products[2].orders.add(order)
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, Decimal('23.00'))
+
+        self.products[2].orders.clear()
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, Decimal('11.00'))
+
+    def test_total_follows_price_change_and_delete(self):
+        product = self.products[1]
+        product.price = Decimal('100.00')
+        product.save()
+        for order in Order.objects.with_computed_total():
+            self.assertEqual(order.total_amount, order.computed_total)
+        self.assertTrue(
+            Order.objects.filter(total_amount__gte=100).exists())
+
+        product.delete()
+        for order in Order.objects.with_computed_total():
+            self.assertEqual(order.total_amount, order.computed_total)
+        self.assertFalse(
+            Order.objects.filter(total_amount__gte=100).exists())
+
+    def test_save_without_price_change_keeps_order_totals(self):
+        product = self.products[1]
+        with mock.patch.object(signals, 'recompute_order_totals') as patched:
+            product.name = 'Renamed'
+            product.save()
+            patched.assert_not_called()
+            product.price = Decimal('100.00')
+            product.save()
+            patched.assert_called_once()
+
+    def test_total_amount_filter(self):
+        query = """
+        {
+          allOrders(totalAmount_Gte: 23, orderBy: "-total_amount") {
+            edges { node { totalAmount } }
+          }
+        }
+        """
+        data = self.execute(query)
+        totals = [
+            Decimal(e['node']['totalAmount'])
+            for e in data['allOrders']['edges']
+        ]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+        self.assertTrue(totals and all(t >= 23 for t in totals))
+
+
+class StatsTests(CRMTestCase):
+    def brute_force_stats(self):
+        revenue = sum(
+            (p.price for o in Order.objects.all() for p in o.products.all()),
+            Decimal('0'),
+        )
+        return Customer.objects.count(), Order.objects.count(), revenue
+
+    def snapshot_stats(self):
+        snapshot = CRMStats.objects.get_snapshot()
+        return (
+            snapshot.total_customers,
+            snapshot.total_orders,
+            snapshot.total_revenue,
+        )
+
+    def test_reconciled_revenue_matches_brute_force(self):
+        CRMStats.objects.all().delete()
+        expected = self.brute_force_stats()
+        self.assertEqual(self.snapshot_stats(), expected)
+        legacy_revenue = (
+            Order.objects
+            .values('products__price')
+            .aggregate(total=Sum('products__price'))
+        )['total']
+        self.assertEqual(legacy_revenue, expected[2])
+
+    def test_snapshot_tracks_writes(self):
+        CRMStats.objects.reconcile()
+        customer = Customer.objects.create(
+            name='New', email='new@example.com')
+        order = Order.objects.create(
+            customer=customer, order_date=date(2025, 3, 1))
+        order.products.add(*self.products[:3])
+        self.products[0].price = Decimal('99.99')
+        self.products[0].save()
+        self.products[4].orders.add(order)
+        self.products[1].delete()
+        self.assertEqual(self.snapshot_stats(), self.brute_force_stats())
+
+        self.customers[0].delete()
+        self.assertEqual(self.snapshot_stats(), self.brute_force_stats())
+
+    def test_stats_query_reads_snapshot(self):
+        CRMStats.objects.reconcile()
+        with self.assertNumQueries(1):
+            data = self.execute(
+                '{ stats { totalCustomers totalOrders totalRevenue } }')
+        customers, orders, revenue = self.brute_force_stats()
+        self.assertEqual(data['stats']['totalCustomers'], customers)
+        self.assertEqual(data['stats']['totalOrders'], orders)
+        self.assertEqual(Decimal(data['stats']['totalRevenue']), revenue)
+
+
+class SalesTimeseriesTests(CRMTestCase):
+    timeseries_query = """
+    query ($granularity: SalesGranularity!, $from: Date!, $to: Date!,
+           $customerId: ID, $productId: ID) {
+      salesTimeseries(granularity: $granularity, from: $from, to: $to,
+                      customerId: $customerId, productId: $productId) {
+        bucket orderCount revenue customerCount
+      }
+    }
+    """
+
+    def timeseries(self, granularity, **variables):
+        variables.update({
+            'granularity': granularity,
+            'from': '2025-01-01',
+            'to': '2025-01-31',
+        })
+        data = self.execute(self.timeseries_query, variables)
+        return data['salesTimeseries']
+
+    def test_rollups_follow_dirty_days(self):
+        self.assertEqual(refresh_sales_rollups(), 6)
+        days = self.timeseries('DAY')
+        self.assertEqual(len(days), 6)
+        self.assertEqual(sum(d['orderCount'] for d in days), 12)
+
+        month = self.timeseries('MONTH')
+        self.assertEqual(len(month), 1)
+        self.assertEqual(month[0]['orderCount'], 12)
+        self.assertEqual(month[0]['customerCount'], 4)
+        self.assertEqual(
+            Decimal(month[0]['revenue']),
+            Order.objects.aggregate(total=Sum('total_amount'))['total'])
+
+        order = Order.objects.create(
+            customer=self.customers[0], order_date=date(2025, 1, 20))
+        order.products.add(self.products[4])
+        refresh_sales_rollups()
+        month = self.timeseries('MONTH')
+        self.assertEqual(month[0]['orderCount'], 13)
+
+    def test_migration_backfills_existing_orders(self):
+        def rollups():
+            return set(SalesRollup.objects.values_list(
+                'granularity', 'bucket', 'product_id', 'order_count',
+                'revenue', 'customer_count'))
+
+        refresh_sales_rollups()
+        rebuilt = rollups()
+        SalesRollup.objects.all().delete()
+        import_module('crm.migrations.0007_sales_rollup') \
+            .backfill_sales_rollups(apps, None)
+        self.assertEqual(rollups(), rebuilt)
+
+    def test_failed_rebuild_keeps_days_queued(self):
+        queued = set(
+            SalesRollupDirtyDay.objects.values_list('day', flat=True))
+        with mock.patch.object(
+                analytics, 'rebuild_sales_rollups',
+                side_effect=OperationalError('lost connection')):
+            with self.assertRaises(OperationalError):
+                refresh_sales_rollups()
+        self.assertEqual(
+            set(SalesRollupDirtyDay.objects.values_list('day', flat=True)),
+            queued)
+        self.assertEqual(refresh_sales_rollups(), len(queued))
+
+    def test_product_and_customer_filters(self):
+        refresh_sales_rollups()
+        product = self.products[0]
+        weeks = self.timeseries('WEEK', productId=str(product.pk))
+        self.assertEqual(
+            sum(w['orderCount'] for w in weeks), product.orders.count())
+
+        customer = self.customers[1]
+        month = self.timeseries('MONTH', customerId=str(customer.pk))
+        self.assertEqual(month[0]['orderCount'], 3)
+        self.assertEqual(month[0]['customerCount'], 1)
+
+
+class KeysetPaginationTests(CRMTestCase):
+    page_query = """
+    query ($first: Int, $last: Int, $after: String, $before: String,
+           $orderBy: String) {
+      allProducts(keyset: true, first: $first, last: $last, after: $after,
+                  before: $before, orderBy: $orderBy) {
+        pageInfo { hasNextPage hasPreviousPage endCursor startCursor }
+        edges { node { name } }
+      }
+    }
+    """
+
+    def walk(self, order_by, first=2):
+        names = []
+        after = None
+        while True:
+            data = self.execute(self.page_query, {
+                'first': first, 'after': after, 'orderBy': order_by})
+            connection = data['allProducts']
+            names.extend(e['node']['name'] for e in connection['edges'])
+            if not connection['pageInfo']['hasNextPage']:
+                return names
+            after = connection['pageInfo']['endCursor']
+
+    def test_pages_follow_ordering(self):
+        Product.objects.create(name='No stock', price=1, stock=None)
+        Product.objects.create(name='Duplicate', price=12, stock=2)
+        for order_by in ('-price', 'stock', '-stock', 'name', None):
+            expected = list(
+                Product.objects
+                .order_by(*keyset_ordering(
+                    get_keyset_keys(
+                        Product.objects.order_by(
+                            *([order_by] if order_by else []))),
+                    backwards=False))
+                .values_list('name', flat=True)
+            )
+            self.assertEqual(self.walk(order_by), expected, order_by)
+
+    def test_backwards_pagination(self):
+        data = self.execute(self.page_query, {'last': 2, 'orderBy': 'name'})
+        connection = data['allProducts']
+        self.assertEqual(
+            [e['node']['name'] for e in connection['edges']],
+            ['Product 3', 'Product 4'])
+        self.assertTrue(connection['pageInfo']['hasPreviousPage'])
+
+        data = self.execute(self.page_query, {
+            'last': 2,
+            'orderBy': 'name',
+            'before': connection['pageInfo']['startCursor'],
+        })
+        self.assertEqual(
+            [e['node']['name'] for e in data['allProducts']['edges']],
+            ['Product 1', 'Product 2'])
+
+    def test_not_null_keys_seek_with_a_row_value(self):
+        first = self.execute(self.page_query, {'first': 2, 'orderBy': 'name'})
+        with CaptureQueriesContext(connection) as queries:
+            data = self.execute(self.page_query, {
+                'first': 2, 'orderBy': 'name',
+                'after': first['allProducts']['pageInfo']['endCursor']})
+        self.assertEqual(
+            [e['node']['name'] for e in data['allProducts']['edges']],
+            ['Product 2', 'Product 3'])
+        sql = queries[0]['sql']
+        self.assertNotIn('NULLS', sql)
+        self.assertIn(
+            '("crm_product"."name", "crm_product"."id") > (', sql)
+
+    def test_total_count_only_when_selected(self):
+        query = """
+        { allOrders(keyset: true, first: 5) { edges { node { id } } } }
+        """
+        with self.assertNumQueries(1):
+            self.execute(query)
+        query = """
+        { allOrders(keyset: true, first: 5) {
+            totalCount edges { node { id } } } }
+        """
+        with self.assertNumQueries(2):
+            data = self.execute(query)
+        self.assertEqual(data['allOrders']['totalCount'], 12)
+
+
+class SearchTests(CRMTestCase):
+    search_query = """
+    query ($query: String!, $types: [SearchType!]) {
+      search(query: $query, types: $types) {
+        rank
+        node {
+          __typename
+          ... on CustomerNode { email }
+          ... on ProductNode { name }
+          ... on OrderNode { customer { email } }
+        }
+      }
+    }
+    """
+
+    def setUp(self):
+        # setUpTestData bulk creates customers, which skips signals
+        call_command('rebuild_search_index', stdout=StringIO())
+
+    def search(self, query, types=None):
+        data = self.execute(
+            self.search_query, {'query': query, 'types': types})
+        return data['search']
+
+    def test_search_ranks_all_types(self):
+        hits = self.search('customer2')
+        typenames = {hit['node']['__typename'] for hit in hits}
+        self.assertEqual(typenames, {'CustomerNode', 'OrderNode'})
+
+        hits = self.search('customer2', types=['CUSTOMER'])
+        self.assertEqual(
+            [hit['node']['email'] for hit in hits],
+            ['customer2@example.com'])
+
+    def test_index_follows_writes(self):
+        product = Product.objects.create(name='Walnut desk', price=5)
+        self.assertEqual(self.search('waln')[0]['node']['name'], 'Walnut desk')
+
+        order = Order.objects.create(
+            customer=self.customers[0], order_date=date(2025, 4, 1))
+        order.products.add(product)
+        self.assertEqual(
+            {hit['node']['__typename'] for hit in self.search('walnut')},
+            {'ProductNode', 'OrderNode'})
+
+        product.name = 'Oak desk'
+        product.save()
+        self.assertEqual(self.search('walnut'), [])
+        self.assertEqual(len(self.search('oak desk')), 2)
+
+        product.delete()
+        self.assertEqual(self.search('oak'), [])
+
+    def test_save_without_name_change_keeps_order_documents(self):
+        product = self.products[1]
+        with mock.patch.object(signals.search, 'index_objects') as patched:
+            product.price = Decimal('100.00')
+            product.save()
+            self.assertEqual(
+                [c.args[0] for c in patched.call_args_list],
+                [search_index.PRODUCT])
+            patched.reset_mock()
+            product.name = 'Renamed'
+            product.save()
+            self.assertEqual(
+                [c.args[0] for c in patched.call_args_list],
+                [search_index.PRODUCT, search_index.ORDER])
+
+    def test_migration_backfills_existing_rows(self):
+        migration = import_module('crm.migrations.0010_search_index')
+        before = [
+            self.search(query)
+            for query in ('customer2', 'product 3', 'customer1 product 1')]
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search_index.TABLE}')
+            self.assertEqual(self.search('customer2'), [])
+            migration.backfill_search_index(apps, SimpleNamespace(
+                connection=connection, execute=cursor.execute))
+        self.assertEqual(before, [
+            self.search(query)
+            for query in ('customer2', 'product 3', 'customer1 product 1')])
+
+    def test_unsupported_database_is_a_graphql_error(self):
+        with mock.patch.dict(search_index.BACKENDS, clear=True):
+            response = self.query(
+                self.search_query, variables={'query': 'customer'})
+        errors = response.json()['errors']
+        self.assertIn('Search is not available', errors[0]['message'])
+
+    def test_bulk_created_customers_are_indexed(self):
+        mutation = """
+        mutation {
+          bulkCreateCustomers(input: [
+            {name: "Zed Zulu", email: "zed@example.com", phone: "+123456"}
+          ]) { customers { id } }
+        }
+        """
+        self.execute(mutation)
+        self.assertEqual(
+            self.search('zulu')[0]['node']['email'], 'zed@example.com')
+
+
+class PersistedQueryTests(CRMTestCase):
+    hello = '{ hello }'
+
+    def setUp(self):
+        super().setUp()
+        document_cache.clear()
+        get_persisted_query_cache().clear()
+
+    def post(self, body):
+        response = self.client.post(
+            self.GRAPHQL_URL, json.dumps(body),
+            content_type='application/json')
+        return json.loads(response.content)
+
+    def test_documents_are_parsed_once(self):
+        with mock.patch('crm.documents.parse', wraps=parse) as parse_mock:
+            for _ in range(3):
+                self.execute(self.hello)
+        self.assertEqual(parse_mock.call_count, 1)
+        self.assertEqual(document_cache.hits, 2)
+
+    def test_validation_errors_are_cached(self):
+        for _ in range(2):
+            response = self.query('{ nope }')
+            self.assertResponseHasErrors(response)
+
+    def test_automatic_persisted_query(self):
+        extensions = {
+            'persistedQuery': {
+                'version': 1, 'sha256Hash': query_hash(self.hello)},
+        }
+        body = self.post({'extensions': extensions})
+        self.assertEqual(
+            body['errors'][0]['extensions']['code'],
+            'PERSISTED_QUERY_NOT_FOUND')
+
+        body = self.post({'query': self.hello, 'extensions': extensions})
+        self.assertEqual(body['data']['hello'], 'Hello, GraphQL!')
+
+        body = self.post({'extensions': extensions})
+        self.assertEqual(body['data']['hello'], 'Hello, GraphQL!')
+
+        response = self.client.get(self.GRAPHQL_URL, {
+            'extensions': json.dumps(extensions)},
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(
+            json.loads(response.content)['data']['hello'], 'Hello, GraphQL!')
+
+    def test_hash_mismatch_is_rejected(self):
+        extensions = {
+            'persistedQuery': {'version': 1, 'sha256Hash': '0' * 64}}
+        body = self.post({'query': self.hello, 'extensions': extensions})
+        self.assertEqual(
+            body['errors'][0]['extensions']['code'],
+            'PERSISTED_QUERY_HASH_MISMATCH')
+
+
+@override_settings(GRAPHQL_RESPONSE_CACHE_ENABLED=True)
+class ResponseCacheTests(CRMTestCase):
+    products_query = """
+    { allProducts(orderBy: "name") { edges { node { name stock } } } }
+    """
+
+    def product_names(self):
+        data = self.execute(self.products_query)
+        return [e['node']['name'] for e in data['allProducts']['edges']]
+
+    def test_repeated_query_is_served_from_cache(self):
+        response_cache.reset_stats()
+        first = self.execute(self.products_query)
+        with self.assertNumQueries(0):
+            second = self.execute(self.products_query)
+        self.assertEqual(first, second)
+        stats = response_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_save_invalidates_cached_responses(self):
+        self.assertEqual(self.product_names()[0], 'Product 0')
+        product = self.products[0]
+        product.name = 'Aardvark'
+        product.save()
+        self.assertEqual(self.product_names()[0], 'Aardvark')
+
+    def test_bulk_create_invalidates_cached_responses(self):
+        query = '{ allCustomers { totalCount } }'
+        self.assertEqual(self.execute(query)['allCustomers']['totalCount'], 4)
+        self.execute("""
+        mutation {
+          bulkCreateCustomers(input: [{name: "New", email: "n@example.com"}])
+          { customers { id } }
+        }
+        """)
+        self.assertEqual(self.execute(query)['allCustomers']['totalCount'], 5)
+
+    def test_order_products_change_invalidates_orders(self):
+        query = '{ allOrders(orderBy: "-total_amount") ' \
+            '{ edges { node { totalAmount } } } }'
+        before = self.execute(query)
+        self.customers[0].orders.first().products.add(self.products[4])
+        self.assertNotEqual(self.execute(query), before)
+
+    def test_unhinted_operations_are_not_cached(self):
+        response_cache.reset_stats()
+        self.execute('{ hello }')
+        self.execute('{ hello allProducts { totalCount } }')
+        self.assertEqual(response_cache.get_stats()['misses'], 0)
+
+    def test_plan_collects_nested_hints_and_tags(self):
+        from alx_backend_graphql.schema import schema
+        document = parse("""
+        { allProducts { edges { node { stock
+            orders { edges { node { customer { name } } } } } } } }
+        """)
+        plan = response_cache.get_plan(
+            schema.graphql_schema, document, document.definitions[0])
+        self.assertEqual(plan.ttl, 10)
+        self.assertEqual(
+            plan.tags, {'crm.product', 'crm.order', 'crm.customer'})
+
+    def test_process_local_cache_is_reported_by_checks(self):
+        from crm.checks import check_response_cache
+        self.assertEqual(
+            [w.id for w in check_response_cache(None)], ['crm.W001'])
+        with override_settings(GRAPHQL_RESPONSE_CACHE_ENABLED=False):
+            self.assertEqual(check_response_cache(None), [])
+
+
+class BulkCreateCustomersTests(CRMTestCase):
+    mutation = """
+    mutation($input: [CustomerInput], $update: Boolean) {
+      bulkCreateCustomers(input: $input, updateExisting: $update) {
+        customers { name email phone }
+        created
+        errors { index field messages }
+      }
+    }
+    """
+
+    def bulk_create(self, rows, update=False):
+        data = self.execute(
+            self.mutation, {'input': rows, 'update': update})
+        return data['bulkCreateCustomers']
+
+    def test_query_count_does_not_grow_with_rows(self):
+        rows = [
+            {'name': f'Bulk {i}', 'email': f'bulk{i}@example.com'}
+            for i in range(200)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            result = self.bulk_create(rows)
+        self.assertEqual(result['created'], 200)
+        self.assertEqual(result['errors'], [])
+        self.assertLess(len(queries), 15)
+        self.assertEqual(CRMStats.objects.get_snapshot().total_customers, 204)
+
+    def test_rows_inserted_concurrently_are_not_counted(self):
+        before = CRMStats.objects.get_snapshot().total_customers
+        # The validation misses customer0, as if it were inserted
+        # by another transaction right after the check
+        with mock.patch.object(bulk, 'existing_emails', return_value=set()):
+            result = bulk.bulk_create_customers([
+                {'name': 'Late', 'email': 'customer0@example.com'},
+                {'name': 'New', 'email': 'new@example.com'},
+            ])
+        self.assertEqual(result.created, 1)
+        self.assertEqual(
+            CRMStats.objects.get_snapshot().total_customers, before + 1)
+        self.assertEqual(
+            Customer.objects.get(email='customer0@example.com').name,
+            self.customers[0].name)
+
+    def test_row_errors_carry_indexes(self):
+        result = self.bulk_create([
+            {'name': 'Ok', 'email': 'ok@example.com', 'phone': '+1234567'},
+            {'name': 'Taken', 'email': 'customer0@example.com'},
+            {'name': 'Bad', 'email': 'not-an-email'},
+            {'name': 'Again', 'email': 'ok@example.com'},
+            {'name': 'Phone', 'email': 'p@example.com', 'phone': '12-34'},
+        ])
+        self.assertEqual(
+            [c['email'] for c in result['customers']], ['ok@example.com'])
+        self.assertEqual(
+            [(e['index'], e['field']) for e in result['errors']],
+            [(1, 'email'), (2, 'email'), (3, 'email'), (4, 'phone')])
+        self.assertEqual(
+            result['errors'][2]['messages'], ['Duplicate of row 0.'])
+
+    def test_update_existing(self):
+        result = self.bulk_create([
+            {'name': 'Renamed', 'email': 'customer0@example.com'},
+            {'name': 'Fresh', 'email': 'fresh@example.com'},
+        ], update=True)
+        self.assertEqual(result['created'], 1)
+        self.assertEqual(
+            [c['name'] for c in result['customers']], ['Renamed', 'Fresh'])
+        self.assertEqual(
+            Customer.objects.get(email='customer0@example.com').name,
+            'Renamed')
+        self.assertEqual(Customer.objects.count(), 5)
+
+
+class ImportTests(CRMTestCase):
+    def import_rows(self, text, object_type, format='csv', **kwargs):
+        report = StringIO()
+        result = importer.import_stream(
+            StringIO(text), object_type, format, report=report, **kwargs)
+        rejected = [
+            json.loads(line) for line in report.getvalue().splitlines()]
+        return result, rejected
+
+    def test_customers_are_upserted_in_chunks(self):
+        text = 'name,email,phone\n' + ''.join(
+            f'Imported {i},imported{i}@example.com,\n' for i in range(25))
+        text += 'Renamed,customer0@example.com,+1234567\n'
+        text += 'Broken,not-an-email,\n'
+        result, rejected = self.import_rows(
+            text, importer.CUSTOMERS, chunk_size=10)
+        self.assertEqual(
+            (result.processed, result.created, result.updated,
+             result.rejected, result.next_offset),
+            (27, 25, 1, 1, 27))
+        self.assertEqual(rejected[0]['row'], 26)
+        self.assertIn('email', rejected[0]['errors'])
+        self.assertEqual(
+            Customer.objects.get(email='customer0@example.com').phone,
+            '+1234567')
+
+    def test_products_update_prices_and_order_totals(self):
+        text = (
+            '{"name": "Product 0", "price": "20.00"}\n'
+            '{"name": "Gadget", "price": "5.50", "stock": 3}\n'
+            'not json\n'
+            '{"name": "Free", "price": "-1"}\n'
+        )
+        result, rejected = self.import_rows(
+            text, importer.PRODUCTS, format='ndjson')
+        self.assertEqual((result.created, result.updated), (1, 1))
+        self.assertEqual([r['row'] for r in rejected], [2, 3])
+        order = Order.objects.filter(products=self.products[0]).first()
+        self.assertEqual(
+            order.total_amount,
+            sum(p.price for p in order.products.all()))
+
+    def test_orders_resolve_references_and_resume(self):
+        text = 'customer_email,products,order_date\n'
+        text += 'customer0@example.com,Product 0|Product 1,2025-02-01\n'
+        text += 'customer1@example.com,Product 4,2025-02-02\n'
+        text += 'nobody@example.com,Product 4,2025-02-03\n'
+        text += 'customer2@example.com,Nothing,2025-02-04\n'
+        text += 'customer3@example.com,Product 4,\n'
+        before = CRMStats.objects.get_snapshot().total_orders
+        result, rejected = self.import_rows(
+            text, importer.ORDERS, offset=1)
+        self.assertEqual((result.created, result.rejected), (1, 3))
+        self.assertEqual(
+            [r['row'] for r in rejected], [2, 3, 4])
+        order = Order.objects.get(order_date=date(2025, 2, 2))
+        self.assertEqual(order.total_amount, self.products[4].price)
+        self.assertEqual(
+            CRMStats.objects.get_snapshot().total_orders, before + 1)
+        self.assertFalse(
+            Order.objects.filter(order_date=date(2025, 2, 1)).exists())
+
+
+class BulkCreateOrdersTests(CRMTestCase):
+    mutation = """
+    mutation($input: [OrderInput!]!) {
+      bulkCreateOrders(input: $input) {
+        orders { id totalAmount }
+        errors { index field messages }
+      }
+    }
+    """
+
+    def bulk_create(self, rows):
+        return self.execute(self.mutation, {'input': rows})['bulkCreateOrders']
+
+    def rows(self, count, product_ids):
+        return [
+            {
+                'customerId': self.customers[i % 4].pk,
+                'productIds': product_ids,
+                'orderDate': '2025-03-01',
+            }
+            for i in range(count)
+        ]
+
+    def test_round_trips_do_not_grow_with_orders(self):
+        Product.objects.update(stock=1000)
+        product_ids = [self.products[3].pk, self.products[4].pk]
+        counts = []
+        for count in (5, 200):
+            with CaptureQueriesContext(connection) as queries:
+                result = self.bulk_create(self.rows(count, product_ids))
+            self.assertEqual(len(result['orders']), count)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(
+            Product.objects.get(pk=self.products[3].pk).stock, 795)
+        self.assertEqual(
+            Decimal(result['orders'][0]['totalAmount']),
+            self.products[3].price + self.products[4].price)
+
+    def test_insufficient_stock_rejects_only_uncovered_rows(self):
+        # Product 2 has 2 units, product 4 has 4
+        result = self.bulk_create(
+            self.rows(3, [self.products[2].pk]) +
+            self.rows(1, [self.products[4].pk]) +
+            self.rows(1, [self.products[4].pk, self.products[2].pk]))
+        self.assertEqual(len(result['orders']), 3)
+        self.assertEqual(
+            [(e['index'], e['field']) for e in result['errors']],
+            [(2, 'products'), (4, 'products')])
+        self.assertEqual(Product.objects.get(pk=self.products[2].pk).stock, 0)
+        self.assertEqual(Product.objects.get(pk=self.products[4].pk).stock, 3)
+
+    def test_unknown_references_are_reported(self):
+        result = self.bulk_create([
+            {'customerId': 999, 'productIds': [self.products[4].pk],
+             'orderDate': '2025-03-01'},
+            {'customerId': self.customers[0].pk, 'productIds': [999],
+             'orderDate': '2025-03-01'},
+            {'customerId': self.customers[0].pk, 'productIds': []},
+        ])
+        self.assertEqual(result['orders'], [])
+        self.assertEqual(
+            [(e['index'], e['field']) for e in result['errors']],
+            [(0, 'customer'), (1, 'products'), (2, 'products'),
+             (2, 'order_date')])
+
+
+class StockTests(CRMTestCase):
+    create_order = """
+    mutation($customer: ID!, $products: [ID!]!) {
+      createOrder(input: {
+        customerId: $customer, productIds: $products,
+        orderDate: "2025-03-01"
+      }) { order { id } }
+    }
+    """
+
+    def test_create_order_reserves_stock(self):
+        product = self.products[2]
+        for _ in range(2):
+            self.execute(self.create_order, {
+                'customer': self.customers[0].pk, 'products': [product.pk]})
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 0)
+
+        response = self.query(self.create_order, variables={
+            'customer': self.customers[0].pk,
+            'products': [product.pk, self.products[4].pk]})
+        error = json.loads(response.content)['errors'][0]
+        self.assertEqual(
+            error['message'], 'Insufficient stock for: Product 2.')
+        self.assertEqual(error['extensions']['code'], 'INSUFFICIENT_STOCK')
+        self.assertEqual(
+            Product.objects.get(pk=self.products[4].pk).stock, 4)
+
+    def test_stock_events_carry_the_stock_written(self):
+        product = self.products[4]
+        with mock.patch.object(pubsub, 'get_pubsub') as get_pubsub:
+            with self.captureOnCommitCallbacks() as callbacks:
+                Product.objects.reserve_stock({product.pk: 3})
+                Product.objects.filter(pk=product.pk).update(stock=0)
+            with self.assertNumQueries(0):
+                for callback in callbacks:
+                    callback()
+        get_pubsub.return_value.publish.assert_called_once_with(
+            pubsub.STOCK_CHANGED, {'products': [[product.pk, 1]]})
+
+    def test_restock_is_a_single_update(self):
+        mutation = """
+        mutation {
+          updateLowStockProducts(threshold: 3, increment: 5, limit: 2) {
+            count
+            productIds
+            changedProducts(first: 1) {
+              totalCount
+              edges { node { name stock } }
+            }
+          }
+        }
+        """
+        with CaptureQueriesContext(connection) as queries:
+            data = self.execute(mutation)['updateLowStockProducts']
+        updates = [q for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('RETURNING', updates[0]['sql'])
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(
+            sorted(int(pk) for pk in data['productIds']),
+            [self.products[0].pk, self.products[1].pk])
+        self.assertEqual(data['changedProducts']['totalCount'], 2)
+        self.assertEqual(
+            Product.objects.get(pk=self.products[2].pk).stock, 2)
+        self.assertEqual(
+            Product.objects.get(pk=self.products[1].pk).stock, 6)
+
+    def test_restock_without_returning(self):
+        with mock.patch(
+                'crm.models.supports_update_returning', return_value=False):
+            ids = Product.objects.restock_below(10, 10)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(
+            sorted(Product.objects.values_list('stock', flat=True)),
+            [10, 11, 12, 13, 14])
+
+
+class StockConcurrencyTests(TransactionTestCase):
+    threads = 8
+    attempts = 25
+
+    def setUp(self):
+        self.product = Product.objects.create(
+            name='Contended', price=Decimal('1.00'), stock=50)
+
+    def run_threads(self, work):
+        errors = []
+
+        def run():
+            try:
+                for _ in range(self.attempts):
+                    # SQLite serializes writers and may report a lock
+                    # instead of waiting, retry until the write lands
+                    while True:
+                        try:
+                            work()
+                            break
+                        except OperationalError:
+                            continue
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=run) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_reservations_never_oversell(self):
+        reserved = []
+
+        def reserve():
+            try:
+                Product.objects.reserve_stock({self.product.pk: 1})
+                reserved.append(1)
+            except InsufficientStock:
+                pass
+
+        self.run_threads(reserve)
+        self.product.refresh_from_db()
+        self.assertEqual(len(reserved), 50)
+        self.assertEqual(self.product.stock, 0)
+
+    def test_restocks_are_not_lost(self):
+        self.run_threads(
+            lambda: Product.objects.filter(pk=self.product.pk).restock(1))
+        self.product.refresh_from_db()
+        self.assertEqual(
+            self.product.stock, 50 + self.threads * self.attempts)
+
+
+class ExecutorTests(CRMTestCase):
+    def test_local_executor_runs_in_process(self):
+        data = execute_graphql(
+            'query($first: Int) { allProducts(first: $first) '
+            '{ edges { node { name } } } }',
+            variables={'first': 2})
+        self.assertEqual(len(data['allProducts']['edges']), 2)
+
+        with self.assertRaises(GraphQLExecutionError) as cm:
+            execute_graphql('{ nope }')
+        self.assertIn('nope', str(cm.exception))
+
+    def test_failed_mutations_roll_back(self):
+        mutation = """
+        mutation {
+          createCustomer(input: {name: "A", email: "a@example.com"}) {
+            customer { id }
+          }
+          createProduct(input: {name: "P", price: -1}) { product { id } }
+        }
+        """
+        with self.assertRaises(GraphQLExecutionError):
+            execute_graphql(mutation)
+        self.assertFalse(
+            Customer.objects.filter(email='a@example.com').exists())
+
+    def test_remote_executor_reuses_its_session(self):
+        executor = RemoteExecutor('http://crm.test/graphql')
+        response = mock.Mock()
+        response.json.return_value = {'data': {'hello': 'hi'}}
+        with mock.patch.object(
+                executor.session, 'post', return_value=response) as post:
+            for _ in range(2):
+                self.assertEqual(
+                    executor.execute('{ hello }'), {'hello': 'hi'})
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(
+            post.call_args.kwargs['json']['query'], '{ hello }')
+
+    def test_remote_executor_never_resends_mutations_after_502_or_504(self):
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                received.append(json.loads(body))
+                self.send_response(int(self.path.strip('/')))
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base = f'http://127.0.0.1:{server.server_port}'
+
+        for status, query, sent in (
+            (502, 'mutation { updateLowStockProducts { count } }', 1),
+            (504, 'mutation { updateLowStockProducts { count } }', 1),
+            (503, 'mutation { updateLowStockProducts { count } }', 3),
+            (502, '{ hello }', 3),
+        ):
+            received.clear()
+            executor = RemoteExecutor(
+                f'{base}/{status}', retries=2, backoff=0)
+            executor.execute(query)
+            self.assertEqual(len(received), sent, (status, query))
+
+    def test_cron_job_uses_the_executor(self):
+        with mock.patch('crm.cron.execute_graphql', wraps=execute_graphql) \
+                as execute, mock.patch('builtins.open', mock.mock_open()):
+            cron.update_low_stock()
+        execute.assert_called_once()
+        self.assertEqual(
+            sorted(Product.objects.values_list('stock', flat=True)),
+            [10, 11, 12, 13, 14])
+
+
+class OrderReminderTests(CRMTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log_path = os.path.join(directory.name, 'reminders.log')
+        self.checkpoint_path = os.path.join(directory.name, 'checkpoint')
+
+    def send(self, **kwargs):
+        return reminders.send_order_reminders(
+            today=date(2025, 1, 8),
+            log_path=self.log_path,
+            checkpoint_path=self.checkpoint_path,
+            page_size=2,
+            **kwargs)
+
+    def logged_emails(self):
+        with open(self.log_path, encoding='utf-8') as f:
+            return [
+                line.split('email=')[1].strip()
+                for line in f if 'email=' in line]
+
+    def test_one_reminder_per_customer(self):
+        self.assertEqual(self.send(), 4)
+        self.assertEqual(
+            self.logged_emails(),
+            [c.email for c in self.customers])
+        # The window is done, a rerun sends nothing
+        self.assertEqual(self.send(), 0)
+
+    def test_rerun_resumes_after_failure(self):
+        calls = []
+
+        def flaky(query, variables=None, operation_name=None):
+            calls.append(variables['after'])
+            if len(calls) == 3:
+                raise GraphQLExecutionError([{'message': 'web tier busy'}])
+            return execute_graphql(query, variables, operation_name)
+
+        with mock.patch.object(reminders, 'execute_graphql', flaky):
+            with self.assertRaises(GraphQLExecutionError):
+                self.send()
+        self.assertEqual(len(self.logged_emails()), 2)
+
+        self.send()
+        self.assertEqual(
+            self.logged_emails(),
+            [c.email for c in self.customers])
+
+
+class CleanupTests(CRMTestCase):
+    def setUp(self):
+        super().setUp()
+        # Customer 0's last order is on 2025-01-03
+        self.idle = Customer.objects.create(
+            name='Idle', email='idle@example.com')
+        self.options = {'days': 2, 'today': date(2025, 1, 6)}
+
+    def test_dry_run_only_counts(self):
+        result = clean_inactive_customers(dry_run=True, **self.options)
+        self.assertEqual((result['customers'], result['orders']), (2, 3))
+        self.assertEqual(Customer.objects.count(), 5)
+
+    def test_deletes_in_chunks_and_keeps_stats(self):
+        CRMStats.objects.reconcile()
+        progress = []
+        result = clean_inactive_customers(
+            batch_size=1, on_chunk=lambda r: progress.append(r.customers),
+            **self.options)
+        self.assertEqual((result['customers'], result['orders']), (2, 3))
+        self.assertEqual(progress, [1, 2])
+        self.assertFalse(
+            Customer.objects.filter(
+                pk__in=[self.customers[0].pk, self.idle.pk]).exists())
+        self.assertFalse(
+            Order.products.through.objects.filter(
+                order__customer=self.customers[0]).exists())
+        snapshot = CRMStats.objects.get_snapshot()
+        expected = CRMStats.objects.reconcile()
+        self.assertEqual(
+            (snapshot.total_customers, snapshot.total_orders,
+             snapshot.total_revenue),
+            (expected.total_customers, expected.total_orders,
+             expected.total_revenue))
+
+
+    def test_delete_receivers_run(self):
+        deleted = []
+
+        def receiver(sender, instance, **kwargs):
+            deleted.append((sender, instance.pk))
+
+        for model in (Customer, Order):
+            post_delete.connect(receiver, sender=model)
+            self.addCleanup(post_delete.disconnect, receiver, sender=model)
+        order_ids = list(
+            self.customers[0].orders.values_list('pk', flat=True))
+        clean_inactive_customers(**self.options)
+        self.assertCountEqual(deleted, [
+            *[(Order, pk) for pk in order_ids],
+            (Customer, self.customers[0].pk),
+            (Customer, self.idle.pk),
+        ])
+
+
+class ReportTests(CRMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.enterContext(override_settings(
+            CRM_REPORT_DIR=self.directory.name, CRM_REPORT_CACHE='default'))
+        conf = {
+            'task_always_eager': True,
+            'task_eager_propagates': True,
+            'broker_url': 'memory://',
+            'result_backend': 'cache+memory://',
+        }
+        previous = {key: celery_app.conf[key] for key in conf}
+        celery_app.conf.update(conf)
+        self.addCleanup(celery_app.conf.update, previous)
+
+    def test_partitions_merge_to_single_aggregate(self):
+        ranges = reports.partition_customers(1)
+        self.assertEqual(len(ranges), 4)
+        partitioned = reports.merge_partials([
+            reports.aggregate_partition(*bounds) for bounds in ranges])
+        whole = reports.merge_partials([
+            reports.aggregate_partition(*reports.partition_customers(10)[0])
+        ])
+        for key in ('customers', 'orders', 'revenue', 'top_customers',
+                    'top_products', 'cohorts'):
+            self.assertEqual(partitioned[key], whole[key])
+
+    def test_chord_caches_and_writes_report(self):
+        report = tasks.build_crm_report(partition_size=2).get()
+        self.assertEqual(report['partitions'], 2)
+        self.assertEqual(
+            (report['customers'], report['orders'], report['revenue']),
+            (4, 12, '276.00'))
+        self.assertEqual(
+            [row['id'] for row in report['top_customers']],
+            [customer.pk for customer in self.customers])
+        self.assertEqual(
+            [(row['name'], row['units']) for row in report['top_products']],
+            [('Product 2', 8), ('Product 1', 8), ('Product 3', 4),
+             ('Product 0', 4)])
+        self.assertEqual(report['top_products'][0]['revenue'], '96.00')
+        self.assertEqual(
+            [(row['customers'], row['active_customers'])
+             for row in report['cohorts']],
+            [(4, 4)])
+
+        with open(report['path'], encoding='utf-8') as f:
+            written = json.load(f)
+        self.assertEqual(written['top_products'], report['top_products'])
+        self.assertEqual(reports.get_latest_report(), written)
+
+
+class TracingTests(CRMTestCase):
+    ORDERS = '''
+        query Orders {
+          allOrders { edges { node { customer { name } } } }
+        }
+    '''
+
+    def test_sampled_operation_returns_trace(self):
+        with override_settings(
+                GRAPHQL_TRACING_SAMPLE_RATE=1,
+                GRAPHQL_TRACING_EXTENSIONS=True):
+            response = self.query(self.ORDERS)
+        trace = json.loads(response.content)['extensions']['tracing']
+        paths = [
+            '.'.join(str(key) for key in field['path'])
+            for field in trace['execution']['resolvers']]
+        self.assertIn('allOrders', paths)
+        self.assertIn('allOrders.edges.0.node.customer', paths)
+        self.assertGreater(trace['database']['queries'], 0)
+        # Customers are batched by the loaders
+        self.assertEqual(trace['database']['duplicates'], [])
+
+    def test_unsampled_operation_has_no_trace(self):
+        with override_settings(
+                GRAPHQL_TRACING_SAMPLE_RATE=0,
+                GRAPHQL_TRACING_EXTENSIONS=True):
+            response = self.query(self.ORDERS)
+        body = json.loads(response.content)
+        self.assertNotIn('tracing', body.get('extensions', {}))
+
+    def test_slow_operation_log_reports_duplicate_sql(self):
+        with override_settings(
+                GRAPHQL_SLOW_OPERATION_MS=0,
+                GRAPHQL_TRACING_SAMPLE_RATE=1), \
+                self.assertLogs('crm.tracing', 'WARNING') as logs, \
+                tracing.trace_operation(mock.Mock()):
+            for customer in self.customers:
+                list(Order.objects.filter(customer=customer))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['event'], 'slow_graphql_operation')
+        self.assertEqual(record['queries'], 4)
+        self.assertEqual(record['duplicates'][0]['count'], 4)
+        self.assertIn('"customer_id" = ?', record['duplicates'][0]['sql'])
+
+    def test_unsampled_operation_only_counts_queries(self):
+        with mock.patch.object(tracing, 'fingerprint') as patched, \
+                tracing.trace_operation(mock.Mock()) as trace:
+            list(Order.objects.all())
+        self.assertEqual(trace.queries, 1)
+        patched.assert_not_called()
+
+    @override_settings(
+        GRAPHQL_TRACING_SAMPLE_RATE=1, GRAPHQL_TRACING_EXTENSIONS=True)
+    async def test_async_fields_are_timed_until_awaited(self):
+        resolve_stats = schema.resolve_stats_async
+
+        async def slow_stats():
+            await asyncio.sleep(0.05)
+            return await resolve_stats()
+
+        with mock.patch.object(schema, 'resolve_stats_async', slow_stats):
+            response = await self.async_client.post(
+                '/graphql/async',
+                {'query': '{ stats { totalCustomers } }'},
+                content_type='application/json')
+        trace = json.loads(response.content)['extensions']['tracing']
+        stats = next(
+            field for field in trace['execution']['resolvers']
+            if field['path'] == ['stats'])
+        self.assertGreaterEqual(stats['duration'], 50_000_000)
+        self.assertEqual(stats['queries'], 1)
+
+    def test_fingerprint_collapses_literals_and_in_lists(self):
+        self.assertEqual(
+            tracing.fingerprint(
+                "SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'x' "
+                "LIMIT 21"),
+            tracing.fingerprint(
+                "SELECT * FROM t WHERE id IN (%s)  AND name = 'y' LIMIT 5"))
+
+
+class QueryCostTests(CRMTestCase):
+    CUSTOMER_ORDERS = '''
+        query {
+          allCustomers(first: 2) { edges { node {
+            orders(first: 3) { totalCount edges { node { id } } }
+          } } }
+        }
+    '''
+    NESTED = '''
+        query Nested($n: Int) {
+          allCustomers(first: $n) { edges { node {
+            orders(first: $n) { edges { node {
+              products(first: $n) { edges { node { name } } }
+            } } }
+          } } }
+        }
+    '''
+
+    def post(self, query, variables=None):
+        response = self.query(query, variables=variables)
+        return response, json.loads(response.content)
+
+    def test_cost_is_reported_in_extensions(self):
+        response, body = self.post(self.CUSTOMER_ORDERS)
+        self.assertResponseNoErrors(response)
+        # allCustomers, then orders and totalCount once per customer
+        self.assertEqual(body['extensions']['cost']['requestedQueryCost'], 5)
+        self.assertEqual(body['extensions']['cost']['depth'], 7)
+
+    def test_unbounded_nesting_is_rejected_before_execution(self):
+        query = '''
+            query {
+              allCustomers { edges { node { orders { edges { node {
+                products { edges { node { orders { edges { node {
+                  customer { name }
+                } } } } } }
+              } } } } } }
+            }
+        '''
+        with CaptureQueriesContext(connection) as queries:
+            response, body = self.post(query)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            body['errors'][0]['extensions']['code'], 'QUERY_TOO_COMPLEX')
+        self.assertEqual(len(queries), 0)
+
+    @override_settings(GRAPHQL_MAX_QUERY_COST=1000)
+    def test_variable_limits_are_checked_with_their_values(self):
+        response, body = self.post(self.NESTED, {'n': 2})
+        self.assertResponseNoErrors(response)
+        self.assertEqual(body['extensions']['cost']['requestedQueryCost'], 7)
+
+        response, body = self.post(self.NESTED, {'n': 100})
+        self.assertResponseHasErrors(response)
+        error = body['errors'][0]['extensions']
+        self.assertEqual(
+            (error['code'], error['cost']), ('QUERY_TOO_COMPLEX', 10101))
+
+    @override_settings(GRAPHQL_COST_BUDGET_PER_MINUTE=10)
+    def test_budget_throttles_client(self):
+        for _ in range(2):
+            self.assertResponseNoErrors(self.query(self.CUSTOMER_ORDERS))
+        response, body = self.post(self.CUSTOMER_ORDERS)
+        self.assertEqual(
+            body['errors'][0]['extensions']['code'], 'QUERY_COST_THROTTLED')
+
+
+@override_settings(GRAPHQL_RESPONSE_CACHE_ENABLED=False)
+class AsyncViewTests(CRMTestCase):
+    STATS_AND_PRODUCTS = '''
+        query {
+          stats { totalCustomers totalOrders totalRevenue }
+          allProducts(first: 3, offset: 1) {
+            totalCount
+            pageInfo { hasNextPage hasPreviousPage endCursor }
+            edges { cursor node {
+              id name
+              orders { totalCount edges { node { customer { name } } } }
+            } }
+          }
+          allOrders(first: 2, keyset: true) {
+            totalCount
+            edges { node { id products { edges { node { name } } } } }
+          }
+        }
+    '''
+
+    async def apost(self, query, variables=None):
+        response = await self.async_client.post(
+            '/graphql/async',
+            {'query': query, 'variables': variables},
+            content_type='application/json')
+        return json.loads(response.content)
+
+    async def test_matches_sync_view(self):
+        expected = await sync_to_async(self.execute)(self.STATS_AND_PRODUCTS)
+        body = await self.apost(self.STATS_AND_PRODUCTS)
+        self.assertNotIn('errors', body)
+        self.assertEqual(body['data'], expected)
+
+    async def test_root_fields_resolve_concurrently(self):
+        connection_started = asyncio.Event()
+        resolve_connection = aio.resolve_connection
+        resolve_stats = schema.resolve_stats_async
+
+        async def connection_first(*args, **kwargs):
+            connection_started.set()
+            return await resolve_connection(*args, **kwargs)
+
+        async def stats_waiting_for_connection():
+            # Only returns if allProducts starts while stats is pending
+            await asyncio.wait_for(connection_started.wait(), timeout=5)
+            return await resolve_stats()
+
+        with mock.patch.object(
+                aio, 'resolve_connection', connection_first), \
+                mock.patch.object(
+                    schema, 'resolve_stats_async',
+                    stats_waiting_for_connection):
+            body = await self.apost(self.STATS_AND_PRODUCTS)
+        self.assertNotIn('errors', body)
+        self.assertEqual(body['data']['stats']['totalCustomers'], 4)
+
+    @override_settings(
+        GRAPHQL_RESPONSE_CACHE_ENABLED=True,
+        GRAPHQL_COST_BUDGET_PER_MINUTE=10000)
+    async def test_cache_calls_stay_off_the_event_loop(self):
+        on_loop = []
+
+        def watch(method):
+            def wrapper(*args, **kwargs):
+                try:
+                    asyncio.get_running_loop()
+                    on_loop.append(method.__name__)
+                except RuntimeError:
+                    pass
+                return method(*args, **kwargs)
+            return wrapper
+
+        query = '{ allProducts(first: 2) { edges { node { name } } } }'
+        sha256 = query_hash(query)
+        with ExitStack() as stack:
+            for name in ('get', 'get_many', 'set', 'add', 'incr'):
+                stack.enter_context(mock.patch.object(
+                    LocMemCache, name, watch(getattr(LocMemCache, name))))
+            for _ in range(2):
+                response = await self.async_client.post(
+                    '/graphql/async',
+                    {'query': query, 'extensions': {'persistedQuery': {
+                        'version': 1, 'sha256Hash': sha256}}},
+                    content_type='application/json')
+                self.assertNotIn('errors', json.loads(response.content))
+        self.assertEqual(on_loop, [])
+
+    async def test_mutations_run_on_the_sync_path(self):
+        body = await self.apost('''
+            mutation {
+              createCustomer(input: {name: "Async", email: "a@example.com"}) {
+                customer { email }
+              }
+            }
+        ''')
+        self.assertNotIn('errors', body)
+        self.assertTrue(
+            await Customer.objects.filter(email='a@example.com').aexists())
+
+
+class SubscriptionTests(TransactionTestCase):
+    ORDER_CREATED = '''
+        subscription {
+          orderCreated {
+            customer { name }
+            products { edges { node { name } } }
+          }
+        }
+    '''
+
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            name='Subscriber', email='subscriber@example.com')
+        self.plenty = Product.objects.create(
+            name='Plenty', price=Decimal('3.00'), stock=5)
+        self.scarce = Product.objects.create(
+            name='Scarce', price=Decimal('2.00'), stock=1)
+
+    @asynccontextmanager
+    async def connect(self, protocol='graphql-transport-ws', init=True):
+        communicator = ApplicationCommunicator(asgi_application, {
+            'type': 'websocket',
+            'path': '/graphql',
+            'subprotocols': [protocol],
+        })
+        await communicator.send_input({'type': 'websocket.connect'})
+        accept = await communicator.receive_output(timeout=1)
+        self.assertEqual(accept['subprotocol'], protocol)
+        if init:
+            await self.send(communicator, {'type': 'connection_init'})
+            self.assertEqual(
+                await self.receive(communicator), {'type': 'connection_ack'})
+        try:
+            yield communicator
+        finally:
+            await communicator.send_input(
+                {'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(timeout=1)
+
+    async def send(self, communicator, message):
+        await communicator.send_input(
+            {'type': 'websocket.receive', 'text': json.dumps(message)})
+
+    async def receive(self, communicator):
+        message = await communicator.receive_output(timeout=5)
+        self.assertEqual(message['type'], 'websocket.send')
+        return json.loads(message['text'])
+
+    async def subscribe(self, communicator, query, channel, type='subscribe'):
+        subscribers = pubsub.get_pubsub().subscriber_count(channel)
+        await self.send(communicator, {
+            'id': '1', 'type': type, 'payload': {'query': query}})
+        # Wait for the subscription to listen before publishing
+        for _ in range(100):
+            if pubsub.get_pubsub().subscriber_count(channel) > subscribers:
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f'No subscriber on {channel}')
+
+    async def test_create_order_pushes_order_created(self):
+        async with self.connect() as communicator:
+            await self.subscribe(
+                communicator, self.ORDER_CREATED, pubsub.ORDER_CREATED)
+            response = await sync_to_async(self.client.post)(
+                '/graphql',
+                {'query': '''
+                    mutation($customer: ID!, $products: [ID!]!) {
+                      createOrder(input: {
+                          customerId: $customer, productIds: $products,
+                          orderDate: "2025-03-01"}) {
+                        order { id }
+                      }
+                    }
+                ''', 'variables': {
+                    'customer': self.customer.pk,
+                    'products': [self.plenty.pk, self.scarce.pk],
+                }},
+                content_type='application/json')
+            self.assertNotIn('errors', json.loads(response.content))
+
+            message = await self.receive(communicator)
+            self.assertEqual(message['type'], 'next')
+            self.assertEqual(message['id'], '1')
+            order = message['payload']['data']['orderCreated']
+            self.assertEqual(order['customer']['name'], 'Subscriber')
+            self.assertEqual(
+                [edge['node']['name'] for edge in order['products']['edges']],
+                ['Plenty', 'Scarce'])
+
+            await self.send(communicator, {'id': '1', 'type': 'complete'})
+            self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+            self.assertEqual(
+                pubsub.get_pubsub().subscriber_count(pubsub.ORDER_CREATED), 0)
+
+    async def test_stock_changes_below_threshold_are_pushed(self):
+        async with self.connect() as communicator:
+            await self.subscribe(communicator, '''
+                subscription {
+                  productStockChanged(threshold: 3) { name stock }
+                }
+            ''', pubsub.STOCK_CHANGED)
+            result = await sync_to_async(bulk_create_orders)([{
+                'customer_id': self.customer.pk,
+                'product_ids': [self.plenty.pk, self.scarce.pk],
+                'order_date': '2025-03-01',
+            }])
+            self.assertEqual(result.created, 1)
+
+            message = await self.receive(communicator)
+            self.assertEqual(
+                message['payload']['data']['productStockChanged'],
+                {'name': 'Scarce', 'stock': 0})
+            # Plenty still has 4
+            self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+
+    async def test_restock_mutation_pushes_stock_changes(self):
+        async with self.connect(protocol='graphql-ws') as communicator:
+            await self.subscribe(communicator, '''
+                subscription { productStockChanged { name stock } }
+            ''', pubsub.STOCK_CHANGED, type='start')
+            await sync_to_async(execute_graphql)('''
+                mutation {
+                  updateLowStockProducts(threshold: 3, increment: 10) { count }
+                }
+            ''')
+
+            message = await self.receive(communicator)
+            self.assertEqual(message['type'], 'data')
+            self.assertEqual(
+                message['payload']['data']['productStockChanged'],
+                {'name': 'Scarce', 'stock': 11})
+
+            await self.send(communicator, {'id': '1', 'type': 'stop'})
+            self.assertEqual(
+                await self.receive(communicator),
+                {'type': 'complete', 'id': '1'})
+
+    async def test_queries_run_over_the_socket(self):
+        async with self.connect() as communicator:
+            await self.send(communicator, {
+                'id': 'q', 'type': 'subscribe',
+                'payload': {'query': '{ stats { totalCustomers } }'}})
+            message = await self.receive(communicator)
+            self.assertEqual(
+                message['payload']['data'], {'stats': {'totalCustomers': 1}})
+            self.assertEqual(
+                await self.receive(communicator),
+                {'type': 'complete', 'id': 'q'})
+
+            await self.send(communicator, {
+                'id': 'bad', 'type': 'subscribe',
+                'payload': {'query': 'subscription { missing }'}})
+            message = await self.receive(communicator)
+            self.assertEqual(message['type'], 'error')
+            self.assertIn('missing', message['payload'][0]['message'])
+
+    async def test_subscribe_before_init_closes_the_socket(self):
+        async with self.connect(init=False) as communicator:
+            await self.send(communicator, {
+                'id': '1', 'type': 'subscribe',
+                'payload': {'query': self.ORDER_CREATED}})
+            message = await communicator.receive_output(timeout=1)
+            self.assertEqual(message['type'], 'websocket.close')
+            self.assertEqual(message['code'], 4401)
+
+    def test_subscriptions_are_rejected_over_http(self):
+        response = self.client.post(
+            '/graphql', {'query': self.ORDER_CREATED},
+            content_type='application/json')
+        body = json.loads(response.content)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('websockets', body['errors'][0]['message'])
+
+
+class OrderExportTests(CRMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(get_user_model().objects.create_superuser(
+            'finance', 'finance@example.com', 'password'))
+
+    def export(self, **params):
+        response = self.client.get('/export/orders', params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_csv_streams_every_order_in_chunks(self):
+        with override_settings(CRM_EXPORT_CHUNK_SIZE=5):
+            response = self.export()
+            # The orders are only read while the response is sent
+            with CaptureQueriesContext(connection) as queries:
+                content = b''.join(response.streaming_content)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        # One cursor over the orders, one products query per chunk
+        self.assertEqual(len(queries), 1 + 3)
+        header, *rows = list(csv.reader(io.StringIO(content.decode())))
+        self.assertEqual(tuple(header), export.FIELDS)
+        self.assertEqual(len(rows), 12)
+        first = dict(zip(header, rows[0]))
+        self.assertEqual(first['customer_email'], 'customer0@example.com')
+        self.assertEqual(first['products'], 'Product 0|Product 1')
+        self.assertEqual(first['product_count'], '2')
+        self.assertEqual(first['total_amount'], '21.00')
+
+    def test_ndjson_applies_order_filters_and_gzip(self):
+        response = self.export(
+            format='ndjson', gzip='1', customer_name='customer 1',
+            product_name='product 2', order_by='-order_date')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('orders.ndjson.gz', response['Content-Disposition'])
+        orders = [
+            json.loads(line)
+            for line in gzip.decompress(content).decode().splitlines()]
+        self.assertEqual(
+            [order['order_date'] for order in orders],
+            ['2025-01-04', '2025-01-03'])
+        self.assertEqual(orders[0]['products'], ['Product 2', 'Product 3'])
+        self.assertEqual(orders[0]['total_amount'], '25.00')
+
+    async def test_streams_asynchronously_over_asgi(self):
+        await sync_to_async(self.async_client.force_login)(
+            await get_user_model().objects.aget(username='finance'))
+        response = await self.async_client.get(
+            '/export/orders', {'format': 'ndjson'})
+        self.assertTrue(response.is_async)
+        content = b''.join([chunk async for chunk in response])
+        self.assertEqual(len(content.splitlines()), 12)
+
+    def test_rejects_invalid_arguments_and_anonymous_users(self):
+        response = self.client.get(
+            '/export/orders', {'order_date__gte': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(
+            'order_date__gte', json.loads(response.content)['errors'])
+        self.assertEqual(
+            self.client.get('/export/orders', {'format': 'xml'}).status_code,
+            400)
+        self.client.logout()
+        self.assertEqual(self.client.get('/export/orders').status_code, 403)
+
+
+class BatchTests(CRMTestCase):
+    ORDER_PRODUCTS = '''
+        {
+          allOrders(first: 6) {
+            edges { node { products { edges { node { name stock } } } } }
+          }
+        }
+    '''
+
+    def post_batch(self, operations):
+        return self.client.post(
+            '/graphql', operations, content_type='application/json')
+
+    def test_executes_every_operation_of_an_array(self):
+        response = self.post_batch([
+            {'id': 'heartbeat', 'query': '{ hello }'},
+            {'id': 'stats', 'query': '{ stats { totalOrders } }'},
+            {'id': 'low', 'query': '{ allProducts(lowStock: true) '
+                                   '{ totalCount } }'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertEqual([entry['id'] for entry in body],
+                         ['heartbeat', 'stats', 'low'])
+        self.assertEqual(body[0]['data'], {'hello': 'Hello, GraphQL!'})
+        self.assertEqual(body[1]['data']['stats']['totalOrders'], 12)
+        self.assertEqual(body[2]['data']['allProducts']['totalCount'], 5)
+
+    def test_operations_share_the_loaders(self):
+        query = '''
+            {
+              search(query: "Customer") {
+                node { ... on OrderNode { customer { name } } }
+              }
+            }
+        '''
+
+        def customer_queries(operations):
+            with CaptureQueriesContext(connection) as queries:
+                body = json.loads(self.post_batch(operations).content)
+            return body, sum(
+                'FROM "crm_customer"' in query['sql'] for query in queries)
+
+        with override_settings(GRAPHQL_RESPONSE_CACHE_ENABLED=False):
+            single, expected = customer_queries([{'query': query}])
+            body, count = customer_queries([{'query': query}] * 2)
+        self.assertGreater(expected, 0)
+        self.assertEqual(body[1]['data'], single[0]['data'])
+        # The second operation finds the customers in the loaders
+        self.assertEqual(count, expected)
+
+    def test_mutations_clear_the_shared_loaders(self):
+        query = {'query': '''
+            {
+              search(query: "Product", first: 20) {
+                node { ... on OrderNode { customer { name } } }
+              }
+            }
+        '''}
+        body = json.loads(self.post_batch([
+            query,
+            {'query': '''
+                mutation {
+                  bulkCreateCustomers(updateExisting: true, input: [
+                      {name: "Renamed", email: "customer0@example.com"}]) {
+                    errors { messages }
+                  }
+                }
+            '''},
+            query,
+        ]).content)
+        self.assertEqual(
+            body[1]['data']['bulkCreateCustomers']['errors'], [])
+
+        def names(entry):
+            return {
+                hit['node']['customer']['name']
+                for hit in entry['data']['search'] if hit['node']}
+        self.assertIn('Customer 0', names(body[0]))
+        self.assertIn('Renamed', names(body[2]))
+        self.assertNotIn('Customer 0', names(body[2]))
+
+    @override_settings(GRAPHQL_BATCH_MAX_SIZE=2)
+    def test_rejects_batches_over_the_limit(self):
+        response = self.post_batch([{'query': '{ hello }'}] * 3)
+        self.assertEqual(response.status_code, 400)
+        error = json.loads(response.content)['errors'][0]
+        self.assertIn('maximum of 2', error['message'])
+
+    def test_rejects_entries_that_are_not_objects(self):
+        for entry in (1, 'x', None, ['{ hello }']):
+            response = self.post_batch([{'query': '{ hello }'}, entry])
+            self.assertEqual(response.status_code, 400)
+            error = json.loads(response.content)['errors'][0]
+            self.assertIn('Batch entry 1', error['message'])
+
+    def test_executor_runs_a_batch(self):
+        data = execute_graphql_batch([
+            {'query': '{ hello }'},
+            {'query': 'query($first: Int) { allProducts(first: $first) '
+                      '{ edges { node { name } } } }',
+             'variables': {'first': 2}},
+        ])
+        self.assertEqual(data[0], {'hello': 'Hello, GraphQL!'})
+        self.assertEqual(len(data[1]['allProducts']['edges']), 2)
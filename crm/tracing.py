@@ -0,0 +1,279 @@
+"""
+Resolver and SQL instrumentation of GraphQL operations.
+
+Every operation run by the view or the in-process executor is wrapped
+in an OperationTrace that times it and, through a database execute
+wrapper, counts its queries. Operations slower than
+GRAPHQL_SLOW_OPERATION_MS are logged as one JSON line.
+
+Per-field timings, and the grouping of queries by fingerprint (the SQL
+with literals and IN lists collapsed) that makes repeated shapes, the
+mark of an N+1, stand out, are only taken for the
+GRAPHQL_TRACING_SAMPLE_RATE share of operations; the middleware is a
+single attribute lookup and the execute wrapper a counter for the
+others. With GRAPHQL_TRACING_EXTENSIONS the trace of a sampled
+operation is returned in ``extensions.tracing`` (Apollo tracing
+format plus query counts).
+"""
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from inspect import isawaitable
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+TRACE_ATTRIBUTE = 'graphql_trace'
+
+_IN_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r'\s+')
+_TRANSACTION_CONTROL = ('SAVEPOINT', 'RELEASE', 'ROLLBACK', 'BEGIN', 'COMMIT')
+
+# Field whose resolver is running, per task under the async executor;
+# sync_to_async carries it to the thread running the queries
+_current_field = ContextVar('graphql_trace_field', default=None)
+
+
+def fingerprint(sql):
+    """
+    Return sql with its literals, parameters and IN lists
+    collapsed so queries of the same shape compare equal
+    """
+    sql = _IN_LIST.sub('(...)', sql)
+    sql = _LITERAL.sub('?', sql).replace('%s', '?')
+    return _SPACE.sub(' ', sql).strip()
+
+
+def should_sample():
+    rate = getattr(settings, 'GRAPHQL_TRACING_SAMPLE_RATE', 0)
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def _path_key(path):
+    # orders.edges.0.node.customer -> orders.edges.node.customer
+    return '.'.join(str(key) for key in path if not isinstance(key, int))
+
+
+class OperationTrace:
+    """
+    Timings and SQL statistics of one operation
+    """
+    def __init__(self, operation_name=None, operation_type=None,
+                 sampled=False):
+        self.operation_name = operation_name
+        self.operation_type = operation_type
+        self.sampled = sampled
+        self.started_at = timezone.now()
+        self.start = time.perf_counter_ns()
+        self.duration = None
+        self.queries = 0
+        self.fingerprints = Counter()
+        self.fingerprint_paths = defaultdict(set)
+        self.resolvers = []
+
+    def __call__(self, execute, sql, params, many, context):
+        """
+        Database execute wrapper counting the query
+        """
+        self.queries += 1
+        if not self.sampled:
+            return execute(sql, params, many, context)
+        field = _current_field.get()
+        if field is not None:
+            field['queries'] += 1
+        if not sql.lstrip().upper().startswith(_TRANSACTION_CONTROL):
+            key = fingerprint(sql)
+            self.fingerprints[key] += 1
+            if field is not None:
+                self.fingerprint_paths[key].add(_path_key(field['path']))
+        return execute(sql, params, many, context)
+
+    def trace_field(self, next, root, info, args):
+        """
+        Call a resolver, recording its wall time and queries; an
+        awaitable result is timed until it is awaited
+        """
+        field = {
+            'path': info.path.as_list(),
+            'parentType': info.parent_type.name,
+            'fieldName': info.field_name,
+            'returnType': str(info.return_type),
+            'startOffset': time.perf_counter_ns() - self.start,
+            'duration': 0,
+            'queries': 0,
+        }
+        token = _current_field.set(field)
+        try:
+            result = next(root, info, **args)
+        except Exception:
+            self._end_field(field)
+            raise
+        finally:
+            _current_field.reset(token)
+        if isawaitable(result):
+            return self._await_field(field, result)
+        self._end_field(field)
+        return result
+
+    async def _await_field(self, field, result):
+        token = _current_field.set(field)
+        try:
+            return await result
+        finally:
+            _current_field.reset(token)
+            self._end_field(field)
+
+    def _end_field(self, field):
+        field['duration'] = (
+            time.perf_counter_ns() - self.start - field['startOffset'])
+        self.resolvers.append(field)
+
+    def finish(self):
+        self.duration = time.perf_counter_ns() - self.start
+
+    @property
+    def duration_ms(self):
+        return (self.duration or 0) / 1_000_000
+
+    def duplicate_queries(self):
+        """
+        Return the fingerprints run at least
+        GRAPHQL_DUPLICATE_QUERY_THRESHOLD times, most frequent first
+        """
+        threshold = getattr(settings, 'GRAPHQL_DUPLICATE_QUERY_THRESHOLD', 2)
+        return [
+            {
+                'sql': key,
+                'count': count,
+                'paths': sorted(self.fingerprint_paths.get(key, ())),
+            }
+            for key, count in self.fingerprints.most_common()
+            if count >= threshold
+        ]
+
+    def as_extension(self):
+        return {
+            'version': 1,
+            'startTime': self.started_at.isoformat(),
+            'endTime': timezone.now().isoformat(),
+            'duration': self.duration,
+            'execution': {'resolvers': self.resolvers},
+            'database': {
+                'queries': self.queries,
+                'duplicates': self.duplicate_queries(),
+            },
+        }
+
+    def as_log_record(self):
+        record = {
+            'event': 'slow_graphql_operation',
+            'operation': self.operation_name,
+            'type': self.operation_type,
+            'duration_ms': round(self.duration_ms, 3),
+            'queries': self.queries,
+            'duplicates': self.duplicate_queries()[:5],
+            'sampled': self.sampled,
+        }
+        if self.sampled:
+            slowest = sorted(
+                self.resolvers, key=lambda f: f['duration'], reverse=True)
+            record['slowest_fields'] = [
+                {
+                    'path': _path_key(field['path']),
+                    'duration_ms': round(field['duration'] / 1_000_000, 3),
+                    'queries': field['queries'],
+                }
+                for field in slowest[:10]
+            ]
+        return record
+
+
+class TracingMiddleware:
+    """
+    Graphene middleware timing the resolvers of sampled operations
+    """
+    def resolve(self, next, root, info, **args):
+        trace = getattr(info.context, TRACE_ATTRIBUTE, None)
+        if trace is None or not trace.sampled:
+            return next(root, info, **args)
+        return trace.trace_field(next, root, info, args)
+
+
+def extensions_enabled():
+    return getattr(settings, 'GRAPHQL_TRACING_EXTENSIONS', False)
+
+
+def log_if_slow(trace):
+    threshold = getattr(settings, 'GRAPHQL_SLOW_OPERATION_MS', None)
+    if threshold is not None and trace.duration_ms > threshold:
+        logger.warning(json.dumps(trace.as_log_record(), default=str))
+
+
+def _start_trace(context, operation_ast, operation_name):
+    if operation_ast is not None:
+        operation_name = operation_name or (
+            operation_ast.name.value if operation_ast.name else None)
+    trace = OperationTrace(
+        operation_name,
+        operation_ast.operation.value if operation_ast is not None else None,
+        sampled=should_sample(),
+    )
+    setattr(context, TRACE_ATTRIBUTE, trace)
+    return trace
+
+
+def _end_trace(context, trace):
+    trace.finish()
+    setattr(context, TRACE_ATTRIBUTE, None)
+    log_if_slow(trace)
+
+
+@contextmanager
+def trace_operation(context, operation_ast=None, operation_name=None):
+    """
+    Trace the operation executed in the block, exposing the trace
+    to TracingMiddleware through context
+    """
+    trace = _start_trace(context, operation_ast, operation_name)
+    try:
+        with connection.execute_wrapper(trace):
+            yield trace
+    finally:
+        _end_trace(context, trace)
+
+
+@asynccontextmanager
+async def atrace_operation(context, operation_ast=None, operation_name=None):
+    """
+    trace_operation for the async view, whose queries run on the
+    request's sync thread rather than on the event loop
+    """
+    trace = _start_trace(context, operation_ast, operation_name)
+    wrappers = await sync_to_async(lambda: connection.execute_wrappers)()
+    wrappers.append(trace)
+    try:
+        yield trace
+    finally:
+        wrappers.remove(trace)
+        _end_trace(context, trace)
+
+
+def attach_extension(result, trace):
+    """
+    Add the trace of a sampled operation to result.extensions
+    when GRAPHQL_TRACING_EXTENSIONS is on
+    """
+    if trace.sampled and extensions_enabled():
+        result.extensions = {
+            **(result.extensions or {}), 'tracing': trace.as_extension()}
+    return result
@@ -1,3 +1,487 @@
-from django.shortcuts import render
+import json
+from dataclasses import dataclass
+from inspect import isawaitable
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection, transaction
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+    HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse)
+from django.views import View
+from graphene_django.constants import MUTATION_ERRORS_FLAG
+from graphene_django.settings import graphene_settings
+from graphene_django.utils.utils import set_rollback
+from graphene_django.views import GraphQLView, HttpError
+from graphql import (
+    DocumentNode, ExecutionResult, OperationDefinitionNode, OperationType,
+    execute, get_operation_ast)
+from graphql.error import GraphQLError
+from graphql.type import validate_schema
+from graphql.validation import specified_rules
+from . import cost, export, response_cache, tracing
+from .aio import AsyncBridgeMiddleware
+from .documents import document_cache, resolve_persisted_query
+from .filters import OrderFilter
+from .loaders import Loaders
+from .models import Order
 
-# Create your views here.
+
+@dataclass
+class PreparedOperation:
+    """
+    A validated operation ready to execute
+    """
+    document: DocumentNode
+    operation_ast: OperationDefinitionNode
+    variables: dict
+    operation_name: str
+    extensions: dict
+
+    @property
+    def arguments(self):
+        return (
+            self.document, self.operation_ast, self.variables,
+            self.operation_name)
+
+    def add_extensions(self, result):
+        if self.extensions:
+            result.extensions = {
+                **(result.extensions or {}), **self.extensions}
+        return result
+
+
+class CRMGraphQLView(GraphQLView):
+    """
+    GraphQL view that attaches a fresh set of DataLoaders to every
+    request, caches parsed and validated documents and the responses
+    of hinted queries, supports Automatic Persisted Queries and
+    traces every executed operation (see crm.tracing). Operations
+    over the cost limits of crm.cost are rejected before execution.
+
+    A JSON array of operations is executed as a batch of at most
+    GRAPHQL_BATCH_MAX_SIZE operations sharing the request's loaders,
+    which are cleared after every mutation.
+    """
+    document_cache = document_cache
+    validation_rules = (*specified_rules, cost.QueryCostRule)
+
+    def get_context(self, request):
+        if getattr(request, 'loaders', None) is None:
+            request.loaders = Loaders()
+        return request
+
+    def parse_body(self, request):
+        if (
+            not self.batch
+            and self.get_content_type(request) == 'application/json'
+            and request.body.lstrip()[:1] == b'['
+        ):
+            self.batch = True
+        data = super().parse_body(request)
+        if not self.batch:
+            return data
+        limit = getattr(settings, 'GRAPHQL_BATCH_MAX_SIZE', None)
+        if limit is not None and len(data) > limit:
+            raise HttpError(HttpResponseBadRequest(
+                f"Batch of {len(data)} operations exceeds the maximum "
+                f"of {limit}."))
+        for index, entry in enumerate(data):
+            if not isinstance(entry, dict):
+                raise HttpError(HttpResponseBadRequest(
+                    f"Batch entry {index} is not a JSON query object."))
+        return data
+
+    def get_response(self, request, data, show_graphiql=False):
+        try:
+            data = self.resolve_persisted_query(request, data)
+        except GraphQLError as e:
+            # APQ clients expect a 200 with the error code so they
+            # can retry with the full query text
+            result = self.json_encode(
+                request, {'errors': [self.format_error(e)]})
+            return result, 200
+
+        query, variables, operation_name, id = self.get_graphql_params(
+            request, data)
+        execution_result = self.execute_graphql_request(
+            request, data, query, variables, operation_name, show_graphiql
+        )
+        return self.build_response(
+            request, execution_result, id, show_graphiql)
+
+    def build_response(self, request, execution_result, id,
+                       show_graphiql=False):
+        if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+            set_rollback()
+
+        status_code = 200
+        if not execution_result:
+            return None, status_code
+
+        response = {}
+        if execution_result.errors:
+            set_rollback()
+            response["errors"] = [
+                self.format_error(e) for e in execution_result.errors
+            ]
+
+        if execution_result.errors and any(
+            not getattr(e, "path", None) for e in execution_result.errors
+        ):
+            status_code = 400
+        else:
+            response["data"] = execution_result.data
+
+        if execution_result.extensions:
+            response["extensions"] = execution_result.extensions
+
+        if self.batch:
+            response["id"] = id
+            response["status"] = status_code
+
+        result = self.json_encode(request, response, pretty=show_graphiql)
+        return result, status_code
+
+    def resolve_persisted_query(self, request, data):
+        extensions = request.GET.get('extensions') or data.get('extensions')
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(
+                    HttpResponseBadRequest("Extensions are invalid JSON."))
+        persisted_query = (extensions or {}).get('persistedQuery')
+        if not persisted_query:
+            return data
+
+        query = request.GET.get('query') or data.get('query')
+        data = dict(data.items())
+        data['query'] = resolve_persisted_query(query, persisted_query)
+        return data
+
+    def execute_graphql_request(
+        self, request, data, query, variables, operation_name,
+        show_graphiql=False
+    ):
+        operation = self.prepare_operation(
+            request, query, variables, operation_name, show_graphiql)
+        if not isinstance(operation, PreparedOperation):
+            return operation
+
+        if not response_cache.is_enabled():
+            result = self.execute_document(request, *operation.arguments)
+        else:
+            result = self.execute_cached(request, *operation.arguments)
+        return operation.add_extensions(result)
+
+    def prepare_operation(
+        self, request, query, variables, operation_name, show_graphiql=False
+    ):
+        """
+        Parse, validate and cost an operation, returning the
+        PreparedOperation to execute or the result to send instead
+        """
+        if not query:
+            if show_graphiql:
+                return None
+            raise HttpError(
+                HttpResponseBadRequest("Must provide query string."))
+
+        schema = self.schema.graphql_schema
+
+        schema_validation_errors = validate_schema(schema)
+        if schema_validation_errors:
+            return ExecutionResult(data=None, errors=schema_validation_errors)
+
+        try:
+            document, validation_errors = self.document_cache.get_validated(
+                schema,
+                query,
+                self.validation_rules,
+                graphene_settings.MAX_VALIDATION_ERRORS,
+            )
+        except Exception as e:
+            return ExecutionResult(errors=[e])
+
+        operation_ast = get_operation_ast(document, operation_name)
+
+        if (
+            request.method.lower() == "get"
+            and operation_ast is not None
+            and operation_ast.operation != OperationType.QUERY
+        ):
+            if show_graphiql:
+                return None
+
+            raise HttpError(
+                HttpResponseNotAllowed(
+                    ["POST"],
+                    "Can only perform a {} operation from a POST request.".format(
+                        operation_ast.operation.value
+                    ),
+                )
+            )
+
+        if validation_errors:
+            return ExecutionResult(data=None, errors=validation_errors)
+
+        if (
+            operation_ast is not None
+            and operation_ast.operation == OperationType.SUBSCRIPTION
+        ):
+            return ExecutionResult(errors=[GraphQLError(
+                'Subscriptions are served over websockets at /graphql.',
+                operation_ast)])
+
+        extensions = {}
+        if operation_ast is not None:
+            query_cost = cost.measure(
+                schema, document, operation_ast, variables)
+            extensions['cost'] = cost.as_extension(query_cost)
+            error = (
+                cost.too_complex_error(query_cost, operation_ast)
+                or cost.charge(request, query_cost))
+            if error is not None:
+                return ExecutionResult(errors=[error], extensions=extensions)
+
+        return PreparedOperation(
+            document, operation_ast, variables, operation_name, extensions)
+
+    def execute_cached(
+        self, request, document, operation_ast, variables, operation_name
+    ):
+        """
+        Serve a cacheable query from the response cache,
+        executing and storing it on a miss
+        """
+        plan = response_cache.get_plan(
+            self.schema.graphql_schema, document, operation_ast)
+        if plan is None:
+            return self.execute_document(
+                request, document, operation_ast, variables, operation_name)
+
+        key, data = response_cache.lookup(
+            plan, document, operation_name, variables, request)
+        if data is not None:
+            return ExecutionResult(data=data)
+
+        result = self.execute_document(
+            request, document, operation_ast, variables, operation_name)
+        if not result.errors and result.data is not None:
+            response_cache.set_response(key, result.data, plan.ttl)
+        return result
+
+    def execute_document(
+        self, request, document, operation_ast, variables, operation_name
+    ):
+        """
+        Execute an already validated document under a trace
+        """
+        with tracing.trace_operation(
+                request, operation_ast, operation_name) as trace:
+            result = self.run_document(
+                request, document, operation_ast, variables, operation_name)
+        if (
+            operation_ast is not None
+            and operation_ast.operation == OperationType.MUTATION
+        ):
+            # Later operations of a batch must not read stale rows
+            request.loaders.clear()
+        return tracing.attach_extension(result, trace)
+
+    def run_document(
+        self, request, document, operation_ast, variables, operation_name
+    ):
+        schema = self.schema.graphql_schema
+        try:
+            execute_options = {
+                "root_value": self.get_root_value(request),
+                "context_value": self.get_context(request),
+                "variable_values": variables,
+                "operation_name": operation_name,
+                "middleware": self.get_middleware(request),
+            }
+            if self.execution_context_class:
+                execute_options[
+                    "execution_context_class"
+                ] = self.execution_context_class
+
+            if (
+                operation_ast is not None
+                and operation_ast.operation == OperationType.MUTATION
+                and (
+                    graphene_settings.ATOMIC_MUTATIONS is True
+                    or connection.settings_dict.get("ATOMIC_MUTATIONS", False) is True
+                )
+            ):
+                with transaction.atomic():
+                    result = execute(schema, document, **execute_options)
+                    if getattr(request, MUTATION_ERRORS_FLAG, False) is True:
+                        transaction.set_rollback(True)
+                return result
+
+            return execute(schema, document, **execute_options)
+        except Exception as e:
+            return ExecutionResult(errors=[e])
+
+
+class AsyncCRMGraphQLView(CRMGraphQLView):
+    """
+    CRMGraphQLView served on the event loop. Queries run with
+    graphql-core's async executor so sibling root fields resolve
+    concurrently (see crm.aio); mutations keep the sync atomic path
+    on the request's thread.
+    """
+    view_is_async = True
+    bridge = AsyncBridgeMiddleware()
+
+    def get_middleware(self, request):
+        return [*(self.middleware or ()), self.bridge]
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            if request.method.lower() not in ("get", "post"):
+                raise HttpError(
+                    HttpResponseNotAllowed(
+                        ["GET", "POST"],
+                        "GraphQL only supports GET and POST requests.",
+                    )
+                )
+            data = self.parse_body(request)
+            if self.batch:
+                responses = [
+                    await self.aget_response(request, entry)
+                    for entry in data
+                ]
+                result = "[{}]".format(
+                    ",".join(response[0] for response in responses))
+                status_code = max(
+                    (response[1] for response in responses), default=200)
+            else:
+                result, status_code = await self.aget_response(
+                    request, data)
+            return HttpResponse(
+                status=status_code, content=result,
+                content_type="application/json")
+        except HttpError as e:
+            response = e.response
+            response["Content-Type"] = "application/json"
+            response.content = self.json_encode(
+                request, {"errors": [self.format_error(e)]})
+            return response
+
+    async def aget_response(self, request, data):
+        # APQ lookups, the cost budget and the response cache use the
+        # sync cache API, which blocks on network I/O with Redis, so
+        # they run off the event loop
+        try:
+            data = await sync_to_async(self.resolve_persisted_query)(
+                request, data)
+        except GraphQLError as e:
+            result = self.json_encode(
+                request, {'errors': [self.format_error(e)]})
+            return result, 200
+
+        query, variables, operation_name, id = self.get_graphql_params(
+            request, data)
+        result = await sync_to_async(self.prepare_operation)(
+            request, query, variables, operation_name)
+        if isinstance(result, PreparedOperation):
+            operation = result
+            if not response_cache.is_enabled():
+                result = await self.aexecute_document(
+                    request, *operation.arguments)
+            else:
+                result = await self.aexecute_cached(
+                    request, *operation.arguments)
+            result = operation.add_extensions(result)
+        return self.build_response(request, result, id)
+
+    async def aexecute_cached(
+        self, request, document, operation_ast, variables, operation_name
+    ):
+        plan = response_cache.get_plan(
+            self.schema.graphql_schema, document, operation_ast)
+        if plan is None:
+            return await self.aexecute_document(
+                request, document, operation_ast, variables, operation_name)
+
+        key, data = await sync_to_async(response_cache.lookup)(
+            plan, document, operation_name, variables, request)
+        if data is not None:
+            return ExecutionResult(data=data)
+
+        result = await self.aexecute_document(
+            request, document, operation_ast, variables, operation_name)
+        if not result.errors and result.data is not None:
+            await sync_to_async(response_cache.set_response)(
+                key, result.data, plan.ttl)
+        return result
+
+    async def aexecute_document(
+        self, request, document, operation_ast, variables, operation_name
+    ):
+        if operation_ast.operation != OperationType.QUERY:
+            return await sync_to_async(self.execute_document)(
+                request, document, operation_ast, variables, operation_name)
+
+        async with tracing.atrace_operation(
+                request, operation_ast, operation_name) as trace:
+            try:
+                result = execute(
+                    self.schema.graphql_schema,
+                    document,
+                    root_value=self.get_root_value(request),
+                    context_value=self.get_context(request),
+                    variable_values=variables,
+                    operation_name=operation_name,
+                    middleware=self.get_middleware(request),
+                )
+                if isawaitable(result):
+                    result = await result
+            except Exception as e:
+                result = ExecutionResult(errors=[e])
+        return tracing.attach_extension(result, trace)
+
+
+class OrderExportView(View):
+    """
+    Stream the orders matching the OrderFilter arguments of the query
+    string as CSV (``format=csv``, the default) or NDJSON
+    (``format=ndjson``), gzipped with ``gzip=1`` (see crm.export)
+    """
+    permission = 'crm.view_order'
+
+    def get(self, request):
+        if not request.user.has_perm(self.permission):
+            return HttpResponseForbidden()
+        format = request.GET.get('format', export.CSV)
+        if format not in export.CONTENT_TYPES:
+            return HttpResponseBadRequest(
+                f"Unknown format, use one of: "
+                f"{', '.join(export.CONTENT_TYPES)}.")
+
+        filterset = OrderFilter(request.GET, queryset=Order.objects.all())
+        if not filterset.is_valid():
+            return JsonResponse({'errors': filterset.errors}, status=400)
+        orders = filterset.qs
+        if filterset.form.cleaned_data.get('product_name'):
+            # Joins the products, one row per matching product
+            orders = orders.distinct()
+        orders = orders.order_by(*orders.query.order_by, 'pk')
+
+        compress = request.GET.get('gzip') in ('1', 'true')
+        stream = export.export_orders(orders, format, compress)
+        if isinstance(request, ASGIRequest):
+            stream = export.aiter_stream(stream)
+
+        filename = f'orders.{format}'
+        content_type = export.CONTENT_TYPES[format]
+        if compress:
+            filename += '.gz'
+            content_type = 'application/gzip'
+        response = StreamingHttpResponse(stream, content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="{filename}"')
+        return response